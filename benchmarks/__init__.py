@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+
+base_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def setupPaths(dataDir):
+    # must run before anything from WazappDesktop is imported, the config path is fixed at import time
+    os.environ['WAZAPP_CONFIG_PATH'] = dataDir
+    sys.path.insert(0, os.path.join(base_dir, 'src'))
+    # reuse the libraries downloaded by a normal installation instead of downloading them again
+    defaultConfigPath = os.path.expanduser(os.path.join('~', '.config', 'wazapp'))
+    sys.path.append(os.path.join(defaultConfigPath, 'peewee-2.0.7'))
+    sys.path.append(os.path.join(defaultConfigPath, 'yowsup-master', 'src'))
+
+def summarize(durations):
+    # latency statistics in milliseconds
+    if not durations:
+        return {'count': 0}
+    durations = sorted(durations)
+    count = len(durations)
+    percentile = lambda p: durations[min(count - 1, int(p * count))] * 1000
+    return {
+        'count': count,
+        'mean': sum(durations) / count * 1000,
+        'median': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': durations[-1] * 1000,
+    }
+
+def timeCalls(func, args):
+    # call func once for every entry in args and return the duration of each call
+    durations = []
+    for arg in args:
+        start = time.time()
+        func(*arg)
+        durations.append(time.time() - start)
+    return durations
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else None
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import argparse
+import subprocess
+
+from . import base_dir, setupPaths
+
+# (contacts, messages)
+SIZES = {'small': (1000, 10000), 'medium': (10000, 1000000), 'large': (100000, 10000000)}
+BENCHMARKS = ('inserts', 'pages', 'contacts', 'renderer', 'webpage', 'startup')
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=base_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix=''):
+    values = {}
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            values.update(flatten(value, '%s%s.' % (prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def compare(oldResults, newResults):
+    # for times lower is better, for rates (perSecond) higher is better
+    old = flatten(oldResults['benchmarks'])
+    new = flatten(newResults['benchmarks'])
+    print '%-50s %14s %14s %8s' % ('benchmark', (oldResults.get('commit') or '')[:12], (newResults.get('commit') or '')[:12], 'change')
+    for key in sorted(set(old) & set(new)):
+        change = '%+.1f%%' % (100.0 * (new[key] - old[key]) / old[key]) if old[key] else ''
+        print '%-50s %14.4f %14.4f %8s' % (key, old[key], new[key], change)
+
+def prepareDataset(dataDir, isDefaultDir, numContacts, numMessages, seed):
+    # generated datasets are reused, the marker file is only written once a dataset is complete
+    markerFile = os.path.join(dataDir, 'dataset.json')
+    if os.path.exists(markerFile):
+        with open(markerFile) as fp:
+            return json.load(fp)
+    if os.path.exists(dataDir) and os.listdir(dataDir):
+        if not isDefaultDir:
+            sys.exit('%s is not empty and contains no benchmark dataset' % dataDir)
+        # an interrupted generation
+        shutil.rmtree(dataDir)
+    from .syntheticData import generateDatabase
+    start = time.time()
+    generateDatabase(numContacts, numMessages, seed)
+    dataset = {'contacts': numContacts, 'messages': numMessages, 'seed': seed, 'generationSeconds': time.time() - start}
+    with open(markerFile, 'w') as fp:
+        json.dump(dataset, fp)
+    return dataset
+
+def main():
+    argParser = argparse.ArgumentParser(prog='python -m benchmarks', description='time the storage, rendering and contact hot paths on synthetic data')
+    argParser.add_argument('--size', choices=sorted(SIZES), default='small', help='dataset size, default: small')
+    argParser.add_argument('--contacts', type=int, help='number of contacts, overrides --size')
+    argParser.add_argument('--messages', type=int, help='number of messages, overrides --size')
+    argParser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    argParser.add_argument('--data-dir', help='where the dataset is generated, default: ~/.cache/wazapp-benchmarks/CONTACTS-MESSAGES')
+    argParser.add_argument('--only', help='comma separated benchmarks to run, from: %s' % ', '.join(BENCHMARKS))
+    argParser.add_argument('--output', help='result file, default: benchmark-COMMIT.json')
+    argParser.add_argument('--compare', metavar='FILE', help='print the change against the results in FILE')
+    args = argParser.parse_args()
+
+    numContacts, numMessages = SIZES[args.size]
+    numContacts = args.contacts or numContacts
+    numMessages = args.messages or numMessages
+    isDefaultDir = args.data_dir is None
+    dataDir = os.path.abspath(args.data_dir or os.path.join(os.path.expanduser('~'), '.cache', 'wazapp-benchmarks', '%d-%d' % (numContacts, numMessages)))
+    selected = args.only.split(',') if args.only else BENCHMARKS
+    for name in selected:
+        if name not in BENCHMARKS:
+            argParser.error('unknown benchmark: %s' % name)
+
+    setupPaths(dataDir)
+    dataset = prepareDataset(dataDir, isDefaultDir, numContacts, numMessages, args.seed)
+    from WazappDesktop.Database import initDatabase, DatabaseWriter
+    initDatabase()
+
+    benchmarks = {}
+    for name in selected:
+        print 'running %s' % name
+        if name == 'inserts':
+            from .storage import benchmarkInserts
+            benchmarks[name] = benchmarkInserts()
+        elif name == 'pages':
+            from .storage import benchmarkPageFetches
+            benchmarks[name] = benchmarkPageFetches()
+        elif name == 'contacts':
+            from .storage import benchmarkContactLookups
+            benchmarks[name] = benchmarkContactLookups()
+        elif name == 'renderer':
+            from .rendering import benchmarkRenderer
+            benchmarks[name] = benchmarkRenderer()
+        elif name == 'webpage':
+            from .rendering import benchmarkWebPage
+            benchmarks[name] = benchmarkWebPage()
+        elif name == 'startup':
+            from .startup import benchmarkStartup
+            DatabaseWriter.instance().flush()
+            benchmarks[name] = benchmarkStartup(dataDir)
+    DatabaseWriter.instance().flush()
+
+    commit = gitCommit()
+    results = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'dataset': dataset,
+        'benchmarks': benchmarks,
+    }
+    output = args.output or 'benchmark-%s.json' % (commit[:12] if commit else time.strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+    print 'results written to %s' % output
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+if __name__ == '__main__':
+    main()
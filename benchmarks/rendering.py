@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+
+from PyQt4.QtCore import QUrl, QSize, QEventLoop
+
+from WazappDesktop.Database import ContactModel, MessageModel, getDatabase
+from WazappDesktop.ContactDB import ContactDB
+from WazappDesktop.Contacts import Contacts
+from WazappDesktop.MessageRenderer import MessageRenderer
+
+from . import base_dir, summarize, rate
+
+def _busiestConversation():
+    cursor = getDatabase().execute_sql('SELECT c."%s" FROM "%s" m JOIN "%s" c ON c."%s" = m."%s" GROUP BY m."%s" ORDER BY COUNT(*) DESC LIMIT 1' % (
+        ContactModel.conversationId.db_column, MessageModel._meta.db_table, ContactModel._meta.db_table,
+        ContactModel.id.db_column, MessageModel.contact.db_column, MessageModel.contact.db_column))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _newRenderer():
+    return MessageRenderer(Contacts.instance(), os.path.join(base_dir, 'res', 'icons', 'im-user.png'))
+
+def _renderAll(renderer, messages):
+    state = renderer.newState()
+    durations = []
+    for message in messages:
+        start = time.time()
+        renderer.render(message.messageId, message.timestamp, message.sender, message.message, state)
+        durations.append(time.time() - start)
+    return durations
+
+def benchmarkRenderer(numMessages=2000):
+    # html for one message, the first time and again from the fragment cache
+    messages = ContactDB.instance().getMessageList(_busiestConversation(), numMessages=numMessages)
+    renderer = _newRenderer()
+    cold = _renderAll(renderer, messages)
+    warm = _renderAll(renderer, messages)
+    return {
+        'messages': len(messages),
+        'cold': summarize(cold), 'coldMessagesPerSecond': rate(len(cold), sum(cold)),
+        'warm': summarize(warm), 'warmMessagesPerSecond': rate(len(warm), sum(warm)),
+    }
+
+def benchmarkWebPage(numMessages=500, pageSize=50):
+    # what ChatWidget.showMessage() and ChatWidget._insertPage() do, in a QWebPage without a window.
+    # needs a QApplication, on machines without a display run under xvfb-run
+    from PyQt4.QtGui import QApplication
+    from PyQt4.QtWebKit import QWebPage
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    messages = ContactDB.instance().getMessageList(_busiestConversation(), numMessages=numMessages)
+    renderer = _newRenderer()
+    page = QWebPage()
+    page.setViewportSize(QSize(800, 600))
+    frame = page.mainFrame()
+    loop = QEventLoop()
+    page.loadFinished.connect(loop.quit)
+    start = time.time()
+    frame.load(QUrl('file://%s' % os.path.join(base_dir, 'res', 'html', 'ChatView.html')))
+    loop.exec_()
+    loadSeconds = time.time() - start
+    body = frame.documentElement().findFirst('body')
+
+    # single live messages, each followed by the layout the scroll to the bottom needs
+    state = renderer.newState()
+    single = []
+    for message in messages:
+        start = time.time()
+        body.appendInside(renderer.render(message.messageId, message.timestamp, message.sender, message.message, state))
+        frame.evaluateJavaScript('elementAdded("%s"); document.body.offsetHeight' % (renderer.paragraphIdFormat % message.messageId))
+        app.processEvents()
+        single.append(time.time() - start)
+
+    # whole pages of history, rendered into one element like when scrolling up
+    body.setInnerXml('')
+    pages = []
+    for pageNumber, chunkStart in enumerate(range(0, len(messages), pageSize)):
+        state = renderer.newState()
+        start = time.time()
+        html = ''.join(renderer.render(message.messageId, message.timestamp, message.sender, message.message, state)
+                       for message in messages[chunkStart:chunkStart + pageSize])
+        body.prependInside('<div class="page" id="bench%d">%s</div>' % (pageNumber, html))
+        frame.evaluateJavaScript('elementAdded("bench%d"); document.body.offsetHeight' % pageNumber)
+        app.processEvents()
+        pages.append(time.time() - start)
+
+    return {
+        'messages': len(messages),
+        'loadSeconds': loadSeconds,
+        'showMessage': summarize(single),
+        'insertPage': summarize(pages),
+        'pageSize': pageSize,
+    }
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import datetime
+import subprocess
+
+from . import base_dir
+
+def _coldStart(numConversations=10):
+    # the work done before the first chats can be shown, timed in a fresh interpreter.
+    # the operating system may still have the database in its file cache
+    phases = []
+    def phase(name, start):
+        phases.append((name, time.time() - start))
+        return time.time()
+
+    start = total = time.time()
+    from WazappDesktop.Database import initDatabase
+    from WazappDesktop.ContactDB import ContactDB
+    from WazappDesktop.Contacts import Contacts
+    from WazappDesktop.helpers import getConfig
+    start = phase('import modules', start)
+    initDatabase()
+    start = phase('open database', start)
+    ContactDB.instance().getAll()
+    start = phase('load contacts', start)
+    recent = ContactDB.instance().getRecentConversationIds(datetime.datetime.now() - datetime.timedelta(14))
+    for conversationId in sorted(recent)[:numConversations]:
+        ContactDB.instance().getMessageList(conversationId, numMessages=getConfig('chatViewPageSize', 50))
+    phase('load first pages', start)
+    phases.append(('total', time.time() - total))
+    return dict(phases)
+
+def benchmarkStartup(dataDir, repeat=3):
+    runs = []
+    for i in range(repeat):
+        env = dict(os.environ, WAZAPP_CONFIG_PATH=dataDir)
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.startup', dataDir], cwd=base_dir, env=env)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    result = {}
+    for name in runs[0]:
+        values = sorted(run[name] for run in runs)
+        result[name] = {'median': values[len(values) // 2], 'min': values[0], 'max': values[-1]}
+    result['runs'] = repeat
+    return result
+
+if __name__ == '__main__':
+    from . import setupPaths
+    setupPaths(sys.argv[1])
+    print json.dumps(_coldStart())
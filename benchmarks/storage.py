@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+
+from WazappDesktop.helpers import getConfig
+from WazappDesktop.Database import MessageModel, DatabaseWriter, getDatabase
+from WazappDesktop.ContactDB import ContactDB
+from WazappDesktop.Contacts import Contacts
+
+from . import summarize, timeCalls, rate
+
+def _conversationIds(rnd, count):
+    conversationIds = [contact.conversationId for contact in ContactDB.instance().getAll()]
+    return [rnd.choice(conversationIds) for i in range(count)]
+
+def _deleteMessages(messageIdPattern):
+    with getDatabase().transaction():
+        getDatabase().execute_sql('DELETE FROM "%s" WHERE "%s" LIKE ?' % (MessageModel._meta.db_table, MessageModel.messageId.db_column),
+                                  (messageIdPattern,), require_commit=False)
+
+def benchmarkInserts(numMessages=5000, batchSize=500, numSingle=500, seed=0):
+    # batches are what the message ingestor writes, single inserts are the ContactDB.addMessage() path
+    rnd = random.Random(seed)
+    contactDB = ContactDB.instance()
+    ownJid = Contacts.instance().getOwnJid()
+    runId = int(time.time())
+    messages = [(jid, 'insert-%d-%d' % (runId, i), time.time(), jid, ownJid, 'benchmark message %d' % i)
+                for i, jid in enumerate(_conversationIds(rnd, numMessages + numSingle))]
+    batches, singles = messages[:numMessages], messages[numMessages:]
+
+    start = time.time()
+    for chunkStart in range(0, len(batches), batchSize):
+        contactDB.addMessages(batches[chunkStart:chunkStart + batchSize])
+    batchSeconds = time.time() - start
+    singleDurations = timeCalls(contactDB.addMessage, singles)
+
+    # leave the dataset as it was for the next run
+    DatabaseWriter.instance().call(_deleteMessages, 'insert-%d-%%' % runId)
+    single = summarize(singleDurations)
+    single['messagesPerSecond'] = rate(len(singleDurations), sum(singleDurations))
+    return {
+        'batched': {'messages': len(batches), 'batchSize': batchSize, 'seconds': batchSeconds, 'messagesPerSecond': rate(len(batches), batchSeconds)},
+        'single': single,
+    }
+
+def benchmarkPageFetches(numConversations=50, pagesPerConversation=5, seed=0):
+    # the newest page is fetched when a chat is opened, older pages when scrolling up
+    rnd = random.Random(seed)
+    contactDB = ContactDB.instance()
+    pageSize = getConfig('chatViewPageSize', 50)
+    newest = []
+    older = []
+    for conversationId in _conversationIds(rnd, numConversations):
+        start = time.time()
+        messages = contactDB.getMessageList(conversationId, numMessages=pageSize)
+        newest.append(time.time() - start)
+        for i in range(pagesPerConversation):
+            if not messages:
+                break
+            before = (messages[0].timestamp, messages[0].messageId)
+            start = time.time()
+            messages = contactDB.getMessageList(conversationId, numMessages=pageSize, before=before)
+            older.append(time.time() - start)
+    return {'pageSize': pageSize, 'newestPage': summarize(newest), 'olderPage': summarize(older)}
+
+def benchmarkContactLookups(numLookups=100000, seed=0):
+    # names are looked up for every rendered message, the first lookup loads the contact cache
+    rnd = random.Random(seed)
+    contacts = Contacts.instance()
+    ContactDB.instance().invalidate()
+    start = time.time()
+    contacts.getName(contacts.getOwnJid())
+    cacheLoadSeconds = time.time() - start
+
+    conversationIds = _conversationIds(rnd, numLookups)
+    # some lookups are for people that are not in the contacts
+    conversationIds[::10] = ['unknown%d@s.whatsapp.net' % i for i in range(len(conversationIds[::10]))]
+    start = time.time()
+    for conversationId in conversationIds:
+        contacts.getName(conversationId)
+    seconds = time.time() - start
+    return {'cacheLoadSeconds': cacheLoadSeconds, 'lookups': numLookups, 'seconds': seconds, 'lookupsPerSecond': rate(numLookups, seconds)}
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import datetime
+
+from WazappDesktop.helpers import setConfig, flushConfig, getOwnPhone
+from WazappDesktop.Database import initDatabase, getDatabase, ContactModel, messageValues, insertMessages
+
+OWN_COUNTRY_CODE = '49'
+OWN_PHONE_NUMBER = '1000000000'
+WORDS = ['hello', 'where', 'are', 'you', 'see', 'you', 'tomorrow', 'ok', 'lunch', '?', 'www.example.com', 'http://example.com/a?b=c', 'haha', 'yes', 'no']
+
+def contactJid(index, numContacts):
+    # every tenth conversation is a group
+    if index % 10 == 9:
+        return '49%09d-%d@g.us' % (index, 1400000000 + index)
+    return '49%09d@s.whatsapp.net' % index
+
+def generateDatabase(numContacts, numMessages, seed=0, chunkSize=10000):
+    # fill an empty database with contacts and a year of messages, a few conversations get most of them
+    rnd = random.Random(seed)
+    setConfig('countryCode', OWN_COUNTRY_CODE)
+    setConfig('phoneNumber', OWN_PHONE_NUMBER)
+    flushConfig()
+    ownJid = '%s@s.whatsapp.net' % getOwnPhone()
+
+    initDatabase()
+    database = getDatabase()
+    jids = [contactJid(i, numContacts) for i in range(numContacts)]
+    with database.transaction():
+        database.get_cursor().executemany('INSERT INTO "%s" ("%s", "%s") VALUES (?, ?)' % (
+            ContactModel._meta.db_table, ContactModel.conversationId.db_column, ContactModel.name.db_column),
+            [(jid, 'Contact %d' % i) for i, jid in enumerate(jids)])
+    contactIds = dict(database.execute_sql('SELECT "%s", "%s" FROM "%s"' % (
+        ContactModel.conversationId.db_column, ContactModel.id.db_column, ContactModel._meta.db_table)).fetchall())
+    users = [jid for jid in jids if jid.endswith('@s.whatsapp.net')]
+
+    start = time.time() - 365 * 24 * 3600
+    step = 365 * 24 * 3600.0 / max(1, numMessages)
+    for chunkStart in range(0, numMessages, chunkSize):
+        rows = []
+        for i in range(chunkStart, min(numMessages, chunkStart + chunkSize)):
+            jid = jids[int(numContacts * rnd.random() ** 3)]
+            own = rnd.random() < 0.4
+            if own:
+                sender, receiver = ownJid, jid
+            elif jid.endswith('@g.us'):
+                sender, receiver = rnd.choice(users), jid
+            else:
+                sender, receiver = jid, ownJid
+            text = ' '.join(rnd.choice(WORDS) for j in range(rnd.randint(1, 25)))
+            timestamp = datetime.datetime.fromtimestamp(start + i * step)
+            rows.append(messageValues(contactIds[jid], 'bench-%d' % i, sender, receiver, text, timestamp, isRead=True, isSent=own, isDelivered=own))
+        with database.transaction():
+            insertMessages(rows)
+        print 'generateDatabase(): %d of %d messages' % (min(numMessages, chunkStart + chunkSize), numMessages)
@@ -1,10 +1,21 @@
+function findPage(element) {
+    // mouse over images are kept inside their page, so they are removed together with it
+    while (element != null && element != document.body) {
+        if (element.className == 'page') {
+            return element;
+        }
+        element = element.parentNode;
+    }
+    return document.body;
+}
+
 function addMouseOverImage(element, imgSrc) {
     //debugOut('addMouseOverImage(): ' + imgSrc);
     var largeDiv = document.createElement('div');
     largeDiv.style.backgroundColor = '#ffffff';
     largeDiv.setAttribute('class', 'mouseOver');
     largeDiv.innerHTML = '<img width="1px" src="' + imgSrc + '">';
-    document.body.appendChild(largeDiv);
+    findPage(element).appendChild(largeDiv);
 
     element.largeDiv = largeDiv;
 
@@ -74,6 +85,41 @@ function elementAdded(elementId) {
     addForAllImageLinks(links);
 }
 
+var scrollMargin = 200;
+var loadingPage = false;
+function keepPosition(anchor, load) {
+    // keep the anchor element at the same position on screen while pages are added or removed
+    var top = anchor.offsetTop;
+    if (load()) {
+        window.scrollBy(0, anchor.offsetTop - top);
+    }
+}
+
+function onScroll(event) {
+    if (loadingPage || typeof chatBridge == 'undefined') {
+        return;
+    }
+    var pages = document.getElementsByClassName('page');
+    if (pages.length == 0) {
+        return;
+    }
+    loadingPage = true;
+    if (window.pageYOffset < scrollMargin) {
+        keepPosition(pages[0], function() { return chatBridge.loadOlderMessages(); });
+    } else if (window.pageYOffset + window.innerHeight > document.body.scrollHeight - scrollMargin) {
+        keepPosition(pages[pages.length - 1], function() { return chatBridge.loadNewerMessages(); });
+    }
+    loadingPage = false;
+}
+
+function showFoundElement(elementId) {
+    var element = document.getElementById(elementId);
+    if (element != null) {
+        element.className += ' found';
+        element.scrollIntoView();
+    }
+}
+
 function debugOut(text) {
     document.getElementById('debug').innerHTML += text + '\n';
 }
@@ -81,4 +127,5 @@ function debugOut(text) {
 function onLoad() {
     //debugOut('onLoad');
     addForAllImageLinks(document.getElementsByTagName('A'))
+    window.addEventListener('scroll', onScroll, false);
 }
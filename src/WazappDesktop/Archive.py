@@ -0,0 +1,401 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import zlib
+import datetime
+import threading
+
+from .helpers import getConfig, ARCHIVE_FILE
+from .Database import WazappDatabase, MessageModel, OutboxModel, DatabaseWriter, getDatabase, searchMatch, searchText
+from .ContactDB import ContactDB
+from .Instrumentation import timed
+
+ARCHIVE_TABLE = 'archivedmessage'
+ARCHIVE_SEARCH_TABLE = 'archivesearch'
+
+# bits of the flags column
+_READ = 1
+_SENT = 2
+_DELIVERED = 4
+_COMPRESSED = 8
+
+_archiveColumns = 'conversationId, messageId, timestamp, sender, receiver, flags, message'
+
+_expiredSql = '''SELECT "%(id)s", "%(messageId)s", "%(sender)s", "%(receiver)s", "%(message)s", "%(timestamp)s", "%(isRead)s", "%(isSent)s", "%(isDelivered)s"
+    FROM "%(messages)s" WHERE "%(contact)s" = ? AND "%(timestamp)s" < ? AND "%(messageId)s" NOT IN (SELECT "%(outboxMessageId)s" FROM "%(outbox)s")
+    ORDER BY "%(timestamp)s" LIMIT ?''' % {
+    'messages': MessageModel._meta.db_table, 'outbox': OutboxModel._meta.db_table,
+    'id': MessageModel.id.db_column, 'messageId': MessageModel.messageId.db_column, 'sender': MessageModel.sender.db_column,
+    'receiver': MessageModel.receiver.db_column, 'message': MessageModel.message.db_column, 'timestamp': MessageModel.timestamp.db_column,
+    'isRead': MessageModel.isRead.db_column, 'isSent': MessageModel.isSent.db_column, 'isDelivered': MessageModel.isDelivered.db_column,
+    'contact': MessageModel.contact.db_column, 'outboxMessageId': OutboxModel.messageId.db_column,
+}
+
+def _compress(message):
+    # short messages usually get bigger when compressed, those are stored as they are
+    data = message.encode('utf8')
+    compressed = zlib.compress(data, 9)
+    if len(compressed) < len(data):
+        return buffer(compressed), True
+    return buffer(data), False
+
+def _decompress(data, flags):
+    data = str(data)
+    if flags & _COMPRESSED:
+        data = zlib.decompress(data)
+    return data.decode('utf8')
+
+def _snippet(message, text, width=60):
+    # the archive search index has no content of its own, so the snippet is cut from the message here
+    plain = re.sub(r'<[^>]*>?', '', message)
+    words = re.findall(r'\w+', text, re.UNICODE)
+    pattern = re.compile(r'\b(?:%s)\w*' % '|'.join(re.escape(word) for word in words), re.UNICODE | re.IGNORECASE)
+    found = pattern.search(plain)
+    start, end = (found.start(), found.end()) if found is not None else (0, 0)
+    start = max(0, start - width)
+    end = min(len(plain), end + width)
+    # move out to the nearest spaces, so words and html entities are not cut in the middle
+    if start > 0:
+        start = plain.rfind(' ', max(0, start - width), start) + 1 or start
+    if end < len(plain):
+        space = plain.find(' ', end, end + width)
+        end = space if space >= 0 else end
+    snippet = pattern.sub(lambda match: '<b>%s</b>' % match.group(0), plain[start:end])
+    return '%s%s%s' % ('...' if start > 0 else '', snippet, '...' if end < len(plain) else '')
+
+def _formatSize(size):
+    return '%.1f MB' % (size / 1024.0 / 1024.0)
+
+
+class ArchivedMessage(object):
+    # read only stand in for a MessageModel row, with the attributes the chat view uses
+
+    def __init__(self, conversationId, messageId, timestamp, sender, receiver, flags, message):
+        self.conversationId = conversationId
+        self.messageId = messageId
+        self.timestamp = MessageModel.timestamp.python_value(timestamp)
+        self.sender = sender
+        self.receiver = receiver
+        self.isRead = bool(flags & _READ)
+        self.isSent = bool(flags & _SENT)
+        self.isDelivered = bool(flags & _DELIVERED)
+        self.message = _decompress(message, flags)
+
+
+class MessageArchive(object):
+    # messages past their retention time live in a separate database file, compressed and only read on demand.
+    # it offers the read methods of ContactDB, so the chat view can show archived messages like stored ones
+
+    @staticmethod
+    def instance():
+        return _instance
+
+    def __init__(self):
+        super(MessageArchive, self).__init__()
+        self._database = WazappDatabase(ARCHIVE_FILE, threadlocals=True)
+        self._searchModule = None
+        self._ready = False
+
+    def _isReady(self):
+        # as long as there is no archive file nothing was archived, reading must not create it.
+        # the schema is created by the writer thread along with the first archived messages, readers only look at it
+        if not self._ready and os.path.isfile(ARCHIVE_FILE):
+            self._loadSchema()
+        return self._ready
+
+    def _loadSchema(self):
+        schema = dict(self._database.execute_sql('SELECT name, sql FROM sqlite_master WHERE name IN (?, ?)', (ARCHIVE_TABLE, ARCHIVE_SEARCH_TABLE)).fetchall())
+        if ARCHIVE_TABLE not in schema:
+            return False
+        if ARCHIVE_SEARCH_TABLE in schema:
+            self._searchModule = 'fts5' if 'fts5' in schema[ARCHIVE_SEARCH_TABLE].lower() else 'fts4'
+        self._ready = True
+        return True
+
+    def createSchema(self):
+        # must run on the writer thread
+        if self._ready or (os.path.isfile(ARCHIVE_FILE) and self._loadSchema()):
+            return
+        database = self._database
+        database.execute_sql('''CREATE TABLE IF NOT EXISTS "%s" (id INTEGER PRIMARY KEY, conversationId TEXT NOT NULL, messageId TEXT NOT NULL UNIQUE,
+            timestamp TEXT NOT NULL, sender TEXT NOT NULL, receiver TEXT NOT NULL, flags INTEGER NOT NULL, message BLOB NOT NULL)''' % ARCHIVE_TABLE)
+        database.execute_sql('CREATE INDEX IF NOT EXISTS "%s_conversationId_timestamp" ON "%s" (conversationId, timestamp, messageId)' % (ARCHIVE_TABLE, ARCHIVE_TABLE))
+        row = database.execute_sql('SELECT sql FROM sqlite_master WHERE name = ?', (ARCHIVE_SEARCH_TABLE,)).fetchone()
+        if row is not None:
+            self._searchModule = 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+        else:
+            # contentless, the text is only stored compressed in the archive table
+            for module, arguments in (('fts5', "message, content=''"), ('fts4', 'content="", message')):
+                try:
+                    database.execute_sql('CREATE VIRTUAL TABLE "%s" USING %s(%s)' % (ARCHIVE_SEARCH_TABLE, module, arguments))
+                    self._searchModule = module
+                    break
+                except Exception as e:
+                    print 'MessageArchive.createSchema(): %s not available: %s' % (module, e)
+        self._ready = True
+
+    def storeMessages(self, conversationId, rows):
+        # must run on the writer thread, rows are (messageId, sender, receiver, message, timestamp, isRead, isSent, isDelivered)
+        # as stored in MessageModel, returns how many were not archived before
+        self.createSchema()
+        archived = 0
+        with self._database.transaction():
+            cursor = self._database.get_cursor()
+            for messageId, sender, receiver, message, timestamp, isRead, isSent, isDelivered in rows:
+                data, compressed = _compress(message)
+                flags = (_READ if isRead else 0) | (_SENT if isSent else 0) | (_DELIVERED if isDelivered else 0) | (_COMPRESSED if compressed else 0)
+                cursor.execute('INSERT OR IGNORE INTO "%s" (%s) VALUES (?, ?, ?, ?, ?, ?, ?)' % (ARCHIVE_TABLE, _archiveColumns),
+                               (conversationId, messageId, timestamp, sender, receiver, flags, data))
+                if cursor.rowcount != 1:
+                    continue
+                archived += 1
+                if self._searchModule is not None:
+                    cursor.execute('INSERT INTO "%s" (rowid, message) VALUES (?, ?)' % ARCHIVE_SEARCH_TABLE, (cursor.lastrowid, searchText(message)))
+        return archived
+
+    def _select(self, where, parameters, order='', limit=None):
+        sql = 'SELECT %s FROM "%s" WHERE %s %s' % (_archiveColumns, ARCHIVE_TABLE, ' AND '.join(where), order)
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return [ArchivedMessage(*row) for row in self._database.execute_sql(sql, parameters).fetchall()]
+
+    def _conditions(self, conversationId, since=None, before=None, after=None):
+        where = ['conversationId = ?']
+        parameters = [conversationId]
+        if since is not None:
+            where.append('timestamp > ?')
+            parameters.append(MessageModel.timestamp.db_value(since))
+        # keyset pagination on (timestamp, messageId) like ContactDB
+        if before is not None:
+            timestamp, messageId = before
+            timestamp = MessageModel.timestamp.db_value(timestamp)
+            where.append('(timestamp < ? OR (timestamp = ? AND messageId < ?))')
+            parameters.extend((timestamp, timestamp, messageId))
+        if after is not None:
+            timestamp, messageId = after
+            timestamp = MessageModel.timestamp.db_value(timestamp)
+            where.append('(timestamp > ? OR (timestamp = ? AND messageId > ?))')
+            parameters.extend((timestamp, timestamp, messageId))
+        return where, parameters
+
+    @timed('MessageArchive.countMessages')
+    def countMessages(self, conversationId, since=None, before=None):
+        if not self._isReady():
+            return 0
+        where, parameters = self._conditions(conversationId, since=since, before=before)
+        return self._database.execute_sql('SELECT COUNT(*) FROM "%s" WHERE %s' % (ARCHIVE_TABLE, ' AND '.join(where)), parameters).fetchone()[0]
+
+    @timed('MessageArchive.getMessageList')
+    def getMessageList(self, conversationId, numMessages=None, since=None, before=None, after=None):
+        if not self._isReady():
+            return list()
+        where, parameters = self._conditions(conversationId, since=since, before=before, after=after)
+        if numMessages is not None and after is not None:
+            return self._select(where, parameters, 'ORDER BY timestamp, messageId', numMessages)
+        if numMessages is not None:
+            return list(reversed(self._select(where, parameters, 'ORDER BY timestamp DESC, messageId DESC', numMessages)))
+        return self._select(where, parameters, 'ORDER BY timestamp, messageId')
+
+    def getPendingMessageIds(self, conversationId):
+        # only confirmed messages are archived
+        return set()
+
+    @timed('MessageArchive.getMessage')
+    def getMessage(self, messageId):
+        if not self._isReady():
+            return None
+        for message in self._select(['messageId = ?'], [messageId]):
+            return message
+        return None
+
+    @timed('MessageArchive.searchMessages')
+    def searchMessages(self, text, conversationId=None, limit=100):
+        # same results as ContactDB.searchMessages(), marked as archived
+        if not self._isReady() or self._searchModule is None:
+            return list()
+        match = searchMatch(text, self._searchModule)
+        if match is None:
+            return list()
+        # fts4 has no built in ranking, its results are ordered by time
+        order = 'rank' if self._searchModule == 'fts5' else 'a.timestamp DESC'
+        parameters = [match]
+        where = ''
+        if conversationId is not None:
+            where = 'AND a.conversationId = ?'
+            parameters.append(conversationId)
+        parameters.append(limit)
+        sql = 'SELECT %s FROM "%s" JOIN "%s" a ON a.id = "%s".rowid WHERE "%s" MATCH ? %s ORDER BY %s LIMIT ?' % (
+            ', '.join('a.' + column for column in _archiveColumns.split(', ')), ARCHIVE_SEARCH_TABLE, ARCHIVE_TABLE,
+            ARCHIVE_SEARCH_TABLE, ARCHIVE_SEARCH_TABLE, where, order)
+        results = []
+        for row in self._database.execute_sql(sql, parameters).fetchall():
+            message = ArchivedMessage(*row)
+            results.append({
+                'conversationId': message.conversationId,
+                'messageId': message.messageId,
+                'timestamp': message.timestamp,
+                'sender': message.sender,
+                'snippet': _snippet(message.message, text),
+                'archived': True,
+            })
+        return results
+
+_instance = MessageArchive()
+
+
+def incrementalVacuumNeeded():
+    # databases created before retention existed need one full VACUUM before retention can give space back
+    if getConfig('retentionDays', 0) <= 0 and not any(days > 0 for days in getConfig('retentionDaysPerConversation', {}).values()):
+        return False
+    return getDatabase().execute_sql('PRAGMA auto_vacuum').fetchone()[0] != 2
+
+def enableIncrementalVacuum():
+    # rewrites the whole database, so it runs at start up before anything else uses the database
+    database = getDatabase()
+    database.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    database.execute_sql('VACUUM')
+
+
+class Retention(object):
+    # moves messages past their retention time into the archive and gives the freed pages back to the file system.
+    # it runs in a background thread, the writes are queued to the writer thread in small chunks.
+    # retentionDays applies to all conversations, retentionDaysPerConversation overrides it, 0 keeps messages forever
+
+    def __init__(self, isIdle, chunkSize=500, vacuumPages=256):
+        super(Retention, self).__init__()
+        self._isIdle = isIdle
+        self._chunkSize = chunkSize
+        self._vacuumPages = vacuumPages
+        self._days = getConfig('retentionDays', 0)
+        self._daysPerConversation = getConfig('retentionDaysPerConversation', {})
+        self._interval = getConfig('retentionCheckInterval', 6 * 3600)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._archived = 0
+        self._reclaimed = 0
+        self._lastRun = None
+
+    def isEnabled(self):
+        return self._days > 0 or any(days > 0 for days in self._daysPerConversation.values())
+
+    def start(self, delay=60):
+        # the first run waits until the start up is over
+        self._thread = threading.Thread(target=self._run, args=(delay,), name='Retention')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def getStats(self):
+        space = self._getSpace()
+        return {
+            'enabled': self.isEnabled(),
+            'archived': self._archived,
+            'reclaimed': _formatSize(self._reclaimed),
+            'lastRun': self._lastRun.strftime('%Y-%m-%d %H:%M:%S') if self._lastRun is not None else None,
+            'databaseSize': _formatSize(space['size']),
+            'freeSpace': _formatSize(space['free']),
+            'archiveSize': _formatSize(sum(os.path.getsize(filename) for filename in (ARCHIVE_FILE, ARCHIVE_FILE + '-wal') if os.path.isfile(filename))),
+        }
+
+    def _run(self, delay):
+        if self._stop.wait(delay):
+            return
+        while True:
+            try:
+                self.runNow()
+            except Exception as e:
+                print 'Retention._run(): failed: %s %s' % (type(e), e)
+            if self._stop.wait(self._interval):
+                return
+
+    def runNow(self):
+        before = self._getSpace()
+        archived = 0
+        if self.isEnabled():
+            archived = self._archiveExpired()
+        self._vacuum()
+        after = self._getSpace()
+        reclaimed = max(0, before['size'] - after['size'])
+        self._archived += archived
+        self._reclaimed += reclaimed
+        self._lastRun = datetime.datetime.now()
+        if archived or reclaimed:
+            print 'Retention.runNow(): archived %d messages, reclaimed %s, the database now has %s with %s free' % (
+                archived, _formatSize(reclaimed), _formatSize(after['size']), _formatSize(after['free']))
+
+    def _pragma(self, name):
+        return getDatabase().execute_sql('PRAGMA %s' % name).fetchone()[0]
+
+    def _getSpace(self):
+        # counted in pages, the file size also depends on when the write ahead log was last written back
+        pageSize = self._pragma('page_size')
+        return {'size': self._pragma('page_count') * pageSize, 'free': self._pragma('freelist_count') * pageSize}
+
+    def _waitForIdle(self, timeout=60):
+        for i in range(timeout):
+            if self._stop.is_set():
+                return False
+            if self._isIdle():
+                return True
+            time.sleep(1)
+        return False
+
+    def _archiveExpired(self):
+        now = datetime.datetime.now()
+        archived = 0
+        for contact in ContactDB.instance().getAll():
+            days = self._daysPerConversation.get(contact.conversationId, self._days)
+            if days <= 0 or contact.id is None:
+                continue
+            archived += self._archiveConversation(contact, now - datetime.timedelta(days))
+            if self._stop.is_set():
+                break
+        return archived
+
+    def _archiveConversation(self, contact, cutoff):
+        # unsent messages stay, the outbox still needs them
+        archived = 0
+        while not self._stop.is_set():
+            rows = getDatabase().execute_sql(_expiredSql, (contact.id, MessageModel.timestamp.db_value(cutoff), self._chunkSize)).fetchall()
+            if not rows:
+                break
+            archived += DatabaseWriter.instance().call(self._archiveChunk, contact.conversationId, rows)
+            if len(rows) < self._chunkSize:
+                break
+            # give other writes a chance in between
+            time.sleep(0.05)
+        return archived
+
+    def _archiveChunk(self, conversationId, rows):
+        # the archive is committed first, if the delete does not happen the chunk is just archived again next time
+        MessageArchive.instance().storeMessages(conversationId, [row[1:] for row in rows])
+        database = getDatabase()
+        with database.transaction():
+            database.get_cursor().executemany('DELETE FROM "%s" WHERE "%s" = ?' % (MessageModel._meta.db_table, MessageModel.id.db_column), [(row[0],) for row in rows])
+        return len(rows)
+
+    def _vacuum(self):
+        # free pages are given back in small steps, and only while nothing else is going on.
+        # databases that were not converted at start up keep their free pages for new messages
+        if self._pragma('auto_vacuum') != 2:
+            return
+        while not self._stop.is_set() and self._pragma('freelist_count') > 0:
+            if not self._waitForIdle():
+                break
+            DatabaseWriter.instance().call(self._incrementalVacuum)
+            time.sleep(0.05)
+        # the file only shrinks once the log is written back
+        DatabaseWriter.instance().call(self._checkpoint)
+
+    def _incrementalVacuum(self):
+        # the pragma frees one page per step, so all rows have to be fetched
+        getDatabase().execute_sql('PRAGMA incremental_vacuum(%d)' % self._vacuumPages).fetchall()
+
+    def _checkpoint(self):
+        getDatabase().execute_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
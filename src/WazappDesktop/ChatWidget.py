@@ -2,53 +2,66 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
+import time
 import datetime
 import webbrowser
 
-from PyQt4.QtCore import Qt, pyqtSlot as Slot, pyqtSignal as Signal, QPoint, QDir, QUrl, QTimer
-from PyQt4.QtGui import QDockWidget, QMenu, QIcon, QCursor
-from PyQt4.QtWebKit import QWebPage, QWebElement
+from PyQt4.QtCore import Qt, pyqtSlot as Slot, pyqtSignal as Signal, QObject, QPoint, QDir, QUrl, QTimer
+from PyQt4.QtGui import QApplication, QDockWidget, QMenu, QIcon, QCursor
+from PyQt4.QtWebKit import QWebView, QWebPage, QWebElement
 from PyQt4.uic import loadUi
 
 from .helpers import getConfig
 from .Contacts import Contacts
 from .ContactDB import ContactDB
+from .Archive import MessageArchive
+from .MessageRenderer import MessageRenderer
+from .Instrumentation import timed
 
-url_pattern1 = re.compile(r"(^|[\n ])(([\w]+?://[\w\#$%&~.\-;:=,?@\[\]+]*)(/[\w\#$%&~/.\-;:=,?@\[\]+]*)?)", re.IGNORECASE | re.DOTALL)
-url_pattern2 = re.compile(r"(^|[\n ])(((www|ftp)\.[\w\#$%&~.\-;:=,?@\[\]+]*)(/[\w\#$%&~/.\-;:=,?@\[\]+]*)?)", re.IGNORECASE | re.DOTALL)
-def url2link(text):
-    text = url_pattern1.sub(r'\1<a href="\2" target="_blank">\2</a>', text)
-    text = url_pattern2.sub(r'\1<a href="http:/\2" target="_blank">\2</a>', text)
-    return text
+class ChatViewBridge(QObject):
+    # the only object exposed to the java script of the chat view
+
+    def __init__(self, chatWidget):
+        super(ChatViewBridge, self).__init__(chatWidget)
+        self._chatWidget = chatWidget
+
+    @Slot(result=bool)
+    def loadOlderMessages(self):
+        return self._chatWidget.loadOlderPage()
+
+    @Slot(result=bool)
+    def loadNewerMessages(self):
+        return self._chatWidget.loadNewerPage()
 
 
 class ChatWidget(QDockWidget):
     send_message_signal = Signal(str, unicode)
     scroll_to_bottom_signal = Signal()
     show_message_signal = Signal(str, str, float, str, str, str)
-    show_history_message_signal = Signal(str, str, datetime.datetime, str, str, str, bool)
     show_history_since_signal = Signal(float)
     show_history_num_messages_signal = Signal(int)
     has_unread_message_signal = Signal(str, bool)
-    paragraphIdFormat = 'p%s'
-    paragraphFormat = '''
-        <p id=%(paragraphId)s>
-            <span class="time">[%(formattedTime)s] </span>
-            <a href="%(senderPic)s"><img height="20px" src="%(senderPic)s"></a>
-            <a href="wa:contactMenu?jid=%(senderJid)s&name=%(senderName)s" class="%(nameClass)s">%(senderDisplayName)s: </a>
-            <span class="message">%(message)s</span>
-        </p>
-    '''
+    show_search_result_signal = Signal(str, str)
+    visibility_changed_signal = Signal(str, bool)
+    paragraphIdFormat = MessageRenderer.paragraphIdFormat
+    chunkIdFormat = 'chunk%d'
 
     def __init__(self, conversationId):
         super(ChatWidget, self).__init__()
         self._conversationId = conversationId
         self._windowTitle = Contacts.instance().getName(self._conversationId)
-        self._ownJid = Contacts.instance().phoneToConversationId(getConfig('countryCode') + getConfig('phoneNumber'))
-        self._defaultContactPicture = '/%s/im-user.png' % QDir.searchPaths('icons')[0]
+        self._renderer = MessageRenderer(Contacts.instance(), '/%s/im-user.png' % QDir.searchPaths('icons')[0])
         self._chatViewUrl = QUrl('file://%s/ChatView.html' % QDir.searchPaths('html')[0])
         self._historyTimestamp = datetime.date.today()
+        # stored messages are read from the database, or from the archive while archived messages are shown
+        self._messageSource = ContactDB.instance()
+        # only a window of pages is kept in the DOM, older and newer pages are loaded while scrolling
+        self._pageSize = getConfig('chatViewPageSize', 50)
+        self._maxMessages = getConfig('chatViewMaxMessages', 500)
+        self._pages = []
+        self._olderRemaining = 0
+        self._newerUnloaded = False
+        self._bridge = ChatViewBridge(self)
 
         self._scrollTimer = QTimer()
         self._scrollTimer.setSingleShot(True)
@@ -60,37 +73,134 @@ class ChatWidget(QDockWidget):
         self.historyButton.setIcon(QIcon.fromTheme('clock'))
 
         self.visibilityChanged.connect(self.on_visibilityChanged)
-        self.chatView.page().setLinkDelegationPolicy(QWebPage.DelegateAllLinks)
         self.__on_messageText_keyPressEvent = self.messageText.keyPressEvent
         self.messageText.keyPressEvent = self.on_messageText_keyPressEvent
         self.show_message_signal.connect(self.showMessage)
-        self.show_history_message_signal.connect(self.showMessage)
         self.show_history_since_signal.connect(self.showHistorySince)
         self.show_history_num_messages_signal.connect(self.showHistoryNumMessages)
         self.has_unread_message_signal.connect(self.unreadMessage)
 
-        self.reloadChatView()
+        # the web view is only created once the chat is shown or gets a message, and dropped again when unused
+        self.chatView = None
+        self._isShown = False
+        self._lastShown = time.time()
+        # messages arriving before the history is loaded are queued
+        self._bodyElement = QWebElement()
+        self.clearChatView()
+
+    def isLoaded(self):
+        return self.chatView is not None
+
+    def idleTime(self):
+        # seconds since the chat was last shown, 0 while it is shown
+        if self._isShown:
+            return 0.0
+        return time.time() - self._lastShown
+
+    def ensureLoaded(self):
+        if self.chatView is not None:
+            return
+        self.chatView = QWebView(self.chatViewContainer)
+        self.chatView.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.chatViewContainer.layout().addWidget(self.chatView)
+        self.chatView.page().setLinkDelegationPolicy(QWebPage.DelegateAllLinks)
+        self.chatView.page().mainFrame().javaScriptWindowObjectCleared.connect(self.on_chatView_javaScriptWindowObjectCleared)
+        self.chatView.loadFinished.connect(self.on_chatView_loadFinished)
+        self.chatView.linkClicked.connect(self.on_chatView_linkClicked)
+        self.chatView.customContextMenuRequested.connect(self.on_chatView_customContextMenuRequested)
+        self._loadChatView()
+
+    def unload(self):
+        # release the web view and its memory, the history is loaded again when the chat is shown
+        if self.chatView is None or self._isShown:
+            return
+        self._scrollTimer.stop()
+        self.clearChatView()
+        self._bodyElement = QWebElement()
+        self.chatView.setParent(None)
+        self.chatView.deleteLater()
+        self.chatView = None
+
+    def _loadChatView(self):
+        self._bodyElement = QWebElement()
+        self.chatView.load(self._chatViewUrl)
         self.showHistorySince(datetime.date.today(), minMessage=3, maxMessages=10)
 
     def reloadChatView(self):
         self._bodyElement = QWebElement()
         self.chatView.load(self._chatViewUrl)
-        self.showHistorySince(self._historyTimestamp)
+        if self.isShowingArchive():
+            self.showArchivedMessages()
+        else:
+            self.showHistorySince(self._historyTimestamp)
+
+    @Slot()
+    def on_chatView_javaScriptWindowObjectCleared(self):
+        self.chatView.page().mainFrame().addToJavaScriptWindowObject('chatBridge', self._bridge)
 
     def on_chatView_customContextMenuRequested(self, pos):
         menu = QMenu()
         results = {}
+        results[menu.addAction('Search...')] = self.showSearchDialog
         results[menu.addAction('Dump HTML')] = self.dumpHtml
+        # hidden unless shift is held or it is enabled in the config
+        if QApplication.keyboardModifiers() & Qt.ShiftModifier or getConfig('showPerformanceMenu', False):
+            results[menu.addAction('Performance')] = self.showPerformanceDialog
         results[menu.addAction('Refresh')] = self.reloadChatView
         result = menu.exec_(self.chatView.mapToGlobal(pos))
         if result in results:
             results[result]()
 
+    def showSearchDialog(self):
+        from .SearchDialog import SearchDialog
+        dialog = SearchDialog(self._conversationId, self)
+        dialog.show_search_result_signal.connect(self.show_search_result_signal)
+        dialog.show()
+
+    def showPerformanceDialog(self):
+        from .PerformanceDialog import PerformanceDialog
+        dialog = PerformanceDialog(self)
+        dialog.show()
+
+    def jumpToMessage(self, messageId):
+        # search results may be archived messages
+        for source in (ContactDB.instance(), MessageArchive.instance()):
+            message = source.getMessage(messageId)
+            if message is not None:
+                break
+        else:
+            print 'jumpToMessage(): unknown message: %s' % messageId
+            return
+        self.ensureLoaded()
+        self.clearChatView()
+        self._messageSource = source
+        self._jumpToMessage = message
+        if self._bodyElement.isNull():
+            return
+        self._showHistoryMessages()
+
+    def _showMessageSurrounding(self, message):
+        # show one page around the message and make it visible, older and newer pages are loaded by scrolling
+        key = self._messageKey(message.timestamp, message.messageId)
+        half = max(1, self._pageSize / 2)
+        older = self._messageSource.getMessageList(self._conversationId, numMessages=half, before=key)
+        newer = self._messageSource.getMessageList(self._conversationId, numMessages=half, after=key)
+        messages = older + [message] + newer
+        self._olderRemaining = self._messageSource.countMessages(self._conversationId, before=self._messageKey(messages[0].timestamp, messages[0].messageId))
+        self._newerUnloaded = len(newer) == half
+        self._insertPage(messages)
+        paragraphId = self.paragraphIdFormat % message.messageId
+        self.chatView.page().mainFrame().evaluateJavaScript('showFoundElement("%s"); null' % paragraphId)
+
     def dumpHtml(self):
         print self.chatView.page().mainFrame().toHtml()
 
     def on_visibilityChanged(self, visible):
+        self._isShown = visible
+        self._lastShown = time.time()
+        self.visibility_changed_signal.emit(self._conversationId, visible)
         if visible:
+            self.ensureLoaded()
             self.has_unread_message_signal.emit(self._conversationId, False)
             self.messageText.setFocus(Qt.OtherFocusReason)
 
@@ -107,30 +217,45 @@ class ChatWidget(QDockWidget):
             menu.addAction('All Time'): 0,
             menu.addAction('None'): datetime.datetime.now(),
         }
+        menu.addSeparator()
+        numArchived = MessageArchive.instance().countMessages(self._conversationId)
+        archiveAction = menu.addAction('Archived Messages (%d)' % numArchived)
+        archiveAction.setEnabled(numArchived > 0)
         result = menu.exec_(self.historyButton.mapToGlobal(QPoint(0, self.historyButton.height())))
         if result in results:
             self.showHistorySince(results[result])
+        elif result is archiveAction:
+            self.showArchivedMessages()
+
+    def isShowingArchive(self):
+        return self._messageSource is not ContactDB.instance()
+
+    def showArchivedMessages(self):
+        # archived messages are shown on their own, the history menu switches back to the stored ones
+        self._messageSource = MessageArchive.instance()
+        self.showHistoryNumMessages(self._messageSource.countMessages(self._conversationId))
 
     @Slot(float)
     @Slot(datetime.date)
     @Slot(datetime.datetime)
-    def showHistorySince(self, timestamp, minMessage=0, maxMessages=10000):
+    def showHistorySince(self, timestamp, minMessage=0, maxMessages=None):
         self._historyTimestamp = timestamp
+        self._messageSource = ContactDB.instance()
         if type(timestamp) is float:
             timestamp = datetime.datetime.fromtimestamp(timestamp)
-        messages = ContactDB.instance().getMessageList(self._conversationId, since=timestamp)
-        if messages is None:
-            numMessages = 0
-        else:
-            numMessages = len(messages)#.count()
-        self.showHistoryNumMessages(min(max(minMessage, numMessages), maxMessages))
+        numMessages = max(minMessage, self._messageSource.countMessages(self._conversationId, since=timestamp))
+        if maxMessages is not None:
+            numMessages = min(numMessages, maxMessages)
+        self.showHistoryNumMessages(numMessages)
 
     @Slot(int)
     def showHistoryNumMessages(self, numMessages):
         #print numMessages, self._conversationId
         self.clearChatView()
+        # only the last page is shown right away, the rest is loaded when scrolling up
+        self._olderRemaining = numMessages
         # queue showing of messages until page is loaded
-        self._showNumMessages = numMessages
+        self._showNumMessages = min(numMessages, self._pageSize)
         if self._bodyElement.isNull():
             return
         self._showHistoryMessages()
@@ -139,21 +264,122 @@ class ChatWidget(QDockWidget):
         if self._bodyElement.isNull():
             print '_showHistoryMessages(): bodyElement is Null!'
             return
+        if self._jumpToMessage is not None:
+            self._showMessageSurrounding(self._jumpToMessage)
+            self._jumpToMessage = None
+            return
         # show last messages
         if self._showNumMessages > 0:
-            for message in ContactDB.instance().getMessageList(self._conversationId, numMessages=self._showNumMessages):
-                self.show_history_message_signal.emit(self._conversationId, message.messageId, message.timestamp, message.sender, message.receiver, message.message, message.isRead)
+            messages = self._messageSource.getMessageList(self._conversationId, numMessages=self._showNumMessages)
+            self._olderRemaining = max(0, self._olderRemaining - len(messages))
+            self._insertPage(messages)
+            self._scrollTimer.start(100)
             self._showNumMessages = 0
 
     def clearChatView(self):
-        self._lastSender = ''
-        self._lastDate = ''
+        self._renderState = self._renderer.newState()
         self._showNumMessages = 0
+        self._numChunks = 0
+        self._pages = []
+        self._olderRemaining = 0
+        self._newerUnloaded = False
+        self._jumpToMessage = None
         self._bodyElement.setInnerXml('')
 
+    def _messageKey(self, timestamp, messageId):
+        if type(timestamp) is float:
+            timestamp = datetime.datetime.fromtimestamp(timestamp)
+        return (timestamp, messageId)
+
+    @timed('ChatWidget.insertPage')
+    def _insertPage(self, messages, prepend=False):
+        # render stored messages as one page element with a single DOM insertion
+        self._numChunks += 1
+        page = {'id': self.chunkIdFormat % self._numChunks, 'first': None, 'last': None, 'count': len(messages)}
+        if messages:
+            page['first'] = self._messageKey(messages[0].timestamp, messages[0].messageId)
+            page['last'] = self._messageKey(messages[-1].timestamp, messages[-1].messageId)
+
+        # pages inserted at the top start with their own state, the bottom page continues the current one
+        state = self._renderer.newState() if prepend else self._renderState
+        html = []
+        unread = False
+        pending = self._messageSource.getPendingMessageIds(self._conversationId) if messages else set()
+        for message in messages:
+            if len(message.message) == 0:
+                continue
+            html.append(self._renderer.render(message.messageId, message.timestamp, message.sender, message.message, state, self._messageStatus(message, pending)))
+            unread = unread or not message.isRead
+        pageHtml = '<div class="page" id="%s">%s</div>' % (page['id'], ''.join(html))
+
+        if prepend:
+            nextPage = self._pages[0] if self._pages else None
+            self._bodyElement.prependInside(pageHtml)
+            self._pages.insert(0, page)
+            if nextPage is not None:
+                # the next page does not need to repeat the date header if the date did not change
+                dateElement = self._bodyElement.findFirst('div#%s > p.date' % nextPage['id'])
+                if not dateElement.isNull() and dateElement.toPlainText() == state['lastDate']:
+                    dateElement.removeFromDocument()
+        else:
+            self._bodyElement.appendInside(pageHtml)
+            self._pages.append(page)
+        self.chatView.page().mainFrame().evaluateJavaScript('elementAdded("%s"); null' % page['id'])
+
+        if unread and not (self.isVisible() and self.isActiveWindow()):
+            self.has_unread_message_signal.emit(self._conversationId, True)
+        return page
+
+    def _messageStatus(self, message, pending):
+        if message.isDelivered:
+            return 'delivered'
+        if message.isSent:
+            return 'sent'
+        if message.messageId in pending:
+            return 'pending'
+        return ''
+
+    def _trimPages(self, fromTop):
+        # drop pages until the DOM is within its budget, but always keep at least one page
+        while len(self._pages) > 1 and sum(page['count'] for page in self._pages) > self._maxMessages:
+            if fromTop:
+                page = self._pages.pop(0)
+                self._olderRemaining += page['count']
+            else:
+                page = self._pages.pop()
+                self._newerUnloaded = True
+                self._renderState = self._renderer.newState()
+            self._bodyElement.findFirst('div#%s' % page['id']).removeFromDocument()
+
+    def loadOlderPage(self):
+        if self._bodyElement.isNull() or not self._pages or self._pages[0]['first'] is None or self._olderRemaining <= 0:
+            return False
+        messages = self._messageSource.getMessageList(self._conversationId, numMessages=min(self._pageSize, self._olderRemaining), before=self._pages[0]['first'])
+        if not messages:
+            self._olderRemaining = 0
+            return False
+        self._olderRemaining -= len(messages)
+        self._insertPage(messages, prepend=True)
+        self._trimPages(fromTop=False)
+        return True
+
+    def loadNewerPage(self):
+        if self._bodyElement.isNull() or not self._pages or not self._newerUnloaded:
+            return False
+        messages = self._messageSource.getMessageList(self._conversationId, numMessages=self._pageSize, after=self._pages[-1]['last'])
+        if len(messages) < self._pageSize:
+            self._newerUnloaded = False
+        if not messages:
+            return False
+        self._insertPage(messages)
+        self._trimPages(fromTop=True)
+        return True
+
     @Slot()
     @Slot(bool)
     def on_chatView_loadFinished(self, ok=True):
+        if self.chatView is None:
+            return
         self._bodyElement = self.chatView.page().mainFrame().documentElement().findFirst('body')
         # check that the body element is really loaded, otherwise try again later
         if self._bodyElement.isNull():
@@ -204,6 +430,8 @@ class ChatWidget(QDockWidget):
 
     @Slot()
     def on_scrollToBottom(self):
+        if self.chatView is None:
+            return
         bottom = self.chatView.page().mainFrame().scrollBarMaximum(Qt.Vertical)
         self.chatView.page().mainFrame().setScrollBarValue(Qt.Vertical, bottom)
 
@@ -213,6 +441,7 @@ class ChatWidget(QDockWidget):
         self.messageText.clear()
         self.send_message_signal.emit(self._conversationId, message)
 
+    @timed('ChatWidget.showMessage')
     def showMessage(self, conversationId, messageId, timestamp, senderJid, receiver, message, isRead=False):
         if len(message) == 0:
             return
@@ -220,61 +449,35 @@ class ChatWidget(QDockWidget):
         if conversationId != self._conversationId:
             print 'showMessage(): message to "%s" not for me "%s"' % (conversationId, self._conversationId)
             return
+        # the history loaded along with the chat view already contains this message
+        if self.chatView is None:
+            self.ensureLoaded()
+            return
         # if html page is not loaded yet, queue this message
         if self._bodyElement.isNull():
             self._showNumMessages += 1
+            self._olderRemaining += 1
             return
 
-        parameters = {}
-        parameters['message'] = message
-        if type(timestamp) is float:
-            timestamp = datetime.datetime.fromtimestamp(timestamp)
-        parameters['formattedDate'] = timestamp.strftime('%A, %d %B %Y')
-        parameters['formattedTime'] = timestamp.strftime('%H:%M:%S')
-        if self._lastDate != parameters['formattedDate']:
-            self._lastDate = parameters['formattedDate']
-            self._bodyElement.appendInside('<p class="date">%s</p>' % parameters['formattedDate'])
-
-        parameters['senderJid'] = senderJid
-        parameters['senderName'] = Contacts.instance().getName(senderJid)
-        parameters['senderDisplayName'] = parameters['senderName']
-
-        parameters['senderPic'] = Contacts.instance().getContactPicture(senderJid)
-        if parameters['senderPic'] is None:
-            parameters['senderPic'] = self._defaultContactPicture
-        parameters['senderPic'] = 'file://' + parameters['senderPic']
-
-        # set class for name element, depending if senderJid is in contacts and if its or own jid
-        if parameters['senderJid'] == parameters['senderName']:
-            parameters['senderDisplayName'] = parameters['senderName'].split('@')[0]
-            parameters['senderName'] = ''
-            parameters['nameClass'] = 'unknown'
-        elif parameters['senderJid'] == self._ownJid:
-            parameters['nameClass'] = 'myname'
-        else:
-            parameters['nameClass'] = 'name'
-
-        # don't show sender name again, if multiple consecutive messages from one sender
-        if parameters['senderDisplayName'] == self._lastSender:
-            parameters['senderDisplayName'] = '...'
-        else:
-            self._lastSender = parameters['senderDisplayName']
-
-        # parse plain text messages for links
-        if '</a>' not in parameters['message']:
-            parameters['message'] = url2link(parameters['message'])
-
-        # parse plain text messages for new lines
-        if '<br>' not in parameters['message']:
-            parameters['message'] = '<br>'.join(parameters['message'].split('\n'))
-
-        parameters['paragraphId'] = self.paragraphIdFormat % messageId
-        self._bodyElement.appendInside(self.paragraphFormat % parameters)
-
-        self.chatView.page().mainFrame().evaluateJavaScript('elementAdded("%s"); null' % parameters['paragraphId'])
-
-        # set scroll timer to scroll down in 100ms, after the new text is hopefully rendered (any better solutions?)
-        self._scrollTimer.start(100)
+        # if the newest pages are not loaded, the message is shown once the user scrolls down,
+        # while the archive is shown it appears when switching back to the stored messages
+        if not self._newerUnloaded and not self.isShowingArchive():
+            if not self._pages:
+                self._insertPage([])
+            page = self._pages[-1]
+            pageElement = self._bodyElement.findFirst('div#%s' % page['id'])
+            # messages from the outbox keep their local id until they are sent
+            status = 'pending' if messageId.startswith('out-') else ''
+            pageElement.appendInside(self._renderer.render(messageId, timestamp, senderJid, message, self._renderState, status))
+            page['last'] = self._messageKey(timestamp, messageId)
+            if page['first'] is None:
+                page['first'] = page['last']
+            page['count'] += 1
+            self.chatView.page().mainFrame().evaluateJavaScript('elementAdded("%s"); null' % (self.paragraphIdFormat % messageId))
+            self._trimPages(fromTop=True)
+
+            # set scroll timer to scroll down in 100ms, after the new text is hopefully rendered (any better solutions?)
+            self._scrollTimer.start(100)
 
         if not isRead and not (self.isVisible() and self.isActiveWindow()):
             self.has_unread_message_signal.emit(self._conversationId, True)
@@ -285,3 +488,14 @@ class ChatWidget(QDockWidget):
         messageElement = self._bodyElement.findFirst('p#%s' % paragraphId)
         if not messageElement.isNull():
             messageElement.setAttribute('class', status)
+
+    @Slot(str, str, str)
+    def messageIdChanged(self, conversationId, oldId, newId):
+        # an outbox message got its id from the server
+        messageElement = self._bodyElement.findFirst('p#%s' % (self.paragraphIdFormat % oldId))
+        if not messageElement.isNull():
+            messageElement.setAttribute('id', self.paragraphIdFormat % newId)
+        for page in self._pages:
+            for key in ('first', 'last'):
+                if page[key] is not None and page[key][1] == oldId:
+                    page[key] = (page[key][0], newId)
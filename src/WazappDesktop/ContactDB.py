@@ -1,65 +1,328 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import re
+import time
 import datetime
+import threading
 
-from .Database import ContactModel, MessageModel
+from .Database import ContactModel, MessageModel, OutboxModel, DatabaseWriter, getDatabase, getSearchModule, searchMatch, backfillSearchIndex, messageValues, insertMessages, SEARCH_TABLE
+
+from .Instrumentation import timed
 
 from PyQt4.QtCore import QObject
 
+_searchSql = '''SELECT m."%(messageId)s", m."%(timestamp)s", m."%(sender)s", c."%(conversationId)s", %%(snippet)s
+    FROM "%(search)s" JOIN "%(messages)s" m ON m."%(id)s" = "%(search)s".rowid JOIN "%(contacts)s" c ON c."%(contactId)s" = m."%(contact)s"
+    WHERE "%(search)s" MATCH ? %%(where)s ORDER BY %%(order)s LIMIT ?''' % {
+    'search': SEARCH_TABLE, 'messages': MessageModel._meta.db_table, 'contacts': ContactModel._meta.db_table,
+    'id': MessageModel.id.db_column, 'messageId': MessageModel.messageId.db_column, 'timestamp': MessageModel.timestamp.db_column,
+    'sender': MessageModel.sender.db_column, 'contact': MessageModel.contact.db_column,
+    'contactId': ContactModel.id.db_column, 'conversationId': ContactModel.conversationId.db_column,
+}
+# fts4 has no built in ranking, its results are ordered by time
+_searchSnippet = {
+    'fts5': ('snippet("%s", 0, ?, ?, \'...\', 12)' % SEARCH_TABLE, 'rank'),
+    'fts4': ('snippet("%s", ?, ?, \'...\', -1, 12)' % SEARCH_TABLE, 'm."%s" DESC' % MessageModel.timestamp.db_column),
+}
+
 class ContactDB(QObject):
 
     @staticmethod
     def instance():
         return _instance
 
+    def __init__(self):
+        super(ContactDB, self).__init__()
+        # write-through cache of all contact rows, keyed by conversationId
+        self._cacheLock = threading.RLock()
+        self._contacts = None
+        self._cacheHits = 0
+        self._cacheMisses = 0
+        self._cacheLoads = 0
+        # bumped whenever a name or picture changes, so rendered messages know when they are stale
+        self._version = 0
+
+    def _getCache(self):
+        with self._cacheLock:
+            if self._contacts is None:
+                # load all contacts with a single query, afterwards lookups never touch the database
+                self._cacheLoads += 1
+                self._contacts = dict((contact.conversationId, contact) for contact in ContactModel.select())
+            return self._contacts
+
+    def _lookup(self, conversationId):
+        with self._cacheLock:
+            contact = self._getCache().get(conversationId)
+            if contact is None:
+                self._cacheMisses += 1
+            else:
+                self._cacheHits += 1
+            return contact
+
+    def invalidate(self, conversationId=None):
+        with self._cacheLock:
+            self._version += 1
+            if conversationId is None or self._contacts is None:
+                self._contacts = None
+                return
+            # reload a single contact from the database
+            self._cacheLoads += 1
+            self._contacts.pop(conversationId, None)
+            for contact in ContactModel.select().where(ContactModel.conversationId == conversationId):
+                self._contacts[conversationId] = contact
+
+    def getVersion(self):
+        return self._version
+
+    def bumpVersion(self):
+        # something shown along with contacts changed outside of the cache, e.g. a picture file arrived
+        with self._cacheLock:
+            self._version += 1
+
+    def getCacheStats(self):
+        with self._cacheLock:
+            return {
+                'hits': self._cacheHits,
+                'misses': self._cacheMisses,
+                'loads': self._cacheLoads,
+                'size': len(self._contacts) if self._contacts is not None else 0,
+            }
+
     def getAll(self):
-        return list(ContactModel.select())
+        with self._cacheLock:
+            return self._getCache().values()
 
     def get(self, conversationId):
-        if ContactModel.select().where(ContactModel.conversationId == conversationId).exists():
-            return ContactModel.get(conversationId=conversationId)
-        return None
+        return self._lookup(conversationId)
 
     def delete(self, conversationId):
-        ContactModel.delete().where(ContactModel.conversationId == conversationId).execute()
+        with self._cacheLock:
+            self._getCache().pop(conversationId, None)
+            self._version += 1
+            DatabaseWriter.instance().submit(ContactModel.delete().where(ContactModel.conversationId == conversationId).execute)
+
+    def _updateCached(self, conversationId, kwargs):
+        # returns the cached contact and whether it has to be written to the database
+        with self._cacheLock:
+            contact = self._lookup(conversationId)
+            if contact is not None:
+                # only write to the database if something actually changed
+                changed = [key for key, value in kwargs.items() if getattr(contact, key) != value]
+                for key in changed:
+                    setattr(contact, key, kwargs[key])
+                if 'name' in changed or 'pictureId' in changed:
+                    self._version += 1
+                return contact, bool(changed)
+            else:
+                if 'name' not in kwargs:
+                    kwargs['name'] = conversationId
+                contact = ContactModel(conversationId=conversationId, **kwargs)
+                self._getCache()[conversationId] = contact
+                # unknown contacts are rendered with their conversationId and without picture
+                if contact.name != conversationId or contact.pictureId is not None:
+                    self._version += 1
+                return contact, True
 
     def updateOrCreate(self, conversationId, **kwargs):
-        if ContactModel.select().where(ContactModel.conversationId == conversationId).exists():
-            contact = ContactModel.get(conversationId=conversationId)
-            if kwargs:
-                for key, value in kwargs.items():
-                    setattr(contact, key, value)
-                contact.save()
+        # the cache is updated right away, the database write is queued for the writer thread
+        with self._cacheLock:
+            contact, changed = self._updateCached(conversationId, kwargs)
+            if changed:
+                DatabaseWriter.instance().submit(self._writeContact, self._contactValues(contact))
             return contact
+
+    def updateOrCreateMany(self, updates):
+        # updates maps conversationId to a dict of fields, all changes are written in one transaction
+        with self._cacheLock:
+            changedContacts = []
+            for conversationId, kwargs in updates.items():
+                contact, changed = self._updateCached(conversationId, dict(kwargs))
+                if changed:
+                    changedContacts.append(self._contactValues(contact))
+            if changedContacts:
+                DatabaseWriter.instance().submit(self._saveContacts, changedContacts)
+
+    def createMissing(self, contacts):
+        # contacts is a list of (conversationId, name, pictureId), contacts that exist already are left alone,
+        # returns how many were created
+        with self._cacheLock:
+            cache = self._getCache()
+            updates = dict((conversationId, {'name': name, 'pictureId': pictureId}) for conversationId, name, pictureId in contacts if conversationId not in cache)
+            self.updateOrCreateMany(updates)
+            return len(updates)
+
+    def getContactId(self, conversationId):
+        # the database id of a contact, waits for a queued write of a new contact
+        contact = self.get(conversationId)
+        if contact is None:
+            return None
+        if contact.id is None:
+            DatabaseWriter.instance().flush()
+        return contact.id
+
+    def _saveContacts(self, contacts):
+        with getDatabase().transaction():
+            for values in contacts:
+                self._writeContact(values)
+
+    def _contactValues(self, contact):
+        # the writer thread gets a copy, the cached contact keeps changing while the write is queued
+        return dict((field, getattr(contact, field)) for field in ('conversationId', 'name', 'pictureId', 'lastSeen'))
+
+    def _writeContact(self, values):
+        # must run on the writer thread, inserts or updates the row and returns its id
+        conversationId = values['conversationId']
+        if ContactModel.update(**values).where(ContactModel.conversationId == conversationId).execute() == 0:
+            contactId = ContactModel.insert(**values).execute()
         else:
-            if 'name' not in kwargs:
-                kwargs['name'] = conversationId
-            contact = ContactModel.create(conversationId=conversationId, **kwargs)
-            return contact
+            contactId = ContactModel.select(ContactModel.id).where(ContactModel.conversationId == conversationId).get().id
+        # the id is the only thing the writer sets on the cached contact
+        with self._cacheLock:
+            contact = self._contacts.get(conversationId) if self._contacts is not None else None
+            if contact is not None and contact.id is None:
+                contact.id = contactId
+        return contactId
 
-    def getMessageList(self, conversationId, numMessages=None, since=None):
-        if not ContactModel.select().where(ContactModel.conversationId == conversationId).exists():
-            return list()
-        messages = ContactModel.get(conversationId=conversationId).messages
+    def _messagesQuery(self, contact, since=None, before=None, after=None):
+        query = MessageModel.select().where(MessageModel.contact == contact)
         if since is not None:
-            return list(messages.where(MessageModel.timestamp > since))
+            query = query.where(MessageModel.timestamp > since)
+        if before is not None:
+            # keyset pagination: only messages older than the given (timestamp, messageId)
+            timestamp, messageId = before
+            query = query.where((MessageModel.timestamp < timestamp) | ((MessageModel.timestamp == timestamp) & (MessageModel.messageId < messageId)))
+        if after is not None:
+            timestamp, messageId = after
+            query = query.where((MessageModel.timestamp > timestamp) | ((MessageModel.timestamp == timestamp) & (MessageModel.messageId > messageId)))
+        return query
+
+    @timed('ContactDB.countMessages')
+    def countMessages(self, conversationId, since=None, before=None):
+        contact = self.get(conversationId)
+        if contact is None:
+            return 0
+        return self._messagesQuery(contact, since=since, before=before).count()
+
+    @timed('ContactDB.getRecentConversationIds')
+    def getRecentConversationIds(self, since):
+        # conversations with a message newer than since, one index lookup per contact
+        cursor = getDatabase().execute_sql('SELECT c."%s" FROM "%s" c WHERE (SELECT MAX(m."%s") FROM "%s" m WHERE m."%s" = c."%s") > ?' % (
+            ContactModel.conversationId.db_column, ContactModel._meta.db_table, MessageModel.timestamp.db_column,
+            MessageModel._meta.db_table, MessageModel.contact.db_column, ContactModel.id.db_column), (MessageModel.timestamp.db_value(since),))
+        return set(row[0] for row in cursor.fetchall())
+
+    def getPendingMessageIds(self, conversationId):
+        # ids of messages in the outbox that the server has not confirmed yet
+        return set(entry.messageId for entry in OutboxModel.select().where(OutboxModel.receiver == conversationId))
+
+    @timed('ContactDB.getMessage')
+    def getMessage(self, messageId):
+        for message in MessageModel.select().where(MessageModel.messageId == messageId):
+            return message
+        return None
+
+    @timed('ContactDB.searchMessages')
+    def searchMessages(self, text, conversationId=None, limit=100):
+        # full text search, in one conversation or in all of them, best matches first
+        searchModule = getSearchModule()
+        if searchModule is None:
+            return list()
+        match = searchMatch(text, searchModule)
+        if match is None:
+            return list()
+        snippet, order = _searchSnippet[searchModule]
+        parameters = ['\x01', '\x02', match]
+        where = ''
+        if conversationId is not None:
+            contact = self.get(conversationId)
+            if contact is None or contact.id is None:
+                return list()
+            where = 'AND m."%s" = ?' % MessageModel.contact.db_column
+            parameters.append(contact.id)
+        parameters.append(limit)
+
+        results = []
+        cursor = getDatabase().execute_sql(_searchSql % {'snippet': snippet, 'where': where, 'order': order}, parameters)
+        for messageId, timestamp, sender, resultConversationId, snippetText in cursor.fetchall():
+            # drop markup that was cut by the snippet, then highlight the matches
+            snippetText = re.sub(r'<[^>]*>?', '', snippetText).replace('\x01', '<b>').replace('\x02', '</b>')
+            results.append({
+                'conversationId': resultConversationId,
+                'messageId': messageId,
+                'timestamp': MessageModel.timestamp.python_value(timestamp),
+                'sender': sender,
+                'snippet': snippetText,
+            })
+        return results
+
+    def startSearchIndexBackfill(self):
+        # index messages stored before the search index existed, chunk by chunk on the writer thread
+        thread = threading.Thread(target=self._backfillSearchIndex, name='SearchIndexBackfill')
+        thread.daemon = True
+        thread.start()
+
+    def _backfillSearchIndex(self):
+        while DatabaseWriter.instance().call(backfillSearchIndex):
+            # give other writes a chance in between
+            time.sleep(0.05)
+
+    @timed('ContactDB.getMessageList')
+    def getMessageList(self, conversationId, numMessages=None, since=None, before=None, after=None):
+        contact = self.get(conversationId)
+        if contact is None:
+            return list()
+        query = self._messagesQuery(contact, since=since, before=before, after=after)
+        if numMessages is not None and after is not None:
+            # the oldest messages after the given one, for scrolling forward
+            return list(query.order_by(MessageModel.timestamp, MessageModel.messageId).limit(numMessages))
         if numMessages is not None:
-            return list(messages)[-numMessages:]
-        return list(messages)
+            # let the database pick the newest messages and return them in chronological order
+            query = query.order_by(MessageModel.timestamp.desc(), MessageModel.messageId.desc()).limit(numMessages)
+            return list(reversed(list(query)))
+        return list(query.order_by(MessageModel.timestamp, MessageModel.messageId))
 
     def addMessage(self, conversationId, messageId, timestamp, sender, receiver, message):
-        if MessageModel.select().where(MessageModel.messageId == messageId).exists():
+        added = self.addMessages([(conversationId, messageId, timestamp, sender, receiver, message)])
+        if not added:
+            return None
+        return added[0][1]
+
+    @timed('ContactDB.addMessages')
+    def addMessages(self, messages):
+        # store a batch of (conversationId, messageId, timestamp, sender, receiver, message) in one transaction
+        # and return the ones that were actually added
+        return DatabaseWriter.instance().call(self._addMessages, messages)
+
+    @timed('ContactDB.addMessages.write')
+    def _addMessages(self, messages):
+        try:
+            with getDatabase().transaction():
+                return self._insertMessages(messages)
+        except:
+            # contacts created in the failed transaction are not in the database
+            self.invalidate()
+            raise
+
+    def _insertMessages(self, messages, isRead=False):
+        # must run on the writer thread inside a transaction
+        added = []
+        for conversationId, messageId, timestamp, sender, receiver, message in messages:
             # if message is already in the logs and it is from my self, mark it as the answer message
-            if sender == receiver:
+            if sender == receiver and MessageModel.select().where(MessageModel.messageId == messageId).exists():
                 messageId += '*'
+            with self._cacheLock:
+                contact = self.updateOrCreate(conversationId)
+                contactId = contact.id
+                contactValues = self._contactValues(contact)
+            if contactId is None:
+                # contact was just created by another thread and its insert is still queued
+                contactId = self._writeContact(contactValues)
+            values = messageValues(contactId, messageId, sender, receiver, message, datetime.datetime.fromtimestamp(timestamp), isRead=isRead)
+            if insertMessages([values]) == 1:
+                added.append((conversationId, messageId, timestamp, sender, receiver, message))
             else:
-                print 'ContactDB.addMessage(): received duplicate message:', conversationId, messageId, timestamp, sender, receiver, message
-                return None
-        contact = self.updateOrCreate(conversationId)
-        timestamp = datetime.datetime.fromtimestamp(timestamp)
-        MessageModel.create(contact=contact, messageId=messageId, sender=sender, receiver=receiver, message=message, timestamp=timestamp, isRead=False)
-        return messageId
-
+                print 'ContactDB.addMessages(): received duplicate message:', conversationId, messageId, timestamp, sender, receiver, message
+        return added
 
 _instance = ContactDB()
@@ -1,7 +1,6 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import os
 import base64
 import re
 import datetime
@@ -9,14 +8,17 @@ import datetime
 from PyQt4.QtGui import QMessageBox
 from PyQt4.QtCore import QObject, pyqtSlot as Slot, pyqtSignal as Signal
 
-from .helpers import PICTURE_CACHE_PATH, getConfig
+from .helpers import getConfig, getOwnPhone, cachedConfigValue
 from .ContactDB import ContactDB
-
-from Yowsup.Contacts.contacts import WAContactsSyncRequest
+from .PictureCache import PictureCache
 
 class Contacts(QObject):
     contacts_updated_signal = Signal()
     contact_status_changed_signal = Signal(str)
+    contact_statuses_changed_signal = Signal(list)
+    contact_added_signal = Signal(str)
+    contact_removed_signal = Signal(str)
+    contact_changed_signal = Signal(str)
     edit_contact_signal = Signal(str, str)
     userIdFormat = '%s@s.whatsapp.net'
     groupIdFormat = '%s@g.us'
@@ -40,6 +42,9 @@ class Contacts(QObject):
         phoneOrGroup = re.sub('[\D]+', '', phoneOrGroup)
         return self.userIdFormat % phoneOrGroup
 
+    def getOwnJid(self):
+        return cachedConfigValue('ownJid', lambda: self.phoneToConversationId(getOwnPhone()))
+
     def getPhone(self, conversationId):
         return conversationId.split('@')[0]
 
@@ -53,11 +58,19 @@ class Contacts(QObject):
 
     def removeContact(self, conversationId):
         ContactDB.instance().delete(conversationId)
-        self.contacts_updated_signal.emit()
+        self.contact_removed_signal.emit(conversationId)
 
     def setContactName(self, conversationId, name):
+        isNew = ContactDB.instance().get(conversationId) is None
         ContactDB.instance().updateOrCreate(conversationId, name=name)
-        self.contacts_updated_signal.emit()
+        if isNew:
+            self.contact_added_signal.emit(conversationId)
+        else:
+            self.contact_changed_signal.emit(conversationId)
+
+    def getVersion(self):
+        # changes whenever a contact name or picture changes
+        return ContactDB.instance().getVersion()
 
     def getName(self, conversationId):
         contact = ContactDB.instance().get(conversationId)
@@ -76,10 +89,10 @@ class Contacts(QObject):
         return contact.pictureId
 
     def getContactPicture(self, conversationId):
-        contact = ContactDB.instance().get(conversationId)
-        if contact is None or contact.pictureId is None:
-            return None
-        return '%s.jpeg' % os.path.join(PICTURE_CACHE_PATH, contact.pictureId)
+        return PictureCache.instance().getOriginal(self.getContactPictureId(conversationId))
+
+    def getContactThumbnail(self, conversationId):
+        return PictureCache.instance().getThumbnail(self.getContactPictureId(conversationId))
 
     def setAvailable(self, conversationId, available):
         self._available[conversationId] = available
@@ -94,6 +107,17 @@ class Contacts(QObject):
         ContactDB.instance().updateOrCreate(conversationId, lastSeen=lastSeen)
         self.contact_status_changed_signal.emit(conversationId)
 
+    def setStatuses(self, available, lastSeen):
+        # apply many presence updates at once and notify about all affected contacts with a single signal
+        self._available.update(available)
+        updates = {}
+        for conversationId, timestamp in lastSeen.items():
+            if type(timestamp) is float:
+                timestamp = datetime.datetime.fromtimestamp(timestamp)
+            updates[conversationId] = {'lastSeen': timestamp}
+        ContactDB.instance().updateOrCreateMany(updates)
+        self.contact_statuses_changed_signal.emit(list(set(available.keys()) | set(lastSeen.keys())))
+
     def getLastSeen(self, conversationId):
         contact = ContactDB.instance().get(conversationId)
         if contact is None:
@@ -118,8 +142,9 @@ class Contacts(QObject):
         self.setContactName(self.phoneToConversationId(phoneOrGroup), name)
 
     def getWAUsers(self, phoneNumbers):
+        from Yowsup.Contacts.contacts import WAContactsSyncRequest
         waUsers = {}
-        waUsername = str(getConfig('countryCode') + getConfig('phoneNumber'))
+        waUsername = str(getOwnPhone())
         waPassword = base64.b64decode(getConfig('password'))
         waContactsSync = WAContactsSyncRequest(waUsername, waPassword, phoneNumbers)
         try:
@@ -3,36 +3,123 @@
 
 import os
 
-from PyQt4.QtCore import pyqtSlot as Slot, pyqtSignal as Signal, QDir
-from PyQt4.QtGui import QWidget, QListWidgetItem, QLineEdit, QInputDialog, QIcon, QMenu
+from PyQt4.QtCore import Qt, pyqtSlot as Slot, pyqtSignal as Signal, QDir, QTimer, QAbstractListModel, QModelIndex, QVariant
+from PyQt4.QtGui import QWidget, QLineEdit, QInputDialog, QIcon, QMenu, QSortFilterProxyModel
 from PyQt4.uic import loadUi
 
 from .helpers import getConfig, setConfig
 from .Contacts import Contacts
 
-class ListWidgetItem(QListWidgetItem):
-
-    def __lt__(self, otherItem):
-        return self._sortingValue.lower() < otherItem._sortingValue.lower()
-
-    def setOnline(self, online=True):
-        if online:
-            self.setIcon(QIcon.fromTheme('user-available'))
-            self._sortingValue = ' ' + self.text()
+class ContactListModel(QAbstractListModel):
+    ConversationIdRole = Qt.UserRole
+    SortRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super(ContactListModel, self).__init__(parent)
+        self._icons = {
+            'available': QIcon.fromTheme('user-available'),
+            'offline': QIcon.fromTheme('user-offline'),
+            'group': QIcon.fromTheme('internet-group-chat'),
+            'unknown': QIcon.fromTheme('dialog-question'),
+        }
+        # display data per contact is computed once per change, not on every paint or comparison
+        self._conversationIds = []
+        self._items = {}
+        # row of every contact, so status updates do not search the list, None while it has to be rebuilt
+        self._rows = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._conversationIds)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._conversationIds):
+            return QVariant()
+        conversationId = self._conversationIds[index.row()]
+        item = self._items[conversationId]
+        if role == Qt.DisplayRole:
+            return item['name']
+        if role == Qt.DecorationRole:
+            return self._icons[item['status']]
+        if role == Qt.ToolTipRole:
+            return item['toolTip']
+        if role == self.SortRole:
+            return item['sortKey']
+        if role == self.ConversationIdRole:
+            return conversationId
+        return QVariant()
+
+    def _makeItem(self, conversationId):
+        contacts = Contacts.instance()
+        name = contacts.getName(conversationId)
+        phone = contacts.getPhone(conversationId)
+        if contacts.isGroup(conversationId):
+            status = 'group'
+            toolTip = 'Group: %s' % (phone)
+            sortPrefix = chr(ord(' ') - 1)
         else:
-            self.setIcon(QIcon.fromTheme('user-offline'))
-            self._sortingValue = self.text()
-
-    def setOffline(self):
-        self.setOnline(False)
+            lastSeen = contacts.getLastSeen(conversationId)
+            if lastSeen is None:
+                status = 'unknown'
+                toolTip = 'Phone: +%s\nno information available' % (phone)
+                sortPrefix = '~'
+            else:
+                available = bool(contacts.isAvailable(conversationId))
+                status = 'available' if available else 'offline'
+                formattedDate = lastSeen.strftime('%d-%m-%Y %H:%M:%S')
+                toolTip = 'Phone: +%s\nAvailable: %s (last seen %s)' % (phone, available, formattedDate)
+                sortPrefix = ' ' if available else ''
+        thumbnail = contacts.getContactThumbnail(conversationId)
+        if thumbnail is not None:
+            toolTip = '<img src="%s"><br>%s' % (thumbnail, toolTip.replace('\n', '<br>'))
+        return {'name': name, 'status': status, 'toolTip': toolTip, 'sortKey': (sortPrefix + name).lower()}
+
+    def resetContacts(self, conversationIds):
+        self.beginResetModel()
+        self._conversationIds = list(conversationIds)
+        self._items = dict((conversationId, self._makeItem(conversationId)) for conversationId in self._conversationIds)
+        self._rows = None
+        self.endResetModel()
+
+    def _row(self, conversationId):
+        if self._rows is None:
+            self._rows = dict((conversationId, row) for row, conversationId in enumerate(self._conversationIds))
+        return self._rows[conversationId]
 
-    def setGroup(self):
-        self.setIcon(QIcon.fromTheme('internet-group-chat'))
-        self._sortingValue = chr(ord(' ') - 1) + self.text()
+    def addContact(self, conversationId):
+        if conversationId in self._items:
+            self.updateContact(conversationId)
+            return
+        row = len(self._conversationIds)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._conversationIds.append(conversationId)
+        self._items[conversationId] = self._makeItem(conversationId)
+        if self._rows is not None:
+            self._rows[conversationId] = row
+        self.endInsertRows()
+
+    def removeContact(self, conversationId):
+        if conversationId not in self._items:
+            return
+        row = self._row(conversationId)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._conversationIds[row]
+        del self._items[conversationId]
+        if row == len(self._conversationIds):
+            del self._rows[conversationId]
+        else:
+            # the contacts after the removed one moved up a row, they are counted again on the next lookup
+            self._rows = None
+        self.endRemoveRows()
 
-    def setUnknown(self):
-        self.setIcon(QIcon.fromTheme('dialog-question'))
-        self._sortingValue = '~' + self.text()
+    def updateContact(self, conversationId):
+        if conversationId not in self._items:
+            return False
+        self._items[conversationId] = self._makeItem(conversationId)
+        index = self.index(self._row(conversationId))
+        self.dataChanged.emit(index, index)
+        return True
 
 class ContactsWidget(QWidget):
     start_chat_signal = Signal(str)
@@ -45,19 +132,33 @@ class ContactsWidget(QWidget):
         self.importGoogleContactsButton.setIcon(QIcon.fromTheme('browser-download'))
         self.addContactButton.setIcon(QIcon.fromTheme('add'))
 
-        self.contactsUpdated()
+        self._model = ContactListModel(self)
+        self._proxyModel = QSortFilterProxyModel(self)
+        self._proxyModel.setSourceModel(self._model)
+        self._proxyModel.setSortRole(ContactListModel.SortRole)
+        self._proxyModel.setDynamicSortFilter(True)
+        self._proxyModel.sort(0)
+        self.contactList.setModel(self._proxyModel)
+
+        # fill the list after the main window is shown
+        QTimer.singleShot(0, self.contactsUpdated)
         Contacts.instance().contacts_updated_signal.connect(self.contactsUpdated)
+        Contacts.instance().contact_added_signal.connect(self._model.addContact)
+        Contacts.instance().contact_removed_signal.connect(self._model.removeContact)
+        Contacts.instance().contact_changed_signal.connect(self.contactStatusChanged)
         Contacts.instance().contact_status_changed_signal.connect(self.contactStatusChanged)
+        Contacts.instance().contact_statuses_changed_signal.connect(self.contactStatusesChanged)
         Contacts.instance().edit_contact_signal.connect(self.editContact)
 
     def on_contactList_customContextMenuRequested(self, pos):
-        item = self.contactList.itemAt(pos)
-        if item is None:
+        index = self.contactList.indexAt(pos)
+        if not index.isValid():
             return
+        conversationId = index.data(ContactListModel.ConversationIdRole).toString()
         menu = QMenu()
         results = {}
-        results[menu.addAction('Edit Contact')] = (self.editContact, item._conversationId, item.text())
-        results[menu.addAction('Remove Contact')] = (Contacts.instance().removeContact, item._conversationId)
+        results[menu.addAction('Edit Contact')] = (self.editContact, conversationId, index.data(Qt.DisplayRole).toString())
+        results[menu.addAction('Remove Contact')] = (Contacts.instance().removeContact, conversationId)
         result = menu.exec_(self.contactList.mapToGlobal(pos))
         if result in results:
             handler = results[result][0]
@@ -80,51 +181,25 @@ class ContactsWidget(QWidget):
 
     @Slot()
     def contactsUpdated(self):
-        self._items = {}
-        self.contactList.clear()
-        for conversationId in Contacts.instance().getAllConversationIds():
-            self.addContact(conversationId)
+        self._model.resetContacts(Contacts.instance().getAllConversationIds())
 
     @Slot()
     def on_addContactButton_clicked(self):
         self.editContact()
 
-    def addContact(self, conversationId):
-        name = Contacts.instance().getName(conversationId)
-        item = ListWidgetItem(name)
-        item._conversationId = conversationId
-        self._items[conversationId] = item
-        self.contactStatusChanged(conversationId)
-        self.contactList.addItem(item)
+    @Slot(list)
+    def contactStatusesChanged(self, conversationIds):
+        for conversationId in conversationIds:
+            self._model.updateContact(conversationId)
 
     @Slot(str)
     def contactStatusChanged(self, conversationId):
-        if conversationId not in self._items:
+        if not self._model.updateContact(conversationId):
             print 'ContactsWidgets.contactStatusChanged(): received contact status for unknown contact:', conversationId
-            return
-
-        item = self._items[conversationId]
-
-        contacts = Contacts.instance()
-        phone = contacts.getPhone(conversationId)
-        if contacts.isGroup(conversationId):
-            item.setToolTip('Group: %s' % (phone))
-            item.setGroup()
-        else:
-            lastSeen = contacts.getLastSeen(conversationId)
-            if lastSeen is None:
-                item.setToolTip('Phone: +%s\nno information available' % (phone))
-                item.setUnknown()
-            else:
-                available = bool(contacts.isAvailable(conversationId))
-                item.setOnline(available)
-                formattedDate = lastSeen.strftime('%d-%m-%Y %H:%M:%S')
-                phone = conversationId.split('@')[0]
-                item.setToolTip('Phone: +%s\nAvailable: %s (last seen %s)' % (phone, available, formattedDate))
 
-    @Slot(QListWidgetItem)
-    def on_contactList_itemDoubleClicked(self, item):
-        self.start_chat_signal.emit(item._conversationId)
+    @Slot(QModelIndex)
+    def on_contactList_doubleClicked(self, index):
+        self.start_chat_signal.emit(index.data(ContactListModel.ConversationIdRole).toString())
 
     @Slot()
     def on_importGoogleContactsButton_clicked(self):
@@ -2,11 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import threading
+import Queue
 from .helpers import checkForPeewee, DATABASE_FILE
 checkForPeewee()
-from peewee import SqliteDatabase, Model, CharField, DateTimeField, BooleanField, TextField, ForeignKeyField
+from peewee import SqliteDatabase, Model, CharField, DateTimeField, BooleanField, TextField, ForeignKeyField, IntegerField
 
-_sqlite_db = SqliteDatabase(DATABASE_FILE, threadlocals=True)
+class WazappDatabase(SqliteDatabase):
+    def _connect(self, database, **kwargs):
+        conn = super(WazappDatabase, self)._connect(database, **kwargs)
+        if conn.execute('PRAGMA page_count').fetchone()[0] == 0:
+            # lets retention give space back to the file system, a new file only takes it before switching to WAL
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # write ahead logging lets the GUI read while the writer thread commits
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-8000')
+        conn.create_function('searchtext', 1, searchText)
+        return conn
+
+# every thread gets its own connection, all writes go through the DatabaseWriter thread
+_sqlite_db = WazappDatabase(DATABASE_FILE, threadlocals=True)
+
+def getDatabase():
+    return _sqlite_db
 
 class ContactModel(Model):
     class Meta:
@@ -17,8 +37,6 @@ class ContactModel(Model):
     pictureId = CharField(null=True)
     lastSeen = DateTimeField(null=True)
 
-if not ContactModel.table_exists():
-    ContactModel.create_table()
 
 
 class MessageModel(Model):
@@ -36,52 +54,346 @@ class MessageModel(Model):
     isSent = BooleanField(default=False)
     isDelivered = BooleanField(default=False)
 
-if not MessageModel.table_exists():
-    MessageModel.create_table()
 
-def convertLegacyDatabases():
-    import glob, datetime, codecs
+_insertMessageFields = (MessageModel.contact, MessageModel.messageId, MessageModel.sender, MessageModel.receiver, MessageModel.message,
+                        MessageModel.timestamp, MessageModel.isRead, MessageModel.isSent, MessageModel.isDelivered)
+# duplicates are dropped by the unique messageId column
+_insertMessageSql = 'INSERT OR IGNORE INTO "%s" (%s) VALUES (%s)' % (
+    MessageModel._meta.db_table,
+    ', '.join('"%s"' % field.db_column for field in _insertMessageFields),
+    ', '.join('?' for field in _insertMessageFields),
+)
+
+def messageValues(contactId, messageId, sender, receiver, message, timestamp, isRead=False, isSent=False, isDelivered=False):
+    # row for insertMessages(), timestamp is a datetime
+    values = (contactId, messageId, sender, receiver, message, timestamp, isRead, isSent, isDelivered)
+    return [field.db_value(value) for field, value in zip(_insertMessageFields, values)]
+
+def insertMessages(rows):
+    # insert rows built by messageValues(), returns how many were not already there
+    cursor = _sqlite_db.get_cursor()
+    if len(rows) == 1:
+        cursor.execute(_insertMessageSql, rows[0])
+    else:
+        cursor.executemany(_insertMessageSql, rows)
+    return cursor.rowcount
+
+def _createIndex(model, *fields):
+    table = model._meta.db_table
+    columns = [field.db_column for field in fields]
+    indexName = '%s_%s' % (table, '_'.join(columns))
+    _sqlite_db.execute_sql('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (indexName, table, ', '.join('"%s"' % column for column in columns)))
+
+
+
+class MetaDataModel(Model):
+    class Meta:
+        database = _sqlite_db
+
+    key = CharField(unique=True)
+    value = TextField(null=True)
+
+
+def getMetaData(key, default=None):
+    for entry in MetaDataModel.select().where(MetaDataModel.key == key):
+        return entry.value
+    return default
+
+def setMetaData(key, value):
+    # like all writes, this should run on the DatabaseWriter thread once the GUI is up
+    _sqlite_db.execute_sql('INSERT OR REPLACE INTO "%s" ("%s", "%s") VALUES (?, ?)' % (MetaDataModel._meta.db_table, MetaDataModel.key.db_column, MetaDataModel.value.db_column), (key, value))
+
+
+class PictureModel(Model):
+    class Meta:
+        database = _sqlite_db
+
+    pictureId = CharField(unique=True)
+    contentHash = CharField()
+
+
+class OutboxModel(Model):
+    class Meta:
+        database = _sqlite_db
+        order_by = ('id',)
+
+    # messageId is the id the message currently has in MessageModel, it changes with every send attempt
+    messageId = CharField(unique=True)
+    receiver = CharField()
+    message = TextField()
+    attempts = IntegerField(default=0)
+    lastAttempt = DateTimeField(null=True)
+
+
+SEARCH_TABLE = 'messagesearch'
+# markup and inline base64 previews are not worth indexing
+_searchMarkup = re.compile(r'<[^>]*>|data:[a-z]+/[a-z]+;base64,[A-Za-z0-9+/=]+')
+
+def searchText(message):
+    # the text that goes into the search index, registered as searchtext() on every connection for the triggers
+    if message is None:
+        return None
+    return _searchMarkup.sub(' ', message)
+
+def _searchIndexed(row):
+    # messages up to the backfill mark are indexed by the backfill, the triggers must leave them alone
+    return '%s."%s" > COALESCE((SELECT CAST("%s" AS INTEGER) FROM "%s" WHERE "%s" = \'searchIndexBackfill\'), 0)' % (
+        row, MessageModel.id.db_column, MetaDataModel.value.db_column, MetaDataModel._meta.db_table, MetaDataModel.key.db_column)
+
+# fts5 only keeps the index and reads the stripped text through a view on the message table when it builds snippets,
+# fts4 would read the unstripped text back to delete from such an index, so it stores the stripped text itself
+_searchTables = (
+    ('fts5', 'message, content="%(view)s", content_rowid="%(id)s"',
+     'INSERT INTO "%(search)s" ("%(search)s", rowid, message) VALUES (\'delete\', old."%(id)s", searchtext(old."%(message)s"));'),
+    ('fts4', 'message',
+     'DELETE FROM "%(search)s" WHERE rowid = old."%(id)s";'),
+)
+
+def _createSearchIndex():
+    # full text index over MessageModel.message, kept in sync by triggers, returns the fts module in use
+    cursor = _sqlite_db.execute_sql("SELECT name, sql FROM sqlite_master WHERE name IN (?, ?)", (SEARCH_TABLE, SEARCH_TABLE + '_update'))
+    schema = dict(cursor.fetchall())
+    if SEARCH_TABLE in schema:
+        if 'searchtext(' in schema.get(SEARCH_TABLE + '_update', ''):
+            return 'fts5' if 'fts5' in schema[SEARCH_TABLE].lower() else 'fts4'
+        # an earlier attempt was interrupted after creating the table, sqlite commits DDL right away,
+        # or the index is from a version that stored the full messages, it is built again
+        for name in ('insert', 'delete', 'update'):
+            _sqlite_db.execute_sql('DROP TRIGGER IF EXISTS "%s_%s"' % (SEARCH_TABLE, name))
+        _sqlite_db.execute_sql('DROP TABLE "%s"' % SEARCH_TABLE)
+
+    names = {
+        'table': MessageModel._meta.db_table,
+        'search': SEARCH_TABLE,
+        'view': SEARCH_TABLE + 'text',
+        'id': MessageModel.id.db_column,
+        'message': MessageModel.message.db_column,
+    }
+    with _sqlite_db.transaction():
+        _sqlite_db.execute_sql('CREATE VIEW IF NOT EXISTS "%(view)s" AS SELECT "%(id)s", searchtext("%(message)s") AS message FROM "%(table)s"' % names, require_commit=False)
+        for module, arguments, delete in _searchTables:
+            try:
+                _sqlite_db.execute_sql('CREATE VIRTUAL TABLE "%s" USING %s(%s)' % (SEARCH_TABLE, module, arguments % names), require_commit=False)
+                break
+            except Exception as e:
+                print 'Database._createSearchIndex(): %s not available: %s' % (module, e)
+        else:
+            return None
+        # new messages are indexed by the triggers, older ones are indexed in the background
+        maxId = _sqlite_db.execute_sql('SELECT MAX("%(id)s") FROM "%(table)s"' % names, require_commit=False).fetchone()[0]
+        setMetaData('searchIndexBackfill', str(maxId or 0))
+        insert = 'INSERT INTO "%(search)s" (rowid, message) VALUES (new."%(id)s", searchtext(new."%(message)s"));'
+        # the update trigger comes last, it marks the index as complete
+        triggers = (
+            ('insert', 'AFTER INSERT ON "%(table)s" WHEN ' + _searchIndexed('new') + ' BEGIN ' + insert + ' END'),
+            ('delete', 'AFTER DELETE ON "%(table)s" WHEN ' + _searchIndexed('old') + ' BEGIN ' + delete + ' END'),
+            ('update', 'AFTER UPDATE OF "%(message)s" ON "%(table)s" WHEN ' + _searchIndexed('old') + ' BEGIN ' + delete + ' ' + insert + ' END'),
+        )
+        for name, trigger in triggers:
+            sql = 'CREATE TRIGGER IF NOT EXISTS "%(search)s_%(name)s" ' + trigger
+            _sqlite_db.execute_sql(sql % dict(names, name=name), require_commit=False)
+    return module
+
+def searchMatch(text, searchModule):
+    # quote every word, so user input can not break the query syntax, and match word prefixes
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    if searchModule == 'fts5':
+        return ' '.join('"%s"*' % word for word in words)
+    return ' '.join('"%s*"' % word for word in words)
+
+_initialized = False
+_searchModule = None
+
+def initDatabase():
+    # create missing tables and indexes, looking at the schema only once
+    global _initialized, _searchModule
+    if _initialized:
+        return
+    _initialized = True
+    tables = set(_sqlite_db.get_tables())
+    for model in (ContactModel, MessageModel, MetaDataModel, PictureModel, OutboxModel):
+        if model._meta.db_table not in tables:
+            model.create_table()
+    # the history of one conversation is always queried ordered by time
+    _createIndex(MessageModel, MessageModel.contact, MessageModel.timestamp)
+    _searchModule = _createSearchIndex()
+
+def getSearchModule():
+    return _searchModule
+
+def backfillSearchIndex(chunkSize=2000):
+    # index the next chunk of messages that existed before the search index, returns False when done
+    upTo = int(getMetaData('searchIndexBackfill', 0))
+    if _searchModule is None or upTo <= 0:
+        return False
+    lower = max(0, upTo - chunkSize)
+    with _sqlite_db.transaction():
+        _sqlite_db.execute_sql('INSERT INTO "%s" (rowid, message) SELECT "%s", searchtext("%s") FROM "%s" WHERE "%s" > ? AND "%s" <= ?' % (
+            SEARCH_TABLE, MessageModel.id.db_column, MessageModel.message.db_column, MessageModel._meta.db_table, MessageModel.id.db_column, MessageModel.id.db_column), (lower, upTo), require_commit=False)
+        setMetaData('searchIndexBackfill', str(lower))
+    return lower > 0
+
+class WriteTimeout(Exception):
+    pass
+
+class WriteResult(object):
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def _set(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done.set()
+
+    def wait(self, timeout=None):
+        # raises WriteTimeout if the write is still queued or running after timeout seconds
+        if not self._done.wait(timeout):
+            raise WriteTimeout('write not done after %s seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+class DatabaseWriter(object):
+
+    @staticmethod
+    def instance():
+        return _writer
+
+    def __init__(self):
+        super(DatabaseWriter, self).__init__()
+        self._queue = Queue.Queue()
+        self._threadLock = threading.Lock()
+        self._thread = None
+
+    def isWriterThread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, func, *args, **kwargs):
+        # queue a write, the returned WriteResult can be waited for if the caller needs the result
+        result = WriteResult()
+        if self.isWriterThread():
+            self._execute(func, args, kwargs, result)
+            return result
+        with self._threadLock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='DatabaseWriter')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((func, args, kwargs, result))
+        return result
+
+    def call(self, func, *args, **kwargs):
+        return self.submit(func, *args, **kwargs).wait()
+
+    def getStats(self):
+        return {'queued': self._queue.qsize()}
+
+    def flush(self):
+        # wait until all writes queued so far are done
+        if self._thread is not None:
+            self.call(lambda: None)
+
+    def _execute(self, func, args, kwargs, result):
+        try:
+            result._set(func(*args, **kwargs))
+        except Exception as e:
+            print 'DatabaseWriter._execute(): %s failed: %s %s' % (getattr(func, '__name__', func), type(e), e)
+            result._set(exception=e)
+
+    def _run(self):
+        while True:
+            func, args, kwargs, result = self._queue.get()
+            self._execute(func, args, kwargs, result)
+
+_writer = DatabaseWriter()
+
+def legacyConversionNeeded():
+    initDatabase()
+    return getMetaData('legacyConversionDone') is None
+
+def _importLegacyChunk(rows, checkpointKey, offset):
+    # the messages and the position in the log file are committed together
+    with _sqlite_db.transaction():
+        imported = insertMessages(rows) if rows else 0
+        setMetaData(checkpointKey, str(offset))
+    return imported
+
+def convertLegacyDatabases(progressCallback=None, chunkSize=1000):
+    # import the old text file contacts and logs, this is resumable: the byte offset reached in every log file
+    # is checkpointed, so an interrupted import continues where it stopped.
+    # progressCallback(filename, bytesDone, bytesTotal) is called from the calling thread after every chunk
+    import glob, datetime
     from .helpers import LOG_FILE_TEMPLATE, CONTACTS_FILE, readObjectFromFile
+    from .ContactDB import ContactDB
+
+    # once everything was imported, don't look at the old files again on every start
+    if not legacyConversionNeeded():
+        return
+    writer = DatabaseWriter.instance()
+    # contacts go through the contact cache, so it never has to be reloaded
+    contactDB = ContactDB.instance()
 
+    oldContacts = {}
     if os.path.isfile(CONTACTS_FILE):
         oldContacts = readObjectFromFile(CONTACTS_FILE)
-        importedContacts = 0
-        for conversationId in oldContacts.keys():
-            name = oldContacts.get(conversationId, {}).get('name', conversationId)
-            pictureId = oldContacts.get(conversationId, {}).get('pictureId')
-            if ContactModel.select().where(ContactModel.conversationId == conversationId).exists():
-                contact = ContactModel.get(conversationId=conversationId)
-            else:
-                contact = ContactModel.create(conversationId=conversationId, name=name, pictureId=pictureId)
-                importedContacts += 1
+        contacts = [(conversationId, info.get('name', conversationId), info.get('pictureId')) for conversationId, info in oldContacts.items()]
+        importedContacts = contactDB.createMissing(contacts)
         print 'Database.convertLegacyDatabases(): imported %d contacts' % (importedContacts)
         print 'Database.convertLegacyDatabases(): please delete old contacts file:', CONTACTS_FILE
-    else:
-        oldContacts = {}
 
-    importedMessages = 0
     base, ext = LOG_FILE_TEMPLATE.split('%s')
     historyFilePattern = base + '*' + ext
-    historyFiles = glob.glob(historyFilePattern)
-    if historyFiles:
-        for filename in historyFiles:
-            conversationId = filename.lstrip(base).rstrip(ext)
-            name = oldContacts.get(conversationId, {}).get('name', conversationId)
-            pictureId = oldContacts.get(conversationId, {}).get('pictureId')
-            if ContactModel.select().where(ContactModel.conversationId == conversationId).exists():
-                contact = ContactModel.get(conversationId=conversationId)
-            else:
-                contact = ContactModel.create(conversationId=conversationId, name=name, pictureId=pictureId)
-
-            with codecs.open(LOG_FILE_TEMPLATE % conversationId, 'r', 'utf8') as logfile:
-                for line in logfile:
-                    messageId, timestamp, sender, receiver, message = line.rstrip('\n').split(';', 4)
-                    timestamp = float(timestamp)
-
-                    if not MessageModel.select().where(MessageModel.messageId == messageId).exists():
-                        timestamp = datetime.datetime.fromtimestamp(timestamp)
-                        MessageModel.create(contact=contact, messageId=messageId, sender=sender, receiver=receiver, message=message, timestamp=timestamp, isRead=True)
-                        importedMessages += 1
+    historyFiles = sorted(glob.glob(historyFilePattern))
+    sizes = dict((filename, os.path.getsize(filename)) for filename in historyFiles)
+    bytesTotal = sum(sizes.values())
+    bytesDone = 0
+    importedMessages = 0
+    for filename in historyFiles:
+        conversationId = filename[len(base):len(filename) - len(ext)]
+        checkpointKey = 'legacyImport:' + os.path.basename(filename)
+        offset = int(getMetaData(checkpointKey, 0))
+        if offset >= sizes[filename]:
+            bytesDone += sizes[filename]
+            continue
 
+        info = oldContacts.get(conversationId, {})
+        contactDB.createMissing([(conversationId, info.get('name', conversationId), info.get('pictureId'))])
+        contactId = contactDB.getContactId(conversationId)
+
+        # binary mode and readline() keep tell() exact, lines are decoded one by one
+        with open(filename, 'rb') as logfile:
+            logfile.seek(offset)
+            bytesDone += offset
+            while True:
+                rows = []
+                lines = 0
+                while lines < chunkSize:
+                    line = logfile.readline()
+                    if not line:
+                        break
+                    lines += 1
+                    try:
+                        messageId, timestamp, sender, receiver, message = line.decode('utf8').rstrip('\n').split(';', 4)
+                        timestamp = datetime.datetime.fromtimestamp(float(timestamp))
+                    except ValueError as e:
+                        print 'Database.convertLegacyDatabases(): skipping broken line in %s: %s' % (filename, e)
+                        continue
+                    rows.append(messageValues(contactId, messageId, sender, receiver, message, timestamp, isRead=True))
+                if lines == 0:
+                    break
+                position = logfile.tell()
+                importedMessages += writer.call(_importLegacyChunk, rows, checkpointKey, position)
+                bytesDone += position - offset
+                offset = position
+                if progressCallback is not None:
+                    progressCallback(filename, bytesDone, bytesTotal)
+
+    if historyFiles:
         print 'Database.convertLegacyDatabases(): imported %s messages' % (importedMessages)
         print 'Database.convertLegacyDatabases(): please delete old history files:', historyFilePattern
+
+    writer.call(setMetaData, 'legacyConversionDone', datetime.datetime.now().isoformat())
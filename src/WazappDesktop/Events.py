@@ -1,6 +1,16 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import time
+import functools
+import threading
+from collections import deque
+
+from PyQt4.QtCore import Qt, QObject, QTimer, pyqtSlot as Slot, pyqtSignal as Signal
+
+from .helpers import getConfig
+from .Instrumentation import Instrumentation
+
 class Events(object):
     def getEventBindings(self):
         bindings = {}
@@ -20,3 +30,142 @@ class Events(object):
         return wrapper
 
 
+# events where only the newest one per key matters, the key is made from the event arguments
+COALESCE_RULES = {
+    'presence_available': lambda jid: ('presence', jid),
+    'presence_unavailable': lambda jid: ('presence', jid),
+    'presence_updated': lambda jid, lastSeen: ('lastSeen', jid),
+    'contact_gotProfilePictureId': lambda jid, pictureId: ('pictureId', jid),
+}
+
+class EventBus(QObject):
+    # receives the Yowsup callbacks on the network thread and runs the bound handlers on the Qt thread.
+    # the network thread only appends to a queue, the Qt thread drains it in batches.
+    # events with a coalescing rule replace their queued predecessor, all other events are kept in order
+    # and when the queue is full the network thread waits instead of dropping them
+    _drain_signal = Signal()
+
+    def __init__(self, signalsInterface):
+        super(EventBus, self).__init__()
+        self._signalsInterface = signalsInterface
+        self._maxQueued = getConfig('eventQueueSize', 10000)
+        self._batchSize = getConfig('eventBatchSize', 200)
+        self._batchTime = getConfig('eventBatchTime', 0.02)
+        self._handlers = {}   # event -> [handler]
+
+        self._queue = deque()   # (event, args, queuedTime) or (coalesceKey, None, queuedTime)
+        self._lock = threading.Lock()
+        self._latest = {}   # coalesceKey -> (event, args), the newest arguments of a queued coalesced event
+        self._scheduled = False
+        self._space = threading.Condition(threading.Lock())
+        self._running = True
+        # the bus is created on the Qt thread, which must never wait for itself
+        self._qtThread = threading.current_thread()
+
+        self._numEvents = 0
+        self._numCoalesced = 0
+        self._numWaits = 0
+        self._maxSeen = 0
+
+        # queued, so a post from the Qt thread itself never runs handlers from inside another handler
+        self._drain_signal.connect(self._drain, Qt.QueuedConnection)
+
+    def register(self, listener):
+        # run the methods bound with Events.bind() on the Qt thread
+        for method, events in listener.getEventBindings().iteritems():
+            for event in events:
+                if event not in self._handlers:
+                    self._handlers[event] = []
+                    self._signalsInterface.registerListener(event, functools.partial(self._post, event))
+                self._handlers[event].append(method)
+
+    def getStats(self):
+        return {
+            'queued': len(self._queue),
+            'maxQueued': self._maxSeen,
+            'events': self._numEvents,
+            'coalesced': self._numCoalesced,
+            'backpressureWaits': self._numWaits,
+        }
+
+    def close(self):
+        # pending events are dropped, unacknowledged messages are sent again by the server
+        self._running = False
+        with self._space:
+            self._space.notify_all()
+
+    # called by the network thread
+    def _post(self, event, *args):
+        if not self._running:
+            return
+        rule = COALESCE_RULES.get(event)
+        if rule is not None:
+            key = rule(*args)
+            with self._lock:
+                alreadyQueued = key in self._latest
+                self._latest[key] = (event, args)
+            if alreadyQueued:
+                self._numCoalesced += 1
+                return
+            item = (key, None, time.time())
+        else:
+            if len(self._queue) >= self._maxQueued and threading.current_thread() is not self._qtThread:
+                self._waitForSpace()
+            item = (event, args, time.time())
+        self._queue.append(item)
+        self._maxSeen = max(self._maxSeen, len(self._queue))
+        self._schedule()
+
+    def _waitForSpace(self):
+        self._numWaits += 1
+        with self._space:
+            while self._running and len(self._queue) >= self._maxQueued:
+                self._space.wait(0.1)
+
+    def _schedule(self):
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._drain_signal.emit()
+
+    @Slot()
+    def _drain(self):
+        start = time.time()
+        processed = 0
+        oldest = None
+        while processed < self._batchSize and time.time() - start < self._batchTime:
+            try:
+                event, args, queuedTime = self._queue.popleft()
+            except IndexError:
+                break
+            if args is None:
+                with self._lock:
+                    event, args = self._latest.pop(event)
+            if oldest is None:
+                oldest = queuedTime
+            processed += 1
+            for handler in self._handlers.get(event, ()):
+                try:
+                    handler(*args)
+                except Exception as e:
+                    print 'EventBus._drain(): handler %s for %s failed: %s %s' % (getattr(handler, '__name__', handler), event, type(e), e)
+        self._numEvents += processed
+
+        if processed:
+            instrumentation = Instrumentation.instance()
+            instrumentation.record('EventBus.batch', time.time() - start)
+            instrumentation.record('EventBus.latency', start - oldest)
+        if len(self._queue) < self._maxQueued:
+            with self._space:
+                self._space.notify_all()
+
+        if self._queue:
+            # let the event loop paint and handle input before the next batch
+            QTimer.singleShot(0, self._drain)
+            return
+        with self._lock:
+            self._scheduled = False
+        # an event may have arrived after the queue was found empty
+        if self._queue:
+            self._schedule()
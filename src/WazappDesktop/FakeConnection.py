@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import heapq
+import random
+import shutil
+import tempfile
+import functools
+import itertools
+import threading
+
+# signals worth recording for a replay, the ones answering our own requests are produced by the fake itself
+REPLAY_SIGNALS = (
+    'message_received', 'group_messageReceived', 'group_subjectReceived',
+    'image_received', 'group_imageReceived', 'video_received', 'group_videoReceived',
+    'audio_received', 'group_audioReceived', 'location_received', 'group_locationReceived',
+    'vcard_received', 'group_vcardReceived',
+    'notification_groupParticipantAdded', 'notification_groupParticipantRemoved',
+    'notification_contactProfilePictureUpdated', 'notification_groupPictureUpdated',
+    'presence_available', 'presence_unavailable', 'presence_updated',
+    'contact_gotProfilePictureId', 'contact_gotProfilePicture',
+)
+
+def readEvents(filename):
+    # one json object per line: {"time": seconds, "signal": name, "args": [...]}
+    with open(filename, 'rb') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            yield json.loads(line)
+
+def syntheticEvents(count, numContacts=200, numGroups=20, burstSize=50, burstInterval=5.0, seed=0):
+    # chat messages, group messages and presence updates arriving in bursts, like after a reconnect
+    rnd = random.Random(seed)
+    contacts = ['49%09d@s.whatsapp.net' % i for i in range(numContacts)]
+    groups = ['49%09d-%d@g.us' % (i, 1400000000 + i) for i in range(numGroups)]
+    runId = int(time.time())
+    words = ['hello', 'where', 'are', 'you', 'see', 'www.example.com', 'tomorrow', 'ok', 'lunch', '?', 'http://example.com/a?b=c']
+    for i in range(count):
+        eventTime = (i // burstSize) * burstInterval + (i % burstSize) * 0.001
+        timestamp = runId + eventTime
+        text = ' '.join(rnd.choice(words) for j in range(rnd.randint(1, 20)))
+        messageId = 'synthetic-%d-%d' % (runId, i)
+        kind = rnd.random()
+        if kind < 0.6 or not groups:
+            event = {'signal': 'message_received', 'args': [messageId, rnd.choice(contacts), text, timestamp, True, '']}
+        elif kind < 0.85:
+            event = {'signal': 'group_messageReceived', 'args': [messageId, rnd.choice(groups), rnd.choice(contacts), text, timestamp, True, '']}
+        else:
+            event = {'signal': 'presence_updated', 'args': [rnd.choice(contacts), rnd.randint(0, 86400)]}
+        event['time'] = eventTime
+        yield event
+
+
+class EventRecorder(object):
+    # writes the signals of a real connection to a file that FakeConnectionManager can replay
+    def __init__(self, signalsInterface, filename, signals=REPLAY_SIGNALS):
+        self._lock = threading.Lock()
+        self._fp = open(filename, 'ab')
+        self._startTime = time.time()
+        for signal in signals:
+            signalsInterface.registerListener(signal, functools.partial(self._record, signal))
+
+    def _record(self, signal, *args):
+        try:
+            line = json.dumps({'time': time.time() - self._startTime, 'signal': signal, 'args': args})
+        except (TypeError, ValueError) as e:
+            print 'EventRecorder._record(): cannot record %s: %s' % (signal, e)
+            return
+        with self._lock:
+            self._fp.write(line + '\n')
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+class FakeSignalsInterface(object):
+    # same contract as the Yowsup signals interface, listeners are called from the connection thread
+    def __init__(self):
+        self._listeners = {}
+
+    def registerListener(self, signal, callback):
+        self._listeners.setdefault(signal, []).append(callback)
+
+    def send(self, signal, args=()):
+        for callback in self._listeners.get(signal, []):
+            try:
+                callback(*args)
+            except Exception as e:
+                print 'FakeSignalsInterface.send(): listener for %s failed: %s %s' % (signal, type(e), e)
+
+
+class FakeMethodsInterface(object):
+    def __init__(self, connectionManager):
+        self._connectionManager = connectionManager
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, method, params=()):
+        with self._lock:
+            self._calls[method] = self._calls.get(method, 0) + 1
+        return self._connectionManager._answer(method, params)
+
+    def getCallCounts(self):
+        with self._lock:
+            return dict(self._calls)
+
+
+class FakeConnectionManager(object):
+    # stands in for YowsupConnectionManager without any network: requests are answered like the server would,
+    # and after login an event stream is replayed at a controllable rate.
+    # rate None follows the recorded times, 0 sends as fast as possible, otherwise it is events per second
+    def __init__(self, events=(), rate=None, pictureFile=None, responseDelay=0.05):
+        self._signalsInterface = FakeSignalsInterface()
+        self._methodsInterface = FakeMethodsInterface(self)
+        self._events = iter(events)
+        self._rate = rate
+        self._pictureFile = pictureFile
+        self._responseDelay = responseDelay
+
+        self._condition = threading.Condition()
+        self._running = True
+        self._loggedIn = False
+        self._sequence = itertools.count()
+        self._messageIds = itertools.count(1)
+        self._responses = []    # heap of [dueTime, sequence, signal, args]
+        self._nextEvent = None
+        self._replayStart = None    # wall clock and recorded time of the first replayed event
+        self._recordedStart = None
+        self._lastDue = None
+        self._replayEnd = None
+        self._eventsSent = 0
+        self._responsesSent = 0
+
+        self._thread = threading.Thread(target=self._run, name='FakeConnection')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def getSignalsInterface(self):
+        return self._signalsInterface
+
+    def getMethodsInterface(self):
+        return self._methodsInterface
+
+    def setAutoPong(self, autoPong):
+        pass
+
+    def setRate(self, rate):
+        with self._condition:
+            self._rate = rate
+            self._lastDue = None
+            self._condition.notify()
+
+    def disconnect(self, reason='fake'):
+        # simulate a dropped connection, the replay pauses until the next login
+        with self._condition:
+            self._loggedIn = False
+            self._lastDue = None
+            self._schedule(0, 'disconnected', (reason,))
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def getStats(self):
+        with self._condition:
+            duration = None
+            if self._replayStart is not None:
+                duration = (self._replayEnd or time.time()) - self._replayStart
+            return {
+                'eventsSent': self._eventsSent,
+                'responsesSent': self._responsesSent,
+                'replayFinished': self._replayEnd is not None,
+                'replayDuration': duration,
+                'eventsPerSecond': self._eventsSent / duration if duration else None,
+                'calls': self._methodsInterface.getCallCounts(),
+            }
+
+    def _schedule(self, delay, signal, args):
+        heapq.heappush(self._responses, [time.time() + delay, next(self._sequence), signal, args])
+        self._condition.notify()
+
+    def _answer(self, method, params):
+        # called by the methods interface, answers arrive on the connection thread like with Yowsup
+        with self._condition:
+            if method == 'auth_login':
+                self._schedule(self._responseDelay, 'auth_success', (params[0],))
+            elif method == 'disconnect':
+                self._loggedIn = False
+                self._schedule(0, 'disconnected', ('closed',))
+            elif method == 'message_send':
+                messageId = 'fake-%d-%d' % (int(time.time()), next(self._messageIds))
+                self._schedule(self._responseDelay, 'receipt_messageSent', (params[0], messageId))
+                self._schedule(2 * self._responseDelay, 'receipt_messageDelivered', (params[0], messageId))
+                return messageId
+            elif method in ('presence_subscribe', 'presence_request'):
+                # like the server, a subscription is answered with the current presence
+                self._schedule(self._responseDelay, 'presence_updated', (params[0], 60))
+            elif method == 'picture_getIds' and self._pictureFile is not None:
+                for jid in params[0].split(','):
+                    self._schedule(self._responseDelay, 'contact_gotProfilePictureId', (jid, str(abs(hash(jid)))))
+            elif method == 'picture_get' and self._pictureFile is not None:
+                self._schedule(self._responseDelay, 'contact_gotProfilePicture', (params[0], None))
+        return None
+
+    def _eventDue(self, event, now):
+        if self._replayStart is None:
+            self._replayStart = now
+            self._recordedStart = event.get('time', 0)
+        if self._rate is None:
+            return self._replayStart + event.get('time', 0) - self._recordedStart
+        if self._rate <= 0:
+            return now
+        if self._lastDue is None:
+            self._lastDue = now - 1.0 / self._rate
+        return self._lastDue + 1.0 / self._rate
+
+    def _nextItem(self):
+        # waits for the next response or replayed event that is due, returns None when closed
+        with self._condition:
+            while self._running:
+                now = time.time()
+                if self._responses and self._responses[0][0] <= now:
+                    dueTime, sequence, signal, args = heapq.heappop(self._responses)
+                    self._responsesSent += 1
+                    if signal == 'auth_success':
+                        self._loggedIn = True
+                    return signal, args
+                waits = [self._responses[0][0] - now] if self._responses else []
+                if self._loggedIn and self._replayEnd is None:
+                    if self._nextEvent is None:
+                        self._nextEvent = next(self._events, None)
+                        if self._nextEvent is None:
+                            self._replayEnd = now
+                            print 'FakeConnectionManager: replay finished, %d events' % self._eventsSent
+                            continue
+                    due = self._eventDue(self._nextEvent, now)
+                    if due <= now:
+                        event, self._nextEvent = self._nextEvent, None
+                        self._lastDue = due
+                        self._eventsSent += 1
+                        return event['signal'], event.get('args', ())
+                    waits.append(due - now)
+                self._condition.wait(min(waits) if waits else None)
+        return None
+
+    def _run(self):
+        while True:
+            item = self._nextItem()
+            if item is None:
+                return
+            signal, args = item
+            if signal == 'contact_gotProfilePicture':
+                # the picture cache moves the file away, so every answer gets its own copy
+                if self._pictureFile is None:
+                    continue
+                fd, filename = tempfile.mkstemp(suffix=os.path.splitext(self._pictureFile)[1])
+                os.close(fd)
+                shutil.copyfile(self._pictureFile, filename)
+                args = (args[0], filename)
+            self._signalsInterface.send(signal, tuple(args))
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pprint
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from PyQt4.QtCore import QObject, QTimer, pyqtSlot as Slot
+
+from .helpers import CONFIG_PATH
+
+class Instrumentation(object):
+    # timers and counters for the hot paths, cheap enough to stay enabled.
+    # every timer keeps its newest durations in a ring buffer, percentiles are computed when asked for
+
+    @staticmethod
+    def instance():
+        return _instance
+
+    def __init__(self, numSamples=1000):
+        super(Instrumentation, self).__init__()
+        self._numSamples = numSamples
+        self._lock = threading.Lock()
+        self._samples = {}  # name -> deque of the newest durations in seconds
+        self._totals = {}   # name -> [count, total seconds] since the last reset
+        self._counters = {}
+        self._statsProviders = []   # (name, function returning a dict), for components with their own statistics
+        self._resetTime = time.time()
+
+    def record(self, name, seconds):
+        # may be called from any thread
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self._numSamples)
+                self._totals[name] = [0, 0.0]
+            samples.append(seconds)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name, increment=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def addStatsProvider(self, name, getStats):
+        self._statsProviders.append((name, getStats))
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+            self._totals = {}
+            self._counters = {}
+            self._resetTime = time.time()
+
+    def _summarize(self, samples, totals):
+        # durations in milliseconds, the percentiles cover only the newest samples
+        samples = sorted(samples)
+        percentile = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+        return {
+            'count': totals[0],
+            'mean': totals[1] / totals[0] * 1000,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': samples[-1] * 1000,
+        }
+
+    def getStats(self):
+        with self._lock:
+            timers = dict((name, self._summarize(samples, self._totals[name])) for name, samples in self._samples.iteritems())
+            counters = dict(self._counters)
+            seconds = time.time() - self._resetTime
+        stats = {'seconds': seconds, 'timers': timers, 'counters': counters}
+        for name, getStats in self._statsProviders:
+            try:
+                stats[name] = getStats()
+            except Exception as e:
+                stats[name] = 'failed: %s %s' % (type(e), e)
+        return stats
+
+    def formatReport(self):
+        stats = self.getStats()
+        lines = ['Performance over the last %.0f seconds' % stats.pop('seconds'), '']
+        lines.append('%-40s %8s %9s %9s %9s %9s %9s' % ('timer (ms)', 'count', 'mean', 'p50', 'p95', 'p99', 'max'))
+        for name, timer in sorted(stats.pop('timers').iteritems()):
+            lines.append('%-40s %8d %9.2f %9.2f %9.2f %9.2f %9.2f' % (name, timer['count'], timer['mean'], timer['p50'], timer['p95'], timer['p99'], timer['max']))
+        lines.append('')
+        lines.append('%-40s %8s' % ('counter', 'value'))
+        for name, value in sorted(stats.pop('counters').iteritems()):
+            lines.append('%-40s %8d' % (name, value))
+        for name, value in sorted(stats.iteritems()):
+            lines.append('')
+            lines.append('%s:' % name)
+            lines.append(pprint.pformat(value))
+        return '\n'.join(lines)
+
+    def dumpToFile(self, filename=None):
+        if filename is None:
+            filename = os.path.join(CONFIG_PATH, 'performance-%s.txt' % time.strftime('%Y%m%d-%H%M%S'))
+        with open(filename, 'w') as fp:
+            fp.write(self.formatReport() + '\n')
+        print 'Instrumentation.dumpToFile(): performance report written to %s' % filename
+        return filename
+
+_instance = Instrumentation()
+
+def timed(name):
+    # decorator recording the duration of every call
+    def wrapper(func):
+        @functools.wraps(func)
+        def timedFunc(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _instance.record(name, time.time() - start)
+        return timedFunc
+    return wrapper
+
+
+class EventLoopMonitor(QObject):
+    # a timer that fires late shows how long the Qt event loop was blocked
+
+    def __init__(self, interval=100):
+        super(EventLoopMonitor, self).__init__()
+        self._interval = interval / 1000.0
+        self._expected = None
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._tick)
+        self._timer.start(interval)
+
+    @Slot()
+    def _tick(self):
+        now = time.time()
+        if self._expected is not None:
+            _instance.record('eventLoop.lag', max(0.0, now - self._expected))
+        self._expected = now + self._interval
+
+    def stop(self):
+        self._timer.stop()
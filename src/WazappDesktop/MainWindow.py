@@ -1,15 +1,17 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from PyQt4.QtCore import Qt, pyqtSlot as Slot, pyqtSignal as Signal, QSettings
+from PyQt4.QtCore import Qt, pyqtSlot as Slot, pyqtSignal as Signal, QSettings, QTimer
 from PyQt4.QtGui import QMainWindow, QTabWidget
 
 from .ChatWidget import ChatWidget
 from .ContactsWidget import ContactsWidget
+from .helpers import getConfig
 
 class MainWindow(QMainWindow):
     send_message_signal = Signal(str, unicode)
     has_unread_message_signal = Signal(bool)
+    chat_visibility_changed_signal = Signal(str, bool)
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -26,12 +28,20 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(self._contactsWidget)
         self._contactsWidget.start_chat_signal.connect(self.startChat)
 
+        # restored chats start as empty docks, their web views are created when they are shown
         self._settings = QSettings('wazapp', 'wazapp-desktop')
         for conversationId in self._settings.value('mainWindow/openConversations').toStringList():
             self.getChatWidget(conversationId)
         self.restoreGeometry(self._settings.value('mainWindow/geometry').toByteArray());
         self.restoreState(self._settings.value('mainWindow/windowState').toByteArray());
 
+        # chats that were not looked at for a while give their web view memory back
+        self._unloadTimeout = getConfig('chatViewUnloadTimeout', 600)
+        self._unloadTimer = QTimer(self)
+        self._unloadTimer.timeout.connect(self.unloadIdleChats)
+        if self._unloadTimeout > 0:
+            self._unloadTimer.start(int(min(60, self._unloadTimeout) * 1000))
+
     @Slot()
     def close(self):
         self._quit = True
@@ -49,6 +59,13 @@ class MainWindow(QMainWindow):
             self.hide()
             event.ignore()
 
+    @Slot(str, int)
+    def showProgress(self, description, percent):
+        if percent < 100:
+            self.statusBar().showMessage('%s: %d%%' % (description, percent))
+        else:
+            self.statusBar().showMessage('%s: done' % description, 5000)
+
     @Slot(str)
     def startChat(self, conversationId):
         # retrieve or create dockWidget for this conversationId
@@ -56,6 +73,12 @@ class MainWindow(QMainWindow):
         # raise dockWidget in front of other dockWidgets
         dockWidget.raise_()
 
+    @Slot(str, str)
+    def showSearchResult(self, conversationId, messageId):
+        dockWidget = self.getChatWidget(conversationId)
+        dockWidget.raise_()
+        dockWidget.jumpToMessage(messageId)
+
     @Slot(str, str, float, str, str, str)
     def showMessage(self, conversationId, messageId, timestamp, sender, receiver, message):
         dockWidget = self.getChatWidget(conversationId)
@@ -74,6 +97,10 @@ class MainWindow(QMainWindow):
     def messageStatusChanged(self, conversationId, messageId, status):
         self.getChatWidget(conversationId).messageStatusChanged(conversationId, messageId, status)
 
+    @Slot(str, str, str)
+    def messageIdChanged(self, conversationId, oldId, newId):
+        self.getChatWidget(conversationId).messageIdChanged(conversationId, oldId, newId)
+
     @Slot(str, bool)
     def unreadMessage(self, conversationId, unread):
         if unread:
@@ -87,6 +114,15 @@ class MainWindow(QMainWindow):
             self.setWindowTitle(self._windowTitle)
             self.has_unread_message_signal.emit(False)
 
+    def getOpenConversations(self):
+        return self._chatWidgets.keys()
+
+    @Slot()
+    def unloadIdleChats(self):
+        for dockWidget in self._chatWidgets.values():
+            if dockWidget.isLoaded() and dockWidget.idleTime() > self._unloadTimeout:
+                dockWidget.unload()
+
     def getChatWidget(self, conversationId):
         # if no dockWidget for this conversationId exists, create a new one
         if conversationId not in self._chatWidgets:
@@ -106,6 +142,8 @@ class MainWindow(QMainWindow):
             self._chatWidgets[conversationId] = dockWidget
             dockWidget.send_message_signal.connect(self.send_message_signal)
             dockWidget.has_unread_message_signal.connect(self.unreadMessage)
+            dockWidget.show_search_result_signal.connect(self.showSearchResult)
+            dockWidget.visibility_changed_signal.connect(self.chat_visibility_changed_signal)
 
         dockWidget = self._chatWidgets[conversationId]
         dockWidget.show()
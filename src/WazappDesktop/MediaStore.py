@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import base64
+import hashlib
+import binascii
+import threading
+
+from .helpers import MEDIA_PATH, PREVIEW_REFERENCE_PREFIX
+from .Database import MessageModel, DatabaseWriter, getDatabase, getMetaData, setMetaData
+
+_previewReference = re.compile(re.escape(PREVIEW_REFERENCE_PREFIX) + '([0-9a-f]{40})')
+_inlinePreview = re.compile(r'data:image/[a-z]+;base64,([A-Za-z0-9+/=\s]+)')
+
+class MediaStore(object):
+
+    @staticmethod
+    def instance():
+        return _instance
+
+    def __init__(self):
+        super(MediaStore, self).__init__()
+        if not os.path.exists(MEDIA_PATH):
+            os.mkdir(MEDIA_PATH)
+        self._mediaUrl = 'file://%s/' % MEDIA_PATH
+
+    def _previewPath(self, contentHash):
+        return os.path.join(MEDIA_PATH, '%s.jpg' % contentHash)
+
+    def storePreview(self, previewData):
+        # save a base64 encoded preview once per content and return the reference to put in the message,
+        # or None if there is no usable preview
+        if not previewData:
+            return None
+        try:
+            data = base64.b64decode(previewData)
+        except (TypeError, binascii.Error) as e:
+            print 'MediaStore.storePreview(): could not decode preview: %s' % e
+            return None
+        if not data:
+            return None
+        contentHash = hashlib.sha1(data).hexdigest()
+        filename = self._previewPath(contentHash)
+        if not os.path.isfile(filename):
+            tempFilename = filename + '.tmp'
+            with open(tempFilename, 'wb') as fp:
+                fp.write(data)
+            os.rename(tempFilename, filename)
+        return PREVIEW_REFERENCE_PREFIX + contentHash
+
+    def resolve(self, message):
+        # turn preview references into urls the chat view loads from disk
+        if PREVIEW_REFERENCE_PREFIX not in message:
+            return message
+        return _previewReference.sub(lambda match: self._mediaUrl + match.group(1) + '.jpg', message)
+
+    def startMigration(self, force=False):
+        # move previews stored inline in old messages into the store, once
+        if not force and getMetaData('inlinePreviewsMigrated') is not None:
+            return
+        thread = threading.Thread(target=self._migrate, name='MediaStoreMigration')
+        thread.daemon = True
+        thread.start()
+
+    def _migrate(self, chunkSize=200):
+        table = MessageModel._meta.db_table
+        idColumn = MessageModel.id.db_column
+        messageColumn = MessageModel.message.db_column
+        lastId = 0
+        migrated = 0
+        while True:
+            cursor = getDatabase().execute_sql('SELECT "%s", "%s" FROM "%s" WHERE "%s" > ? AND "%s" LIKE ? ORDER BY "%s" LIMIT ?' % (
+                idColumn, messageColumn, table, idColumn, messageColumn, idColumn), (lastId, '%;base64,%', chunkSize))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            lastId = rows[-1][0]
+            updates = []
+            for messageId, message in rows:
+                # previews that can not be decoded stay inline
+                newMessage = _inlinePreview.sub(lambda match: self.storePreview(match.group(1)) or match.group(0), message)
+                if newMessage != message:
+                    updates.append((newMessage, messageId))
+            if updates:
+                DatabaseWriter.instance().call(self._updateMessages, updates)
+                migrated += len(updates)
+            # give other writes a chance in between
+            time.sleep(0.05)
+        DatabaseWriter.instance().call(setMetaData, 'inlinePreviewsMigrated', str(migrated))
+        if migrated:
+            print 'MediaStore._migrate(): moved the previews of %d messages out of the database' % migrated
+
+    def _updateMessages(self, updates):
+        database = getDatabase()
+        with database.transaction():
+            database.get_cursor().executemany('UPDATE "%s" SET "%s" = ? WHERE "%s" = ?' % (
+                MessageModel._meta.db_table, MessageModel.message.db_column, MessageModel.id.db_column), updates)
+
+
+_instance = MediaStore()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import Queue
+
+from .ContactDB import ContactDB
+
+class MessageIngestor(object):
+    def __init__(self, committedCallback, maxBatchSize=500, maxDelay=0.05, maxAttempts=3, retryDelay=0.2):
+        super(MessageIngestor, self).__init__()
+        self._committedCallback = committedCallback
+        self._maxBatchSize = maxBatchSize
+        self._maxDelay = maxDelay
+        self._maxAttempts = maxAttempts
+        self._retryDelay = retryDelay
+        self._queue = Queue.Queue()
+
+        self._statsLock = threading.Lock()
+        self._numMessages = 0
+        self._numDuplicates = 0
+        self._numFailed = 0
+        self._numRetries = 0
+        self._numBatches = 0
+        self._maxBatch = 0
+        self._commitTime = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='MessageIngestor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, conversationId, messageId, timestamp, sender, receiver, message, ack=None):
+        # ack is handed back to committedCallback once the message is stored, or found to be stored already
+        self._queue.put(((conversationId, messageId, timestamp, sender, receiver, message), ack))
+
+    def close(self):
+        # commit everything that is still queued, then stop the thread
+        self._queue.put(None)
+        self._thread.join()
+
+    def getStats(self):
+        with self._statsLock:
+            return {
+                'messages': self._numMessages,
+                'duplicates': self._numDuplicates,
+                'failed': self._numFailed,
+                'retries': self._numRetries,
+                'batches': self._numBatches,
+                'maxBatchSize': self._maxBatch,
+                'averageBatchSize': float(self._numMessages + self._numDuplicates) / self._numBatches if self._numBatches else 0.0,
+                'messagesPerSecond': self._numMessages / self._commitTime if self._commitTime > 0 else 0.0,
+            }
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            # collect more messages until the batch is full or the delay is over
+            batch = [item]
+            deadline = time.time() + self._maxDelay
+            while len(batch) < self._maxBatchSize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        start = time.time()
+        messages = [message for message, ack in batch]
+        added, failed = self._store(messages)
+        # messages that could not be stored are not acknowledged, the server sends them again
+        acks = [ack for index, (message, ack) in enumerate(batch) if ack is not None and index not in failed]
+        with self._statsLock:
+            self._commitTime += time.time() - start
+            self._numMessages += len(added)
+            self._numDuplicates += len(batch) - len(added) - len(failed)
+            self._numFailed += len(failed)
+            self._numBatches += 1
+            self._maxBatch = max(self._maxBatch, len(batch))
+        if added or acks:
+            self._committedCallback(added, acks)
+
+    def _store(self, batch):
+        # a failed batch is tried again, then message by message, so one bad message does not take the others with it.
+        # returns the added messages and the set of indexes of those that could not be stored at all
+        for attempt in range(self._maxAttempts):
+            if attempt > 0:
+                with self._statsLock:
+                    self._numRetries += 1
+                time.sleep(self._retryDelay * attempt)
+            try:
+                return ContactDB.instance().addMessages(batch), set()
+            except Exception as e:
+                print 'MessageIngestor._store(): failed to store %d messages, attempt %d: %s' % (len(batch), attempt + 1, e)
+        if len(batch) == 1:
+            print 'MessageIngestor._store(): lost message %s from %s' % (batch[0][1], batch[0][0])
+            return [], set([0])
+        added = []
+        failed = set()
+        for index, item in enumerate(batch):
+            try:
+                added.extend(ContactDB.instance().addMessages([item]))
+            except Exception as e:
+                print 'MessageIngestor._store(): lost message %s from %s: %s' % (item[1], item[0], e)
+                failed.add(index)
+        return added, failed
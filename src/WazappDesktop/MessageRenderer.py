@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+import datetime
+from collections import OrderedDict
+
+from .helpers import getConfig
+from .MediaStore import MediaStore
+
+_urlChars = r'[\w\#$%&~.\-;:=,?@\[\]+]*'
+_urlPathChars = r'[\w\#$%&~/.\-;:=,?@\[\]+]*'
+# urls with a scheme and bare www./ftp. host names are found in a single pass
+_linkPattern = re.compile(r'(^|[\n ])(?:([\w]+?://%s(?:/%s)?)|((?:www|ftp)\.%s(?:/%s)?))' % (_urlChars, _urlPathChars, _urlChars, _urlPathChars), re.IGNORECASE)
+
+def _makeLink(match):
+    prefix, url, hostUrl = match.groups()
+    if url is not None:
+        return '%s<a href="%s" target="_blank">%s</a>' % (prefix, url, url)
+    return '%s<a href="http://%s" target="_blank">%s</a>' % (prefix, hostUrl, hostUrl)
+
+def url2link(text):
+    return _linkPattern.sub(_makeLink, text)
+
+# rendered paragraphs are shared by all chat views, keyed by (messageId, contacts version, collapsed, status)
+_fragments = OrderedDict()
+_dates = {}
+
+class MessageRenderer(object):
+    # turns stored messages into html, without depending on the chat view
+    paragraphIdFormat = 'p%s'
+    dateFormat = '<p class="date">%s</p>'
+    paragraphFormat = '''
+        <p id=%(paragraphId)s class="%(status)s">
+            <span class="time">[%(formattedTime)s] </span>
+            <a href="%(senderPic)s"><img height="20px" src="%(senderThumbnail)s"></a>
+            <a href="wa:contactMenu?jid=%(senderJid)s&name=%(senderName)s" class="%(nameClass)s">%(senderDisplayName)s: </a>
+            <span class="message">%(message)s</span>
+        </p>
+    '''
+
+    def __init__(self, contacts, defaultContactPicture):
+        super(MessageRenderer, self).__init__()
+        # contacts provides getOwnJid(), getName(), getContactPicture(), getContactThumbnail() and getVersion()
+        self._contacts = contacts
+        self._ownJid = contacts.getOwnJid()
+        self._defaultContactPicture = defaultContactPicture
+        self._maxCachedFragments = getConfig('messageRendererCacheSize', 5000)
+        self._senders = {}
+        self._sendersVersion = None
+
+    def newState(self):
+        # keeps track of the date header and sender of the previous message
+        return {'lastDate': '', 'lastSender': ''}
+
+    def formatDate(self, timestamp):
+        date = timestamp.date()
+        formattedDate = _dates.get(date)
+        if formattedDate is None:
+            formattedDate = _dates[date] = timestamp.strftime('%A, %d %B %Y')
+        return formattedDate
+
+    def _getSender(self, senderJid, version):
+        if version != self._sendersVersion:
+            self._senders = {}
+            self._sendersVersion = version
+        sender = self._senders.get(senderJid)
+        if sender is not None:
+            return sender
+
+        sender = {'senderJid': senderJid}
+        sender['senderName'] = self._contacts.getName(senderJid)
+        sender['senderDisplayName'] = sender['senderName']
+
+        # the small thumbnail is shown inline, the original picture is shown on mouse over
+        senderPic = self._contacts.getContactPicture(senderJid)
+        senderThumbnail = self._contacts.getContactThumbnail(senderJid)
+        if senderPic is None:
+            senderPic = self._defaultContactPicture
+        if senderThumbnail is None:
+            senderThumbnail = senderPic
+        sender['senderPic'] = 'file://' + senderPic
+        sender['senderThumbnail'] = 'file://' + senderThumbnail
+
+        # set class for name element, depending if senderJid is in contacts and if its or own jid
+        if senderJid == sender['senderName']:
+            sender['senderDisplayName'] = sender['senderName'].split('@')[0]
+            sender['senderName'] = ''
+            sender['nameClass'] = 'unknown'
+        elif senderJid == self._ownJid:
+            sender['nameClass'] = 'myname'
+        else:
+            sender['nameClass'] = 'name'
+        self._senders[senderJid] = sender
+        return sender
+
+    def render(self, messageId, timestamp, senderJid, message, state, status=''):
+        if type(timestamp) is float:
+            timestamp = datetime.datetime.fromtimestamp(timestamp)
+        html = ''
+        formattedDate = self.formatDate(timestamp)
+        if state['lastDate'] != formattedDate:
+            state['lastDate'] = formattedDate
+            html = self.dateFormat % formattedDate
+
+        version = self._contacts.getVersion()
+        sender = self._getSender(senderJid, version)
+        # don't show sender name again, if multiple consecutive messages from one sender
+        collapsed = sender['senderDisplayName'] == state['lastSender']
+        state['lastSender'] = sender['senderDisplayName']
+
+        key = (messageId, version, collapsed, status)
+        fragment = _fragments.pop(key, None)
+        if fragment is None:
+            fragment = self._renderParagraph(messageId, timestamp, sender, message, collapsed, status)
+        _fragments[key] = fragment
+        while len(_fragments) > self._maxCachedFragments:
+            _fragments.popitem(last=False)
+        return html + fragment
+
+    def _renderParagraph(self, messageId, timestamp, sender, message, collapsed, status):
+        parameters = dict(sender)
+        if collapsed:
+            parameters['senderDisplayName'] = '...'
+        parameters['formattedTime'] = '%02d:%02d:%02d' % (timestamp.hour, timestamp.minute, timestamp.second)
+
+        message = MediaStore.instance().resolve(message)
+        # parse plain text messages for links
+        if '</a>' not in message:
+            message = url2link(message)
+        # parse plain text messages for new lines
+        if '<br>' not in message:
+            message = message.replace('\n', '<br>')
+        parameters['message'] = message
+
+        parameters['paragraphId'] = self.paragraphIdFormat % messageId
+        # own messages are marked pending, sent or delivered
+        parameters['status'] = status
+        return self.paragraphFormat % parameters
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import cgi
+import time
+import uuid
+import datetime
+import threading
+from collections import OrderedDict
+
+from PyQt4.QtCore import QObject, QTimer, pyqtSlot as Slot, pyqtSignal as Signal
+
+from .helpers import getConfig
+from .Database import MessageModel, OutboxModel, DatabaseWriter, getDatabase
+from .ContactDB import ContactDB
+
+class Outbox(QObject):
+    # outgoing messages are stored before they are sent, and stay in the outbox until the server confirms them
+    message_added_signal = Signal(str, str, float, str, str, str)
+    message_id_changed_signal = Signal(str, str, str)
+
+    def __init__(self, methodsInterface, ownJid, flushInterval=500):
+        super(Outbox, self).__init__()
+        self._methodsInterface = methodsInterface
+        self._ownJid = ownJid
+        self._retryTimeout = getConfig('outboxRetryTimeout', 30.0)
+        self._maxAttempts = getConfig('outboxMaxAttempts', 5)
+        self._online = False
+
+        # messageId -> OutboxModel in the order the messages were written, loaded once, afterwards kept in sync with the database
+        self._pending = OrderedDict((entry.messageId, entry) for entry in OutboxModel.select())
+        # every retry gets a new id from the server, receipts for an earlier attempt are applied to the message under its current id
+        self._renamedIds = {}
+
+        # receipts may come from any thread, they are written in batches
+        self._statusLock = threading.Lock()
+        self._sent = set()
+        self._delivered = set()
+        self._statusTimer = QTimer(self)
+        self._statusTimer.timeout.connect(self.flushStatuses)
+        self._statusTimer.start(flushInterval)
+
+        self._retryTimer = QTimer(self)
+        self._retryTimer.timeout.connect(self.sendPending)
+
+    def getStats(self):
+        return {'pending': len(self._pending)}
+
+    def add(self, receiver, message):
+        # store a new message and send it as soon as we are online
+        messageId = 'out-%s' % uuid.uuid4().hex
+        timestamp = time.time()
+        html = cgi.escape(message)
+        # the GUI does not wait for the write, the writer thread stores the message before anything else touches it
+        self._pending[messageId] = OutboxModel(messageId=messageId, receiver=receiver, message=message)
+        DatabaseWriter.instance().submit(self._store, receiver, messageId, timestamp, message, html)
+        self.message_added_signal.emit(receiver, messageId, timestamp, self._ownJid, receiver, html)
+        QTimer.singleShot(0, self.sendPending)
+        return messageId
+
+    def _store(self, receiver, messageId, timestamp, message, html):
+        with getDatabase().transaction():
+            ContactDB.instance()._insertMessages([(receiver, messageId, timestamp, self._ownJid, receiver, html)], isRead=True)
+            OutboxModel.insert(messageId=messageId, receiver=receiver, message=message).execute()
+
+    def setOnline(self, online):
+        self._online = online
+        if online:
+            # every login gives failed messages a new set of attempts
+            for entry in self._pending.values():
+                entry.attempts = 0
+            self.sendPending()
+            self._retryTimer.start(int(self._retryTimeout * 1000 / 2))
+        else:
+            self._retryTimer.stop()
+
+    @Slot()
+    def sendPending(self):
+        if not self._online:
+            return
+        # a receipt that already arrived must not cause another attempt
+        self.flushStatuses()
+        now = datetime.datetime.now()
+        retryAfter = datetime.timedelta(seconds=self._retryTimeout)
+        pending = OrderedDict()
+        for entry in self._pending.values():
+            if entry.attempts < self._maxAttempts and (entry.lastAttempt is None or entry.attempts == 0 or now - entry.lastAttempt >= retryAfter):
+                self._send(entry, now)
+            pending[entry.messageId] = entry
+        self._pending = pending
+
+    def _send(self, entry, now):
+        # yowsup picks the id of every message it sends, the message is renamed to it
+        oldId = entry.messageId
+        newId = self._methodsInterface.call('message_send', (entry.receiver, entry.message.encode('utf8')))
+        self._renamedIds[oldId] = newId
+        entry.messageId = newId
+        entry.attempts += 1
+        entry.lastAttempt = now
+        DatabaseWriter.instance().submit(self._renamed, oldId, newId, entry.attempts, now)
+        self.message_id_changed_signal.emit(entry.receiver, oldId, newId)
+        if entry.attempts == self._maxAttempts:
+            print 'Outbox._send(): giving up on message %s until the next login' % newId
+
+    # receipts may still arrive for an earlier attempt, this is the id the message has now, may be called from any thread
+    def currentId(self, messageId):
+        while messageId in self._renamedIds:
+            messageId = self._renamedIds[messageId]
+        return messageId
+
+    def _renamed(self, oldId, newId, attempts, lastAttempt):
+        database = getDatabase()
+        with database.transaction():
+            database.execute_sql('UPDATE "%s" SET "%s" = ? WHERE "%s" = ?' % (
+                MessageModel._meta.db_table, MessageModel.messageId.db_column, MessageModel.messageId.db_column), (newId, oldId), require_commit=False)
+            database.execute_sql('UPDATE "%s" SET "%s" = ?, "%s" = ?, "%s" = ? WHERE "%s" = ?' % (
+                OutboxModel._meta.db_table, OutboxModel.messageId.db_column, OutboxModel.attempts.db_column, OutboxModel.lastAttempt.db_column, OutboxModel.messageId.db_column),
+                (newId, attempts, OutboxModel.lastAttempt.db_value(lastAttempt), oldId), require_commit=False)
+
+    # may be called from any thread
+    def markSent(self, messageId):
+        with self._statusLock:
+            self._sent.add(messageId)
+
+    def markDelivered(self, messageId):
+        with self._statusLock:
+            self._delivered.add(messageId)
+
+    @Slot()
+    def flushStatuses(self):
+        with self._statusLock:
+            sent, self._sent = self._sent, set()
+            delivered, self._delivered = self._delivered, set()
+        if not sent and not delivered:
+            return
+        sent = set(self.currentId(messageId) for messageId in sent)
+        delivered = set(self.currentId(messageId) for messageId in delivered)
+        confirmed = [messageId for messageId in sent | delivered if self._pending.pop(messageId, None) is not None]
+        DatabaseWriter.instance().submit(self._writeStatuses, sent - delivered, delivered, confirmed)
+
+    def _writeStatuses(self, sent, delivered, confirmed):
+        table = MessageModel._meta.db_table
+        messageIdColumn = MessageModel.messageId.db_column
+        database = getDatabase()
+        with database.transaction():
+            cursor = database.get_cursor()
+            cursor.executemany('UPDATE "%s" SET "%s" = 1 WHERE "%s" = ?' % (table, MessageModel.isSent.db_column, messageIdColumn),
+                               [(messageId,) for messageId in sent])
+            cursor.executemany('UPDATE "%s" SET "%s" = 1, "%s" = 1 WHERE "%s" = ?' % (table, MessageModel.isSent.db_column, MessageModel.isDelivered.db_column, messageIdColumn),
+                               [(messageId,) for messageId in delivered])
+            cursor.executemany('DELETE FROM "%s" WHERE "%s" = ?' % (OutboxModel._meta.db_table, OutboxModel.messageId.db_column),
+                               [(messageId,) for messageId in confirmed])
+
+    def close(self):
+        self._retryTimer.stop()
+        self._statusTimer.stop()
+        self.flushStatuses()
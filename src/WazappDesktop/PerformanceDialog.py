@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+
+from PyQt4.QtCore import pyqtSlot as Slot, QDir, QTimer
+from PyQt4.QtGui import QDialog, QFont
+from PyQt4.uic import loadUi
+
+from .Instrumentation import Instrumentation
+
+class PerformanceDialog(QDialog):
+    # shows the instrumentation report, refreshed every second while open
+
+    def __init__(self, parent=None):
+        super(PerformanceDialog, self).__init__(parent)
+        loadUi(os.path.join(QDir.searchPaths('ui')[0], 'PerformanceDialog.ui'), self)
+        font = QFont('Monospace')
+        font.setStyleHint(QFont.TypeWriter)
+        self.reportView.setFont(font)
+        self._refreshTimer = QTimer(self)
+        self._refreshTimer.timeout.connect(self.refresh)
+        self._refreshTimer.start(1000)
+        self.refresh()
+
+    @Slot()
+    def refresh(self):
+        scrollBar = self.reportView.verticalScrollBar()
+        position = scrollBar.value()
+        self.reportView.setPlainText(Instrumentation.instance().formatReport())
+        scrollBar.setValue(position)
+
+    @Slot()
+    def on_resetButton_clicked(self):
+        Instrumentation.instance().reset()
+        self.refresh()
+
+    @Slot()
+    def on_saveButton_clicked(self):
+        Instrumentation.instance().dumpToFile()
+
+    def done(self, result):
+        self._refreshTimer.stop()
+        super(PerformanceDialog, self).done(result)
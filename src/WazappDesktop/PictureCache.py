@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import hashlib
+import threading
+import Queue
+
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QImage
+
+from .helpers import PICTURE_CACHE_PATH, getConfig
+from .Database import PictureModel, DatabaseWriter, getDatabase
+from .ContactDB import ContactDB
+
+ORIGINALS_PATH = os.path.join(PICTURE_CACHE_PATH, 'originals')
+THUMBNAILS_PATH = os.path.join(PICTURE_CACHE_PATH, 'thumbnails')
+THUMBNAIL_SIZE = 40
+
+class PictureCache(object):
+
+    @staticmethod
+    def instance():
+        # created on first use, so importing the module does not touch the file system
+        global _instance
+        with _instanceLock:
+            if _instance is None:
+                _instance = PictureCache()
+        return _instance
+
+    def __init__(self):
+        super(PictureCache, self).__init__()
+        for path in (ORIGINALS_PATH, THUMBNAILS_PATH):
+            if not os.path.exists(path):
+                os.mkdir(path)
+        self._maxSize = getConfig('pictureCacheSize', 50 * 1024 * 1024)
+        self._evictionInterval = 60.0
+        # pictures are stored by content hash, this maps the pictureIds of contacts to those hashes
+        self._lock = threading.RLock()
+        self._hashes = None
+        self._lastUsed = {}
+        self._hasThumbnail = {}
+        self._lastEviction = 0.0
+        # pictures from the old cache layout are imported in the background, not while rendering
+        self._legacyChecked = set()
+        self._legacyQueue = Queue.Queue()
+        self._legacyThread = None
+
+    def _originalPath(self, contentHash):
+        return os.path.join(ORIGINALS_PATH, '%s.jpeg' % contentHash)
+
+    def _thumbnailPath(self, contentHash):
+        return os.path.join(THUMBNAILS_PATH, '%s.png' % contentHash)
+
+    def _getHashes(self):
+        with self._lock:
+            if self._hashes is None:
+                self._hashes = dict((picture.pictureId, picture.contentHash) for picture in PictureModel.select())
+            return self._hashes
+
+    def _lookup(self, pictureId):
+        if pictureId is None:
+            return None
+        with self._lock:
+            contentHash = self._getHashes().get(pictureId)
+            if contentHash is None:
+                self._importLegacy(pictureId)
+                return None
+            self._lastUsed[contentHash] = time.time()
+            return contentHash
+
+    def _importLegacy(self, pictureId):
+        # look for a picture of the old cache layout once, it shows up after the import
+        if pictureId in self._legacyChecked:
+            return
+        self._legacyChecked.add(pictureId)
+        legacyFilename = '%s.jpeg' % os.path.join(PICTURE_CACHE_PATH, pictureId)
+        if not os.path.isfile(legacyFilename):
+            return
+        self._legacyQueue.put((pictureId, legacyFilename))
+        if self._legacyThread is None:
+            self._legacyThread = threading.Thread(target=self._runLegacyImport, name='PictureCacheImport')
+            self._legacyThread.daemon = True
+            self._legacyThread.start()
+
+    def _runLegacyImport(self):
+        while True:
+            pictureId, legacyFilename = self._legacyQueue.get()
+            try:
+                self.store(pictureId, legacyFilename)
+            except Exception as e:
+                print 'PictureCache._runLegacyImport(): could not import %s: %s' % (legacyFilename, e)
+
+    def getOriginal(self, pictureId):
+        contentHash = self._lookup(pictureId)
+        if contentHash is None:
+            return None
+        return self._originalPath(contentHash)
+
+    def getThumbnail(self, pictureId):
+        contentHash = self._lookup(pictureId)
+        if contentHash is None:
+            return None
+        with self._lock:
+            hasThumbnail = self._hasThumbnail.get(contentHash)
+            if hasThumbnail is None:
+                hasThumbnail = self._hasThumbnail[contentHash] = os.path.isfile(self._thumbnailPath(contentHash))
+        if not hasThumbnail:
+            # no thumbnail could be made, the original is shown scaled instead
+            return self._originalPath(contentHash)
+        return self._thumbnailPath(contentHash)
+
+    def store(self, pictureId, filename):
+        # move a downloaded picture into the cache and create its thumbnail, returns its content hash
+        with open(filename, 'rb') as fp:
+            contentHash = hashlib.sha1(fp.read()).hexdigest()
+        originalFilename = self._originalPath(contentHash)
+        if os.path.isfile(originalFilename):
+            os.remove(filename)
+        else:
+            shutil.move(filename, originalFilename)
+        thumbnailFilename = self._thumbnailPath(contentHash)
+        hasThumbnail = os.path.isfile(thumbnailFilename)
+        if not hasThumbnail:
+            image = QImage(originalFilename)
+            if image.isNull():
+                print 'PictureCache.store(): could not load picture %s for thumbnail' % originalFilename
+            else:
+                hasThumbnail = image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation).save(thumbnailFilename, 'PNG')
+                if not hasThumbnail:
+                    print 'PictureCache.store(): could not save thumbnail %s' % thumbnailFilename
+
+        with self._lock:
+            self._getHashes()[pictureId] = contentHash
+            self._lastUsed[contentHash] = time.time()
+            self._hasThumbnail[contentHash] = hasThumbnail
+        ContactDB.instance().bumpVersion()
+        DatabaseWriter.instance().submit(self._saveHash, pictureId, contentHash)
+        if time.time() - self._lastEviction > self._evictionInterval:
+            self.evict()
+        return contentHash
+
+    def _saveHash(self, pictureId, contentHash):
+        getDatabase().execute_sql('INSERT OR REPLACE INTO "%s" ("%s", "%s") VALUES (?, ?)' % (
+            PictureModel._meta.db_table, PictureModel.pictureId.db_column, PictureModel.contentHash.db_column), (pictureId, contentHash))
+
+    def _deleteHashes(self, pictureIds):
+        with getDatabase().transaction():
+            for pictureId in pictureIds:
+                PictureModel.delete().where(PictureModel.pictureId == pictureId).execute()
+
+    def evict(self):
+        # delete pictures no contact uses anymore, then the least recently used ones until the cache fits its budget
+        with self._lock:
+            self._lastEviction = time.time()
+            hashes = self._getHashes()
+            referenced = set(hashes.get(contact.pictureId) for contact in ContactDB.instance().getAll())
+
+            files = {}
+            for name in os.listdir(ORIGINALS_PATH):
+                contentHash, extension = os.path.splitext(name)
+                if extension != '.jpeg':
+                    # not a cached picture, e.g. left behind by an interrupted move
+                    strayPath = os.path.join(ORIGINALS_PATH, name)
+                    if os.path.isfile(strayPath):
+                        print 'PictureCache.evict(): removing stray file %s' % strayPath
+                        os.remove(strayPath)
+                    continue
+                paths = [self._originalPath(contentHash), self._thumbnailPath(contentHash)]
+                paths = [path for path in paths if os.path.isfile(path)]
+                if not paths:
+                    continue
+                files[contentHash] = (sum(os.path.getsize(path) for path in paths), paths)
+
+            evicted = set(contentHash for contentHash in files if contentHash not in referenced)
+            totalSize = sum(size for contentHash, (size, paths) in files.items() if contentHash not in evicted)
+            if totalSize > self._maxSize:
+                def lastUsed(contentHash):
+                    return self._lastUsed.get(contentHash) or os.path.getmtime(files[contentHash][1][0])
+                for contentHash in sorted(set(files) - evicted, key=lastUsed):
+                    if totalSize <= self._maxSize:
+                        break
+                    evicted.add(contentHash)
+                    totalSize -= files[contentHash][0]
+
+            reclaimed = 0
+            for contentHash in evicted:
+                size, paths = files[contentHash]
+                for path in paths:
+                    os.remove(path)
+                reclaimed += size
+                self._lastUsed.pop(contentHash, None)
+                self._hasThumbnail.pop(contentHash, None)
+            pictureIds = [pictureId for pictureId, contentHash in hashes.items() if contentHash in evicted or contentHash not in files]
+            for pictureId in pictureIds:
+                del hashes[pictureId]
+        if pictureIds:
+            DatabaseWriter.instance().submit(self._deleteHashes, pictureIds)
+        if evicted:
+            print 'PictureCache.evict(): removed %d pictures, reclaimed %d kB' % (len(evicted), reclaimed / 1024)
+
+
+_instance = None
+_instanceLock = threading.Lock()
@@ -1,88 +1,158 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import os
-import shutil
+import time
+import heapq
+import itertools
 import threading
 from .Events import Events
 from .Contacts import Contacts
+from .PictureCache import PictureCache
+from .helpers import getConfig
+from .Instrumentation import Instrumentation
 
 class PictureDownloader(Events):
-    def __init__(self, connectionManager, contacts):
+    def __init__(self, connectionManager, contacts, eventBus):
         super(PictureDownloader, self).__init__()
-        self._pictureRequestsLock = threading.RLock()
-        self._pictureRequests = {}
-        self.signalsInterface = connectionManager.getSignalsInterface()
+        self._maxConcurrent = getConfig('pictureMaxConcurrentRequests', 2)
+        self._requestInterval = getConfig('pictureRequestInterval', 0.2)
+        self._timeout = getConfig('pictureRequestTimeout', 2.0)
+        self._maxBackoff = 60.0
+        self._maxTimeouts = 5
+
+        # one scheduler thread works through a priority queue of picture requests
+        self._condition = threading.Condition()
+        self._running = True
+        self._sequence = itertools.count()
+        self._ready = []    # heap of [priority, sequence, jid, 'ready'], jids of visible chats come first
+        self._delayed = []  # heap of [dueTime, sequence, jid, 'delayed'], requests waiting for their backoff
+        self._queued = {}   # jid -> heap entry, entries not in here are stale
+        self._inFlight = {} # jid -> deadline
+        self._numTimeouts = {}
+        self._visible = set()
+        self._lastRequestTime = 0.0
+
         self.methodsInterface = connectionManager.getMethodsInterface()
-        for method, events in self.getEventBindings().iteritems():
-            for event in events:
-                self.signalsInterface.registerListener(event, method)
+        eventBus.register(self)
+
+        self._thread = threading.Thread(target=self._run, name='PictureDownloader')
+        self._thread.daemon = True
+        self._thread.start()
 
     def close(self):
-        with self._pictureRequestsLock:
-            for jid in self._pictureRequests.keys():
-                self._removeRequest(jid)
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def setChatVisible(self, jid, visible):
+        with self._condition:
+            if visible:
+                self._visible.add(jid)
+                # move an already queued request to the front
+                entry = self._queued.get(jid)
+                if entry is not None and entry[3] == 'ready' and entry[0] > 0:
+                    self._pushReady(jid)
+            else:
+                self._visible.discard(jid)
+
+    def _pushReady(self, jid):
+        entry = [0 if jid in self._visible else 1, next(self._sequence), jid, 'ready']
+        self._queued[jid] = entry
+        heapq.heappush(self._ready, entry)
+        self._condition.notify()
+
+    def _pushDelayed(self, jid, delay):
+        entry = [time.time() + delay, next(self._sequence), jid, 'delayed']
+        self._queued[jid] = entry
+        heapq.heappush(self._delayed, entry)
+        self._condition.notify()
 
     def _removeRequest(self, jid):
-        with self._pictureRequestsLock:
-            if jid in self._pictureRequests:
-                request = self._pictureRequests[jid]
-                if 'timer' in request:
-                    try:
-                        request['timer'].cancel()
-                        request['timer'].join()
-                    except:
-                        pass
-                if 'timeout' in request:
-                    try:
-                        request['timeout'].cancel()
-                        request['timeout'].join()
-                    except:
-                        pass
-                del self._pictureRequests[jid]
+        # returns the deadline of the request, if it was in flight
+        with self._condition:
+            self._queued.pop(jid, None)
+            deadline = self._inFlight.pop(jid, None)
+            self._numTimeouts.pop(jid, None)
+            self._condition.notify()
+        return deadline
 
     @Events.bind('contact_gotProfilePictureId')
     def onProfilePictureId(self, jid, pictureId):
         Contacts.instance().setContactPictureId(jid, pictureId)
-        pictureFilename = Contacts.instance().getContactPicture(jid)
-        if not os.path.isfile(pictureFilename):
+        if Contacts.instance().getContactPicture(jid) is None:
             #print 'onProfilePictureId(): queuing picture request for %s: %s' % (jid, pictureId)
             self._requestPicture(jid)
 
     def _requestPicture(self, jid):
-        with self._pictureRequestsLock:
-            if 'timeout' not in self._pictureRequests.get(jid, {}):
-                delay = 0.2 * len(self._pictureRequests)
-                #print 'onProfilePictureId(): requesting new picture for "%s" in %4.2fs' % (Contacts.instance().getName(jid), delay)
-                request = self._pictureRequests.get(jid, {'numTimeouts': 0})
-                request['timer'] = threading.Timer(delay, lambda: self.methodsInterface.call('picture_get', (jid,)))
-                request['timeout'] = threading.Timer(delay + 2.0 + 0.5 * request['numTimeouts'], lambda: self._requestPictureTimeout(jid))
-                self._pictureRequests[jid] = request
-                request['timer'].start()
-                request['timeout'].start()
+        with self._condition:
+            if jid not in self._queued and jid not in self._inFlight:
+                self._pushReady(jid)
 
     @Events.bind('contact_gotProfilePicture')
     def onProfilePicture(self, jid, filename):
-        self._removeRequest(jid)
+        deadline = self._removeRequest(jid)
+        if deadline is not None:
+            Instrumentation.instance().record('PictureDownloader.request', time.time() - (deadline - self._timeout))
         #print 'onProfilePicture(): %s %s' % (jid, filename)
-        pictureFilename = Contacts.instance().getContactPicture(jid)
-        if pictureFilename is not None:
-            #print 'onProfilePicture(): moving pic for "%s" pic to %s' % (Contacts.instance().getName(jid), pictureFilename)
-            shutil.move(filename, pictureFilename)
+        pictureId = Contacts.instance().getContactPictureId(jid)
+        if pictureId is not None:
+            #print 'onProfilePicture(): storing pic for "%s" as %s' % (Contacts.instance().getName(jid), pictureId)
+            PictureCache.instance().store(pictureId, filename)
         else:
             print 'onProfilePicture(): received picture for "%s" without requesting it' % (Contacts.instance().getName(jid))
 
-    def _requestPictureTimeout(self, jid):
-        with self._pictureRequestsLock:
-            if jid in self._pictureRequests:
-                numTimeouts = self._pictureRequests[jid]['numTimeouts'] + 1
-                if numTimeouts >= 5:
-                    print '_requestPictureTimeout(): pic request for "%s" timed out %d times, giving up' % (Contacts.instance().getName(jid), numTimeouts)
-                    self._removeRequest(jid)
-                    return
-                self._pictureRequests[jid]['numTimeouts'] = numTimeouts
-                del self._pictureRequests[jid]['timeout']
-                # queue picture again
-                self._requestPicture(jid)
+    def _checkTimeouts(self, now):
+        for jid, deadline in self._inFlight.items():
+            if deadline > now:
+                continue
+            del self._inFlight[jid]
+            Instrumentation.instance().count('PictureDownloader.timeouts')
+            numTimeouts = self._numTimeouts.get(jid, 0) + 1
+            if numTimeouts >= self._maxTimeouts:
+                print '_checkTimeouts(): pic request for "%s" timed out %d times, giving up' % (Contacts.instance().getName(jid), numTimeouts)
+                self._numTimeouts.pop(jid, None)
+                continue
+            self._numTimeouts[jid] = numTimeouts
+            # queue picture again, waiting twice as long after every timeout
+            self._pushDelayed(jid, min(self._maxBackoff, self._timeout * 2 ** (numTimeouts - 1)))
 
+    def _nextRequest(self, now):
+        # returns the jid to request now, or None and the time to wait for the next thing to do
+        while self._delayed and self._delayed[0][0] <= now:
+            entry = heapq.heappop(self._delayed)
+            if self._queued.get(entry[2]) is entry:
+                self._pushReady(entry[2])
 
+        waits = [deadline - now for deadline in self._inFlight.values()]
+        if self._delayed:
+            waits.append(self._delayed[0][0] - now)
+        if self._ready and len(self._inFlight) < self._maxConcurrent:
+            rateWait = self._lastRequestTime + self._requestInterval - now
+            if rateWait > 0:
+                waits.append(rateWait)
+            else:
+                while self._ready:
+                    entry = heapq.heappop(self._ready)
+                    jid = entry[2]
+                    if self._queued.get(jid) is entry:
+                        del self._queued[jid]
+                        self._inFlight[jid] = now + self._timeout
+                        self._lastRequestTime = now
+                        return jid, None
+        return None, max(0.0, min(waits)) if waits else None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.time()
+                self._checkTimeouts(now)
+                jid, wait = self._nextRequest(now)
+                if jid is None:
+                    self._condition.wait(wait)
+                    continue
+            #print '_run(): requesting new picture for "%s"' % Contacts.instance().getName(jid)
+            Instrumentation.instance().count('PictureDownloader.requests')
+            self.methodsInterface.call('picture_get', (jid,))
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from PyQt4.QtCore import QObject, QTimer, pyqtSlot as Slot
+
+from .Contacts import Contacts
+
+class PresenceAggregator(QObject):
+    def __init__(self, flushInterval=1000):
+        super(PresenceAggregator, self).__init__()
+        # latest presence state per jid, collected from the event handlers and applied once per interval
+        self._lock = threading.Lock()
+        self._available = {}
+        self._lastSeen = {}
+
+        self._flushTimer = QTimer(self)
+        self._flushTimer.timeout.connect(self.flush)
+        self._flushTimer.start(flushInterval)
+
+    def setAvailable(self, jid, available):
+        with self._lock:
+            self._available[jid] = available
+
+    def setLastSeen(self, jid, lastSeen):
+        with self._lock:
+            self._lastSeen[jid] = lastSeen
+
+    def close(self):
+        self._flushTimer.stop()
+        self.flush()
+
+    @Slot()
+    def flush(self):
+        with self._lock:
+            available, self._available = self._available, {}
+            lastSeen, self._lastSeen = self._lastSeen, {}
+        if available or lastSeen:
+            Contacts.instance().setStatuses(available, lastSeen)
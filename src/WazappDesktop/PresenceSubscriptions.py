@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import datetime
+
+from PyQt4.QtCore import QObject, QTimer, pyqtSlot as Slot
+
+from .helpers import getConfig
+from .Database import DatabaseWriter, getMetaData, setMetaData
+from .Contacts import Contacts
+from .ContactDB import ContactDB
+
+class PresenceSubscriptions(QObject):
+    # keeps the presence subscriptions and picture ids of all contacts up to date, sending only what changed.
+    # requests are queued by priority: open chats first, then recent conversations, then everybody else
+    OPEN, RECENT, OTHER = 0, 1, 2
+
+    def __init__(self, methodsInterface, getOpenConversations):
+        super(PresenceSubscriptions, self).__init__()
+        self._methodsInterface = methodsInterface
+        self._getOpenConversations = getOpenConversations
+        self._chunkSize = getConfig('pictureIdsChunkSize', 50)
+        self._requestsPerTick = getConfig('presenceRequestsPerTick', 5)
+        self._recentDays = getConfig('presenceRecentDays', 14)
+        self._online = False
+
+        # presence subscriptions only last for one connection, the checked picture ids survive restarts
+        self._subscribed = set()
+        self._picturesChecked = self._loadSet('pictureIdsChecked')
+        self._dirty = False
+
+        self._queue = []    # heap of [priority, seq, method, jids]
+        self._queued = set()    # (method, jid) pairs waiting in the queue
+        self._seq = 0
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._sendRequests)
+
+    def _loadSet(self, key):
+        value = getMetaData(key, '')
+        return set(jid for jid in value.split(',') if jid)
+
+    def _save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        DatabaseWriter.instance().submit(setMetaData, 'pictureIdsChecked', ','.join(sorted(self._picturesChecked)))
+
+    def getStats(self):
+        return {'subscribed': len(self._subscribed), 'picturesChecked': len(self._picturesChecked), 'queued': len(self._queue)}
+
+    def setOnline(self, online):
+        self._online = online
+        if online:
+            # a new connection starts without subscriptions, sync subscribes everybody again by priority
+            self._subscribed = set()
+            self.sync(refresh=True)
+        else:
+            # whatever was not sent yet is found again by the next sync
+            self._timer.stop()
+            self._queue = []
+            self._queued = set()
+            self._save()
+
+    def _priorities(self, conversationIds):
+        openConversations = set(self._getOpenConversations())
+        recent = ContactDB.instance().getRecentConversationIds(datetime.datetime.now() - datetime.timedelta(self._recentDays))
+        priorities = {}
+        for jid in conversationIds:
+            if jid in openConversations:
+                priorities[jid] = self.OPEN
+            elif jid in recent:
+                priorities[jid] = self.RECENT
+            else:
+                priorities[jid] = self.OTHER
+        return priorities
+
+    def _push(self, priority, method, jids):
+        jids = [jid for jid in jids if (method, jid) not in self._queued]
+        if not jids:
+            return
+        self._queued.update((method, jid) for jid in jids)
+        self._seq += 1
+        heapq.heappush(self._queue, [priority, self._seq, method, jids])
+
+    @Slot()
+    @Slot(str)
+    def sync(self, conversationId=None, refresh=False):
+        # queue requests for contacts that were added or removed since the last sync,
+        # after a login the picture ids of open and recent chats are refreshed too
+        if not self._online:
+            return
+        conversationIds = set(Contacts.instance().getAllConversationIds())
+        priorities = self._priorities(conversationIds)
+        byPriority = lambda jid: (priorities[jid], jid)
+
+        for jid in self._subscribed - conversationIds:
+            self._push(self.OTHER, 'presence_unsubscribe', [jid])
+        # the server answers a subscription with the current presence, it needs no extra request
+        for jid in sorted(conversationIds - self._subscribed, key=byPriority):
+            self._push(priorities[jid], 'presence_subscribe', [jid])
+
+        # picture changes are announced while we are online, changes made while we were offline are only
+        # looked up for open and recent chats
+        pictureIds = conversationIds - self._picturesChecked
+        if refresh:
+            pictureIds.update(jid for jid in conversationIds if priorities[jid] != self.OTHER)
+        pictureIds = sorted(pictureIds, key=byPriority)
+        for start in range(0, len(pictureIds), self._chunkSize):
+            chunk = pictureIds[start:start + self._chunkSize]
+            self._push(priorities[chunk[0]], 'picture_getIds', chunk)
+
+        if self._queue and not self._timer.isActive():
+            self._timer.start(200)
+
+    @Slot(str, bool)
+    def chatVisibilityChanged(self, conversationId, visible):
+        # an opened chat should show a fresh last seen time
+        if visible and self._online and conversationId in self._subscribed:
+            self._push(self.OPEN, 'presence_request', [conversationId])
+            if not self._timer.isActive():
+                self._timer.start(200)
+
+    @Slot()
+    def _sendRequests(self):
+        for i in range(self._requestsPerTick):
+            if not self._queue:
+                break
+            priority, seq, method, jids = heapq.heappop(self._queue)
+            self._queued.difference_update((method, jid) for jid in jids)
+            if method == 'picture_getIds':
+                self._methodsInterface.call(method, (','.join(jids),))
+                self._picturesChecked.update(jids)
+            else:
+                self._methodsInterface.call(method, (jids[0],))
+                if method == 'presence_subscribe':
+                    self._subscribed.add(jids[0])
+                elif method == 'presence_unsubscribe':
+                    self._subscribed.discard(jids[0])
+                    self._picturesChecked.discard(jids[0])
+            self._dirty = self._dirty or method in ('picture_getIds', 'presence_unsubscribe')
+        if not self._queue:
+            self._timer.stop()
+            self._save()
+
+    def close(self):
+        self._timer.stop()
+        self._save()
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+
+from PyQt4.QtCore import QObject, QTimer, pyqtSlot as Slot, pyqtSignal as Signal
+from PyQt4.QtNetwork import QNetworkConfigurationManager
+
+from .helpers import getConfig
+
+class ReconnectManager(QObject):
+    # connection state machine, all state changes happen on the Qt thread driven by timers
+    OFFLINE, CONNECTING, ONLINE, WAITING = 'offline', 'connecting', 'online', 'waiting'
+
+    online_signal = Signal()
+    offline_signal = Signal()
+    _disconnected_signal = Signal(str)
+    _auth_success_signal = Signal()
+    _auth_failed_signal = Signal()
+
+    def __init__(self, login):
+        super(ReconnectManager, self).__init__()
+        self._login = login
+        self._baseDelay = float(getConfig('reconnectBaseDelay', 1.0))
+        self._maxDelay = float(getConfig('reconnectMaxDelay', 300.0))
+        self._loginTimeout = float(getConfig('reconnectLoginTimeout', 30.0))
+        self._state = self.OFFLINE
+        self._failures = 0
+        self._offlineSince = time.time()
+
+        self._wasOnline = False
+        self._reconnects = 0
+        self._attempts = 0
+        self._timesToOnline = []
+
+        self._retryTimer = QTimer(self)
+        self._retryTimer.setSingleShot(True)
+        self._retryTimer.timeout.connect(self.connectNow)
+        self._loginTimer = QTimer(self)
+        self._loginTimer.setSingleShot(True)
+        self._loginTimer.timeout.connect(self._loginTimedOut)
+
+        # Yowsup calls back from its own thread, these signals move the calls to the Qt thread
+        self._disconnected_signal.connect(self._onDisconnected)
+        self._auth_success_signal.connect(self._onAuthSuccess)
+        self._auth_failed_signal.connect(self._onAuthFailed)
+
+        self._networkManager = QNetworkConfigurationManager(self)
+        self._networkManager.onlineStateChanged.connect(self._onlineStateChanged)
+
+    def getState(self):
+        return self._state
+
+    def isOnline(self):
+        return self._state == self.ONLINE
+
+    def getStats(self):
+        timesToOnline = self._timesToOnline
+        return {
+            'state': self._state,
+            'reconnects': self._reconnects,
+            'attempts': self._attempts,
+            'failures': self._failures,
+            'lastTimeToOnline': timesToOnline[-1] if timesToOnline else None,
+            'averageTimeToOnline': sum(timesToOnline) / len(timesToOnline) if timesToOnline else None,
+        }
+
+    @Slot()
+    def connectNow(self):
+        if self._state in (self.CONNECTING, self.ONLINE):
+            return
+        self._retryTimer.stop()
+        self._state = self.CONNECTING
+        self._attempts += 1
+        self._loginTimer.start(int(self._loginTimeout * 1000))
+        try:
+            if self._login() is False:
+                # nothing to retry with, e.g. the stored password is broken
+                self.stop()
+        except Exception as e:
+            print 'ReconnectManager.connectNow(): login failed: %s %s' % (type(e), e)
+            self._scheduleRetry()
+
+    def stop(self):
+        self._retryTimer.stop()
+        self._loginTimer.stop()
+        self._state = self.OFFLINE
+
+    def _nextDelay(self):
+        # exponential backoff with jitter, so clients disconnected together don't come back together
+        delay = min(self._maxDelay, self._baseDelay * 2 ** min(self._failures, 16))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _scheduleRetry(self):
+        self._loginTimer.stop()
+        delay = self._nextDelay()
+        self._failures += 1
+        self._state = self.WAITING
+        print 'ReconnectManager._scheduleRetry(): reconnecting in %.1f seconds' % delay
+        self._retryTimer.start(int(delay * 1000))
+
+    # may be called from any thread
+    def disconnected(self, reason):
+        self._disconnected_signal.emit(reason)
+
+    def authSuccess(self):
+        self._auth_success_signal.emit()
+
+    def authFailed(self):
+        self._auth_failed_signal.emit()
+
+    @Slot(str)
+    def _onDisconnected(self, reason):
+        if self._state == self.ONLINE:
+            self._offlineSince = time.time()
+            self.offline_signal.emit()
+        if self._state != self.OFFLINE:
+            self._scheduleRetry()
+
+    @Slot()
+    def _onAuthSuccess(self):
+        self._loginTimer.stop()
+        if self._state == self.ONLINE:
+            return
+        self._retryTimer.stop()
+        # the first login is measured from startup
+        self._timesToOnline = self._timesToOnline[-99:] + [time.time() - self._offlineSince]
+        if self._wasOnline:
+            self._reconnects += 1
+        self._wasOnline = True
+        self._failures = 0
+        self._state = self.ONLINE
+        self.online_signal.emit()
+
+    @Slot()
+    def _onAuthFailed(self):
+        # wrong credentials do not get better by retrying
+        self.stop()
+
+    @Slot()
+    def _loginTimedOut(self):
+        if self._state == self.CONNECTING:
+            print 'ReconnectManager._loginTimedOut(): no answer to login'
+            self._scheduleRetry()
+
+    @Slot(bool)
+    def _onlineStateChanged(self, isOnline):
+        # when the network comes back there is no point in waiting for the backoff
+        if isOnline and self._state == self.WAITING:
+            self._failures = 0
+            self.connectNow()
@@ -8,7 +8,7 @@ from PyQt4.QtCore import pyqtSlot as Slot, QDir
 from PyQt4.QtGui import QDialog, QMessageBox
 from PyQt4.uic import loadUi
 
-from .helpers import getConfig, setConfig
+from .helpers import getConfig, setConfig, flushConfig
 
 from Yowsup.Common.utilities import Utilities
 from Yowsup.Registration.v2.coderequest import WACodeRequest as WACodeRequestV2
@@ -131,4 +131,6 @@ class RegistrationDialog(QDialog):
         setConfig('countryCode', countryCode)
         setConfig('phoneNumber', phoneNumber)
         setConfig('password', password)
+        # don't wait for the delayed write, the credentials should be on disk right away
+        flushConfig()
         self.accept()
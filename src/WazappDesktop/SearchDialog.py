@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+
+from PyQt4.QtCore import pyqtSlot as Slot, pyqtSignal as Signal, QDir, QUrl
+from PyQt4.QtGui import QDialog
+from PyQt4.uic import loadUi
+
+from .Contacts import Contacts
+from .ContactDB import ContactDB
+from .Archive import MessageArchive
+
+class SearchDialog(QDialog):
+    show_search_result_signal = Signal(str, str)
+    resultFormat = '''
+        <p>
+            <a href="wa:searchResult?jid=%(conversationId)s&messageId=%(messageId)s">%(chatName)s, %(formattedTime)s%(archived)s</a><br>
+            %(senderName)s: %(snippet)s
+        </p>
+    '''
+
+    def __init__(self, conversationId, parent=None):
+        super(SearchDialog, self).__init__(parent)
+        self._conversationId = conversationId
+        loadUi(os.path.join(QDir.searchPaths('ui')[0], 'SearchDialog.ui'), self)
+        self.setWindowTitle('Search Messages in %s' % Contacts.instance().getName(conversationId))
+
+    @Slot()
+    def on_searchEdit_returnPressed(self):
+        self.search()
+
+    @Slot(bool)
+    def on_allChatsCheck_toggled(self, checked):
+        self.search()
+
+    def search(self):
+        text = self.searchEdit.text()
+        if len(text.strip()) == 0:
+            self.resultView.clear()
+            return
+        conversationId = None if self.allChatsCheck.isChecked() else self._conversationId
+        # archived messages are listed after the stored ones
+        results = ContactDB.instance().searchMessages(text, conversationId=conversationId)
+        results += MessageArchive.instance().searchMessages(text, conversationId=conversationId)
+        html = []
+        for result in results:
+            parameters = dict(result)
+            parameters['chatName'] = Contacts.instance().getName(result['conversationId'])
+            parameters['senderName'] = Contacts.instance().getName(result['sender'])
+            parameters['formattedTime'] = result['timestamp'].strftime('%d-%m-%Y %H:%M')
+            parameters['archived'] = ' (archived)' if result.get('archived') else ''
+            html.append(self.resultFormat % parameters)
+        if not html:
+            html.append('<p>No messages found.</p>')
+        self.resultView.setHtml(''.join(html))
+
+    @Slot(QUrl)
+    def on_resultView_anchorClicked(self, url):
+        parameters = dict(url.queryItems())
+        self.show_search_result_signal.emit(parameters['jid'], parameters['messageId'])
@@ -3,31 +3,41 @@
 
 import time
 import datetime
+import threading
 import base64
 import cgi
 
-from PyQt4.QtCore import pyqtSlot as Slot, pyqtSignal as Signal, QObject
+from PyQt4.QtCore import pyqtSlot as Slot, pyqtSignal as Signal, QObject, QTimer
 
 from .MainWindow import MainWindow
 from .SystemTrayIcon import SystemTrayIcon
 from .Contacts import Contacts
+from .helpers import makeHtmlImageLink, getConfig, getOwnPhone
+from .Events import Events, EventBus
+from .MessageIngestor import MessageIngestor
+from .PresenceAggregator import PresenceAggregator
+from .Database import DatabaseWriter, legacyConversionNeeded, convertLegacyDatabases
 from .ContactDB import ContactDB
-from .helpers import makeHtmlImageLink, getConfig
-from .Events import Events
-from .PictureDownloader import PictureDownloader
-
-from Yowsup.connectionmanager import YowsupConnectionManager
+from .MediaStore import MediaStore
+from .ReconnectManager import ReconnectManager
+from .PresenceSubscriptions import PresenceSubscriptions
+from .Outbox import Outbox
+from .Archive import Retention
+from .Instrumentation import Instrumentation, EventLoopMonitor, timed
 
 class WazappDesktop(QObject, Events):
     show_message_signal = Signal(str, str, float, str, str, str)
     status_changed_signal = Signal(bool, bool)
     message_status_changed_signal = Signal(str, str, str)
+    progress_signal = Signal(str, int)
+    _acks_signal = Signal(list)
 
-    def __init__(self):
+    def __init__(self, connectionManager=None):
         super(WazappDesktop, self).__init__()
-        Contacts.instance().contacts_updated_signal.connect(self.checkPresence)
-
-        connectionManager = YowsupConnectionManager()
+        # anything with the signals and methods interfaces of Yowsup will do, e.g. a FakeConnectionManager
+        if connectionManager is None:
+            from Yowsup.connectionmanager import YowsupConnectionManager
+            connectionManager = YowsupConnectionManager()
         connectionManager.setAutoPong(True)
         self.signalsInterface = connectionManager.getSignalsInterface()
         self.methodsInterface = connectionManager.getMethodsInterface()
@@ -48,32 +58,132 @@ class WazappDesktop(QObject, Events):
 
         self.show_message_signal.connect(self._mainWindow.showMessage)
         self.message_status_changed_signal.connect(self._mainWindow.messageStatusChanged)
-
-        self._ownJid = Contacts.instance().phoneToConversationId(getConfig('countryCode') + getConfig('phoneNumber'))
-
-        self._pictureDownloader = PictureDownloader(connectionManager, Contacts.instance())
-
-        for method, events in self.getEventBindings().iteritems():
-            for event in events:
-                self.signalsInterface.registerListener(event, method)
+        self.progress_signal.connect(self._mainWindow.showProgress)
+
+        self._ownJid = Contacts.instance().getOwnJid()
+
+        # the picture downloader is only needed once we are logged in
+        self._connectionManager = connectionManager
+        self._pictureDownloader = None
+        self._messageIngestor = MessageIngestor(self._messagesCommitted)
+        self._acks_signal.connect(self._sendAcks)
+        self._presenceAggregator = PresenceAggregator()
+        ContactDB.instance().startSearchIndexBackfill()
+
+        self._reconnectManager = ReconnectManager(self._login)
+        self._reconnectManager.online_signal.connect(self._resync)
+        self._reconnectManager.offline_signal.connect(self._wentOffline)
+        # presence subscriptions and picture ids are only requested for contacts that changed
+        self._presenceSubscriptions = PresenceSubscriptions(self.methodsInterface, self._mainWindow.getOpenConversations)
+        Contacts.instance().contacts_updated_signal.connect(self._presenceSubscriptions.sync)
+        Contacts.instance().contact_added_signal.connect(self._presenceSubscriptions.sync)
+        Contacts.instance().contact_removed_signal.connect(self._presenceSubscriptions.sync)
+        self._mainWindow.chat_visibility_changed_signal.connect(self._presenceSubscriptions.chatVisibilityChanged)
+        # outgoing messages are stored first and sent whenever we are online
+        self._outbox = Outbox(self.methodsInterface, self._ownJid)
+        self._outbox.message_added_signal.connect(self.show_message_signal)
+        self._outbox.message_id_changed_signal.connect(self._mainWindow.messageIdChanged)
+
+        # Yowsup calls back from its network thread, the event bus runs the handlers on the Qt thread
+        self._eventBus = EventBus(self.signalsInterface)
+        self._eventBus.register(self)
+
+        # old messages are moved to the archive and the database file is compacted while nothing else happens
+        self._retention = Retention(self._isIdle)
+        self._retention.start()
+
+        # statistics shown in the performance report next to the timers
+        self._eventLoopMonitor = EventLoopMonitor()
+        instrumentation = Instrumentation.instance()
+        instrumentation.addStatsProvider('connection', self._reconnectManager.getStats)
+        instrumentation.addStatsProvider('ingestor', self._messageIngestor.getStats)
+        instrumentation.addStatsProvider('presenceSubscriptions', self._presenceSubscriptions.getStats)
+        instrumentation.addStatsProvider('outbox', self._outbox.getStats)
+        instrumentation.addStatsProvider('contactCache', ContactDB.instance().getCacheStats)
+        instrumentation.addStatsProvider('databaseWriter', DatabaseWriter.instance().getStats)
+        instrumentation.addStatsProvider('eventBus', self._eventBus.getStats)
+        instrumentation.addStatsProvider('retention', self._retention.getStats)
+        if hasattr(connectionManager, 'getStats'):
+            instrumentation.addStatsProvider('replay', connectionManager.getStats)
 
         self.setOnline(False)
-        self._login()
+        # let the main window show up before connecting
+        QTimer.singleShot(0, self._reconnectManager.connectNow)
+        # imported logs may contain inline previews too, so the migration waits for the import
+        if legacyConversionNeeded():
+            QTimer.singleShot(0, self._startLegacyImport)
+        else:
+            MediaStore.instance().startMigration()
 
     @Slot()
     def close(self):
-        self._pictureDownloader.close()
+        self._eventLoopMonitor.stop()
+        self._eventBus.close()
+        self._retention.close()
+        self._reconnectManager.stop()
+        self._presenceSubscriptions.close()
+        self._outbox.close()
+        if self._pictureDownloader is not None:
+            self._pictureDownloader.close()
+        self._messageIngestor.close()
+        self._presenceAggregator.close()
+        DatabaseWriter.instance().flush()
         self.methodsInterface.call('presence_sendUnavailable')
 
+    def _isIdle(self):
+        # may be called from any thread
+        return self._eventBus.getStats()['queued'] == 0 and DatabaseWriter.instance().getStats()['queued'] == 0
+
+    def _getPictureDownloader(self):
+        if self._pictureDownloader is None:
+            from .PictureDownloader import PictureDownloader
+            self._pictureDownloader = PictureDownloader(self._connectionManager, Contacts.instance(), self._eventBus)
+            self._mainWindow.chat_visibility_changed_signal.connect(self._pictureDownloader.setChatVisible)
+        return self._pictureDownloader
+
+    def _startLegacyImport(self):
+        # the import is resumable, so it may run in the background and be interrupted by quitting
+        thread = threading.Thread(target=self._importLegacyDatabases, name='LegacyImport')
+        thread.daemon = True
+        thread.start()
+
+    def _importLegacyDatabases(self):
+        description = 'Importing old chat history'
+        def progress(filename, bytesDone, bytesTotal):
+            self.progress_signal.emit(description, min(99, 100 * bytesDone / max(1, bytesTotal)))
+        try:
+            convertLegacyDatabases(progress)
+        except Exception as e:
+            print 'WazappDesktop._importLegacyDatabases(): import failed, it will be continued on next start: %s %s' % (type(e), e)
+            return
+        self.progress_signal.emit(description, 100)
+        MediaStore.instance().startMigration(force=True)
+        Contacts.instance().contacts_updated_signal.emit()
+
     def _login(self):
-        self.username = getConfig('countryCode') + getConfig('phoneNumber')
+        self.username = getOwnPhone()
         try:
-            password = base64.b64decode(getConfig('password'))
+            password = base64.b64decode(getConfig('password', ''))
         except TypeError as e:
             print 'cannot login: error using stored password: %s' % e
-            return
+            return False
         self.methodsInterface.call('auth_login', (self.username, password))
 
+    @Slot()
+    def _wentOffline(self):
+        self._presenceSubscriptions.setOnline(False)
+        self._outbox.setOnline(False)
+
+    def getConnectionStats(self):
+        return self._reconnectManager.getStats()
+
+    @Slot()
+    def _resync(self):
+        # runs on the Qt thread after every successful login
+        self._getPictureDownloader()
+        self._presenceSubscriptions.setOnline(True)
+        self._outbox.setOnline(True)
+
     @Slot(bool)
     def unreadMessage(self, unread):
         self._hasUnreadMessage = unread
@@ -87,14 +197,8 @@ class WazappDesktop(QObject, Events):
     def toggleMainWindow(self):
         self._mainWindow.setVisible(not self._mainWindow.isVisible())
 
-    @Slot()
-    def checkPresence(self):
-        conversationIds = Contacts.instance().getAllConversationIds()
-        self.methodsInterface.call('picture_getIds', (','.join(conversationIds),))
-        for jid in conversationIds:
-            self.methodsInterface.call('presence_request', (jid,))
-
-    def handleMessage(self, messageId, timestamp, sender, receiver, message):
+    @timed('WazappDesktop.handleMessage')
+    def handleMessage(self, messageId, timestamp, sender, receiver, message, ack=None):
         if receiver == self._ownJid:
             conversationId = sender
         else:
@@ -102,14 +206,25 @@ class WazappDesktop(QObject, Events):
         if type(message) is str:
             message = message.decode('utf8')
         #self._out('%s -> %s: %s' % (Contacts.instance().getName(sender), Contacts.instance().getName(receiver), message), timestamp=timestamp, logId=conversationId)
-        messageId = ContactDB.instance().addMessage(conversationId, messageId, timestamp, sender, receiver, message)
-        if messageId is not None:
+        # the receipt is only sent once the message is in the database, the server sends it again otherwise
+        self._messageIngestor.add(conversationId, messageId, timestamp, sender, receiver, message, ack)
+
+    def _messagesCommitted(self, messages, acks):
+        # called from the ingestor thread, once a batch of new messages is in the database
+        for conversationId, messageId, timestamp, sender, receiver, message in messages:
             self.show_message_signal.emit(conversationId, messageId, timestamp, sender, receiver, message)
+        if acks:
+            self._acks_signal.emit(acks)
+
+    @Slot(list)
+    def _sendAcks(self, acks):
+        # yowsup is only called from the Qt thread
+        for method, args in acks:
+            self.methodsInterface.call(method, args)
 
     @Slot(str, unicode)
     def do_send(self, receiver, message):
-        messageId = self.methodsInterface.call('message_send', (receiver, message.encode('utf8')))
-        self.handleMessage(messageId, time.time(), self._ownJid, receiver, cgi.escape(message))
+        self._outbox.add(receiver, message)
 
     def _out(self, message, timestamp=None, logId='system'):
         if timestamp is None:
@@ -138,25 +253,23 @@ class WazappDesktop(QObject, Events):
 
     @Events.bind('message_received')
     def onMessageReceived(self, messageId, jid, messageContent, timestamp, wantsReceipt, pushName):
-        self.handleMessage(messageId, timestamp, jid, self._ownJid, cgi.escape(messageContent))
-        if wantsReceipt:
-            self.methodsInterface.call('message_ack', (jid, messageId))
+        self.handleMessage(messageId, timestamp, jid, self._ownJid, cgi.escape(messageContent), ack=('message_ack', (jid, messageId)) if wantsReceipt else None)
 
     @Events.bind('group_messageReceived')
     def onGroupMessageReceived(self, messageId, groupJid, author, messageContent, timestamp, wantsReceipt, pushName):
-        self.handleMessage(messageId, timestamp, author, groupJid, cgi.escape(messageContent))
-        if wantsReceipt:
-            self.methodsInterface.call('message_ack', (groupJid, messageId))
+        self.handleMessage(messageId, timestamp, author, groupJid, cgi.escape(messageContent), ack=('message_ack', (groupJid, messageId)) if wantsReceipt else None)
 
     @Events.bind('receipt_messageSent')
     def onMessageSent(self, jid, messageId):
         #print 'onMessageSent():', jid, messageId
-        self.message_status_changed_signal.emit(jid, messageId, 'sent')
+        self._outbox.markSent(messageId)
+        self.message_status_changed_signal.emit(jid, self._outbox.currentId(messageId), 'sent')
 
     @Events.bind('receipt_messageDelivered')
     def onMessageDelivered(self, jid, messageId):
         #print 'onMessageDelivered():', jid, messageId
-        self.message_status_changed_signal.emit(jid, messageId, 'delivered')
+        self._outbox.markDelivered(messageId)
+        self.message_status_changed_signal.emit(jid, self._outbox.currentId(messageId), 'delivered')
 
     @Events.bind('group_gotInfo')
     def onGroupInfo(self, groupJid, owner, subject, subjectOwner, subjectTimestamp, creationTimestamp):
@@ -175,9 +288,7 @@ class WazappDesktop(QObject, Events):
 
     @Events.bind('group_subjectReceived')
     def onGroupSubjectReceived(self, messageId, groupJid, author, subject, timestamp, wantsReceipt):
-        self.handleMessage(messageId, timestamp, author, groupJid, 'changed group subject to: "%s"' % subject)
-        if wantsReceipt:
-            self.methodsInterface.call('subject_ack', (groupJid, messageId))
+        self.handleMessage(messageId, timestamp, author, groupJid, 'changed group subject to: "%s"' % subject, ack=('subject_ack', (groupJid, messageId)) if wantsReceipt else None)
 
     @Events.bind('group_gotParticipants')
     def onGroupGotParticipants(self, groupJid, participants):
@@ -192,10 +303,15 @@ class WazappDesktop(QObject, Events):
     def onGroupImageReceived(self, messageId, groupJid, timestamp, author, preview, url, size, receiptRequested):
         self.handleImageReceived(messageId, timestamp, author, groupJid, groupJid, preview, url, size, receiptRequested)
 
+    def _makePreviewLink(self, preview, url):
+        # media without a preview is shown as a plain url, like audio recordings
+        previewReference = MediaStore.instance().storePreview(preview)
+        if previewReference is None:
+            return url
+        return makeHtmlImageLink(previewReference, url)
+
     def handleImageReceived(self, messageId, timestamp, sender, receiver, ack, preview, url, size, receiptRequested):
-        self.handleMessage(messageId, timestamp, sender, receiver, 'sent an image:<br>%s' % makeHtmlImageLink(preview, url))
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (ack, messageId))
+        self.handleMessage(messageId, timestamp, sender, receiver, 'sent an image:<br>%s' % self._makePreviewLink(preview, url), ack=('notification_ack', (ack, messageId)) if receiptRequested else None)
 
 
     @Events.bind('video_received')
@@ -207,9 +323,7 @@ class WazappDesktop(QObject, Events):
         self.handleVideoReceived(messageId, timestamp, author, groupJid, groupJid, preview, url, size, receiptRequested)
 
     def handleVideoReceived(self, messageId, timestamp, sender, receiver, ack, preview, url, size, receiptRequested):
-        self.handleMessage(messageId, timestamp, sender, receiver, 'sent a video: %s' % makeHtmlImageLink(preview, url))
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (ack, messageId))
+        self.handleMessage(messageId, timestamp, sender, receiver, 'sent a video: %s' % self._makePreviewLink(preview, url), ack=('notification_ack', (ack, messageId)) if receiptRequested else None)
 
 
     @Events.bind('audio_received')
@@ -221,9 +335,7 @@ class WazappDesktop(QObject, Events):
         self.handleAudioReceived(messageId, timestamp, author, groupJid, groupJid, url, size, receiptRequested)
 
     def handleAudioReceived(self, messageId, timestamp, sender, receiver, ack, url, size, receiptRequested):
-        self.handleMessage(messageId, timestamp, sender, receiver, 'sent an audio recording: %s' % url)
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (ack, messageId))
+        self.handleMessage(messageId, timestamp, sender, receiver, 'sent an audio recording: %s' % url, ack=('notification_ack', (ack, messageId)) if receiptRequested else None)
 
 
     @Events.bind('location_received')
@@ -235,9 +347,7 @@ class WazappDesktop(QObject, Events):
         self.handleLocationReceived(messageId, timestamp, author, groupJid, groupJid, name, preview, latitude, longitude, receiptRequested)
 
     def handleLocationReceived(self, messageId, timestamp, sender, receiver, ack, name, preview, latitude, longitude, receiptRequested):
-        self.handleMessage(messageId, timestamp, sender, receiver, 'sent a location: "%s" (lat: %f, long: %f)' % (name, latitude, longitude))
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (ack, messageId))
+        self.handleMessage(messageId, timestamp, sender, receiver, 'sent a location: "%s" (lat: %f, long: %f)' % (name, latitude, longitude), ack=('notification_ack', (ack, messageId)) if receiptRequested else None)
 
 
     @Events.bind('vcard_received')
@@ -249,22 +359,16 @@ class WazappDesktop(QObject, Events):
         self.handleVCardReceived(messageId, timestamp, author, groupJid, groupJid, name, data, receiptRequested)
 
     def handleVCardReceived(self, messageId, timestamp, sender, receiver, ack, name, data, receiptRequested):
-        self.handleMessage(messageId, timestamp, sender, receiver, 'sent a business card: "%s"\n%s' % (name, data))
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (ack, messageId))
+        self.handleMessage(messageId, timestamp, sender, receiver, 'sent a business card: "%s"\n%s' % (name, data), ack=('notification_ack', (ack, messageId)) if receiptRequested else None)
 
 
     @Events.bind('notification_groupParticipantAdded')
     def onGroupParticipantAdded(self, groupJid, jid, author, timestamp, messageId, receiptRequested):
-        self.handleMessage(messageId, timestamp, author, groupJid, 'added group member: "%s"' % (jid))
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (groupJid, messageId))
+        self.handleMessage(messageId, timestamp, author, groupJid, 'added group member: "%s"' % (jid), ack=('notification_ack', (groupJid, messageId)) if receiptRequested else None)
 
     @Events.bind('notification_groupParticipantRemoved')
     def onGroupParticipantRemoved(self, groupJid, jid, author, timestamp, messageId, receiptRequested):
-        self.handleMessage(messageId, timestamp, author, groupJid, 'removed group member: "%s"' % (jid))
-        if receiptRequested:
-            self.methodsInterface.call('notification_ack', (groupJid, messageId))
+        self.handleMessage(messageId, timestamp, author, groupJid, 'removed group member: "%s"' % (jid), ack=('notification_ack', (groupJid, messageId)) if receiptRequested else None)
 
     @Events.bind('notification_contactProfilePictureUpdated')
     def onContactProfilePictureUpdated(self, jid, timestamp, messageId, receiptRequested):
@@ -286,35 +390,33 @@ class WazappDesktop(QObject, Events):
         self.setOnline(True)
         self.methodsInterface.call('ready')
         self.methodsInterface.call('presence_sendAvailable')
-        self.checkPresence()
+        self._reconnectManager.authSuccess()
 
     @Events.bind('auth_fail')
     def onAuthFailed(self, username, err):
         self._out('Auth Failed!')
         self.setOnline(False)
+        self._reconnectManager.authFailed()
 
     @Events.bind('disconnected')
     def onDisconnected(self, reason):
         self._out('Disconnected because %s' % reason)
         self.setOnline(False)
-        time.sleep(1)
-        try:
-            self._login()
-        except:
-            pass
+        # the reconnect manager retries with backoff on the Qt thread
+        self._reconnectManager.disconnected(reason)
 
     @Events.bind('presence_available')
     def onPresenceAvailable(self, jid):
         #self._out('%s is now available' % Contacts.instance().getName(jid))
-        Contacts.instance().setAvailable(jid, True)
-        Contacts.instance().setLastSeen(jid, time.time())
+        self._presenceAggregator.setAvailable(jid, True)
+        self._presenceAggregator.setLastSeen(jid, time.time())
 
     @Events.bind('presence_unavailable')
     def onPresenceUnavailable(self, jid):
         #self._out('%s is now unavailable' % Contacts.instance().getName(jid))
-        Contacts.instance().setAvailable(jid, False)
+        self._presenceAggregator.setAvailable(jid, False)
 
     @Events.bind('presence_updated')
     def onPresenceUpdated(self, jid, lastseen):
         #self._out('%s was last seen %s seconds ago' % (Contacts.instance().getName(jid), lastseen), logId=jid)
-        Contacts.instance().setLastSeen(jid, time.time() - lastseen)
+        self._presenceAggregator.setLastSeen(jid, time.time() - lastseen)
@@ -2,18 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import os
+import ast
 import sys
+import time
 import pprint
+import atexit
 import base64
+import importlib
+import threading
+from contextlib import contextmanager
 
-CONFIG_PATH = os.path.expanduser(os.path.join('~', '.config', 'wazapp'))
+# WAZAPP_CONFIG_PATH points everything at another directory, e.g. for benchmarks on synthetic data
+CONFIG_PATH = os.environ.get('WAZAPP_CONFIG_PATH') or os.path.expanduser(os.path.join('~', '.config', 'wazapp'))
 CONFIG_FILE = os.path.join(CONFIG_PATH, 'config.conf')
 CONTACTS_FILE = os.path.join(CONFIG_PATH, 'contacts.conf')
 DATABASE_FILE = os.path.join(CONFIG_PATH, 'wazapp-desktop.db')
+# messages past their retention time are moved here
+ARCHIVE_FILE = os.path.join(CONFIG_PATH, 'wazapp-archive.db')
 LOG_FILE_TEMPLATE = os.path.join(CONFIG_PATH, 'chat_%s.log')
 PICTURE_CACHE_PATH = os.path.join(CONFIG_PATH, 'pics')
+MEDIA_PATH = os.path.join(CONFIG_PATH, 'media')
+# messages refer to previews in the MediaStore by content hash
+PREVIEW_REFERENCE_PREFIX = 'wa-preview:'
 if not os.path.exists(PICTURE_CACHE_PATH):
-    os.mkdir(PICTURE_CACHE_PATH)
+    os.makedirs(PICTURE_CACHE_PATH)
 
 def checkForYowsup():
     return checkForModule('Yowsup', 'https://github.com/DorianScholz/yowsup/archive/master.zip', CONFIG_PATH, os.path.join('yowsup-master', 'src'))
@@ -22,11 +34,10 @@ def checkForPeewee():
     return checkForModule('peewee', 'https://github.com/coleifer/peewee/archive/2.0.7.zip', CONFIG_PATH, 'peewee-2.0.7')
 
 def checkForModule(moduleName, downloadUrl, extractPath, importSubPath):
-    import imp
     sys.path.append(os.path.join(extractPath, importSubPath))
     try:
-        module = imp.load_module(moduleName, *imp.find_module(moduleName))
-    except:
+        module = importlib.import_module(moduleName)
+    except ImportError:
         print 'Importing %s failed, downloading from: %s' % (moduleName, downloadUrl)
         try:
             # download and extract zip file
@@ -42,7 +53,7 @@ def checkForModule(moduleName, downloadUrl, extractPath, importSubPath):
             online_file.close()
 
             # try import again
-            module = imp.load_module(moduleName, *imp.find_module(moduleName))
+            module = importlib.import_module(moduleName)
 
         except Exception as e:
             print 'Could not download or extract %s: %s %s' % (moduleName, type(e), str(e))
@@ -52,27 +63,60 @@ def checkForModule(moduleName, downloadUrl, extractPath, importSubPath):
     return module
 
 
+class StartupProfiler(object):
+    def __init__(self, enabled=False):
+        super(StartupProfiler, self).__init__()
+        self._enabled = enabled
+        self._start = time.time()
+        self._phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addPhase(name, time.time() - start)
+
+    def addPhase(self, name, duration):
+        self._phases.append((name, duration))
+
+    def printReport(self):
+        if not self._enabled:
+            return
+        print 'Startup profile:'
+        for name, duration in self._phases:
+            print '  %-30s %8.1f ms' % (name, duration * 1000)
+        print '  %-30s %8.1f ms' % ('total', (time.time() - self._start) * 1000)
+
+
 def readObjectFromFile(path):
     with open(path) as fp:
         try:
-            obj =  eval(fp.read())
+            # only python literals are accepted, the files are written by pprint
+            obj = ast.literal_eval(fp.read())
         except Exception as e:
             print 'readObjectFromFile(): failed loading object from file "%s":\n%s' % (path, e)
             return None
         return obj
 
 def writeObjectToFile(path, data):
-    with open(path, 'w') as fp:
+    # write to a temporary file first and rename it, so a crash never leaves a half written file behind
+    tempPath = path + '.tmp'
+    with open(tempPath, 'w') as fp:
         pprint.pprint(data, stream=fp, indent=4)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tempPath, path)
 
-def makeHtmlInlineImage(imageData):
-    return '<img alt="Preview Image" src="data:image/png;base64,%s" />' % imageData
+def makeHtmlPreviewImage(previewReference):
+    return '<img alt="Preview Image" src="%s" />' % previewReference
 
 def makeHtmlLink(text, url):
     return '<a href="%s">%s</a>' % (url, text)
 
-def makeHtmlImageLink(imageData, url):
-    image = makeHtmlInlineImage(imageData)
+def makeHtmlImageLink(previewReference, url):
+    image = makeHtmlPreviewImage(previewReference)
     return makeHtmlLink(image, url)
 
 def isAccountConfigured():
@@ -85,26 +129,62 @@ def isAccountConfigured():
         return False
     return None not in (getConfig('countryCode'), getConfig('phoneNumber'))
 
+CONFIG_WRITE_DELAY = 1.0
+
 __config = None
+__derivedConfig = {}
+__configLock = threading.RLock()
+__configWriteTimer = None
 
-def _overwriteConfig(config):
-    global __config, CONFIG_PATH
-    __config = config
-    if not os.path.exists(CONFIG_PATH):
-        os.mkdir(CONFIG_PATH)
-    writeObjectToFile(CONFIG_FILE, __config)
+def _loadConfig():
+    global __config
+    with __configLock:
+        if __config is None:
+            try:
+                __config = readObjectFromFile(CONFIG_FILE)
+            except IOError:
+                __config = None
+            if not isinstance(__config, dict):
+                __config = {}
+        return __config
 
 def getConfig(key, default=None):
-    global __config
-    if __config is None:
-        try:
-            __config = readObjectFromFile(CONFIG_FILE)
-        except IOError:
-            __config = {}
-    return __config.get(key, default)
+    config = __config if __config is not None else _loadConfig()
+    return config.get(key, default)
 
 def setConfig(key, value):
-    global __config
-    getConfig(key)
-    __config[key] = value
-    _overwriteConfig(__config)
+    global __configWriteTimer
+    with __configLock:
+        config = _loadConfig()
+        if key in config and config[key] == value:
+            return
+        config[key] = value
+        __derivedConfig.clear()
+        # bursts of changes end up in one write
+        if __configWriteTimer is None:
+            __configWriteTimer = threading.Timer(CONFIG_WRITE_DELAY, flushConfig)
+            __configWriteTimer.daemon = True
+            __configWriteTimer.start()
+
+def flushConfig():
+    global __configWriteTimer
+    with __configLock:
+        if __configWriteTimer is None:
+            return
+        __configWriteTimer.cancel()
+        __configWriteTimer = None
+        if not os.path.exists(CONFIG_PATH):
+            os.mkdir(CONFIG_PATH)
+        writeObjectToFile(CONFIG_FILE, __config)
+
+atexit.register(flushConfig)
+
+def cachedConfigValue(name, compute):
+    # values derived from the config are computed once, until the config changes
+    with __configLock:
+        if name not in __derivedConfig:
+            __derivedConfig[name] = compute()
+        return __derivedConfig[name]
+
+def getOwnPhone():
+    return cachedConfigValue('ownPhone', lambda: getConfig('countryCode', '') + getConfig('phoneNumber', ''))
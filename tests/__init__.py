@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import atexit
+import tempfile
+
+base_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# the tests run on their own config directory, it must be set before anything from WazappDesktop is imported
+dataDir = tempfile.mkdtemp(prefix='wazapp-tests-')
+atexit.register(shutil.rmtree, dataDir, True)
+os.environ['WAZAPP_CONFIG_PATH'] = dataDir
+sys.path.insert(0, os.path.join(base_dir, 'src'))
+# reuse the libraries downloaded by a normal installation
+defaultConfigPath = os.path.expanduser(os.path.join('~', '.config', 'wazapp'))
+sys.path.append(os.path.join(defaultConfigPath, 'peewee-2.0.7'))
+
+def resetDatabase():
+    # start every test with empty tables, written through the writer thread like everything else
+    from WazappDesktop.Database import initDatabase, DatabaseWriter, ContactModel, MessageModel, OutboxModel
+    from WazappDesktop.ContactDB import ContactDB
+    initDatabase()
+    def clear():
+        for model in (MessageModel, OutboxModel, ContactModel):
+            model.delete().execute()
+    DatabaseWriter.instance().call(clear)
+    ContactDB.instance().invalidate()
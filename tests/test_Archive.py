@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import datetime
+import unittest
+
+from . import resetDatabase
+from WazappDesktop.Database import MessageModel, OutboxModel, DatabaseWriter
+from WazappDesktop.ContactDB import ContactDB
+from WazappDesktop.Archive import MessageArchive, Retention, ARCHIVE_TABLE, ARCHIVE_SEARCH_TABLE
+
+def clearArchive():
+    archive = MessageArchive.instance()
+    def drop():
+        for table in (ARCHIVE_SEARCH_TABLE, ARCHIVE_TABLE):
+            archive._database.execute_sql('DROP TABLE IF EXISTS "%s"' % table)
+        archive._ready = False
+        archive._searchModule = None
+    DatabaseWriter.instance().call(drop)
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        clearArchive()
+        self.contactDB = ContactDB.instance()
+        self.archive = MessageArchive.instance()
+        self.now = datetime.datetime.now().replace(microsecond=0)
+
+    def _add(self, messageId, daysAgo, message='message', conversationId='alice@s.whatsapp.net'):
+        timestamp = time.mktime((self.now - datetime.timedelta(days=daysAgo)).timetuple())
+        self.contactDB.addMessages([(conversationId, messageId, timestamp, conversationId, 'me@s.whatsapp.net', message)])
+
+    def _retention(self, days=30, chunkSize=3):
+        retention = Retention(lambda: True, chunkSize=chunkSize)
+        retention._days = days
+        return retention
+
+    def test_expired_messages_are_moved_in_chunks(self):
+        for number in range(10):
+            self._add('old%d' % number, 40 + number, 'old message %d' % number)
+        self._add('new0', 1)
+        self._add('new1', 2)
+        chunks = []
+        retention = self._retention()
+        archiveChunk = retention._archiveChunk
+        def countingArchiveChunk(conversationId, rows):
+            chunks.append(len(rows))
+            return archiveChunk(conversationId, rows)
+        retention._archiveChunk = countingArchiveChunk
+
+        self.assertEqual(retention._archiveExpired(), 10)
+        self.assertEqual(chunks, [3, 3, 3, 1])
+        self.assertEqual([message.messageId for message in self.contactDB.getMessageList('alice@s.whatsapp.net')], ['new1', 'new0'])
+        self.assertEqual(self.archive.countMessages('alice@s.whatsapp.net'), 10)
+        archived = self.archive.getMessage('old3')
+        self.assertEqual(archived.message, 'old message 3')
+        self.assertEqual(archived.timestamp, self.now - datetime.timedelta(days=43))
+        self.assertTrue(archived.isRead is False)
+        # nothing is left to archive, a second run does not find anything
+        self.assertEqual(retention._archiveExpired(), 0)
+
+    def test_archiving_is_idempotent(self):
+        self._add('old0', 40)
+        retention = self._retention()
+        rows = [(1, 'old0', 'alice@s.whatsapp.net', 'me@s.whatsapp.net', 'message', MessageModel.timestamp.db_value(self.now), False, True, True)]
+        # a chunk that was archived but not deleted is archived again on the next run
+        DatabaseWriter.instance().call(self.archive.storeMessages, 'alice@s.whatsapp.net', [row[1:] for row in rows])
+        self.assertEqual(retention._archiveExpired(), 1)
+        self.assertEqual(self.archive.countMessages('alice@s.whatsapp.net'), 1)
+        self.assertEqual(self.contactDB.countMessages('alice@s.whatsapp.net'), 0)
+
+    def test_unsent_messages_stay(self):
+        self._add('old0', 40)
+        self._add('old1', 41)
+        DatabaseWriter.instance().call(lambda: OutboxModel.create(messageId='old1', receiver='alice@s.whatsapp.net', message='message'))
+        self.assertEqual(self._retention()._archiveExpired(), 1)
+        self.assertEqual([message.messageId for message in self.contactDB.getMessageList('alice@s.whatsapp.net')], ['old1'])
+
+    def test_reading_does_not_create_the_archive(self):
+        self.assertEqual(self.archive.getMessageList('alice@s.whatsapp.net'), [])
+        self.assertEqual(self.archive.searchMessages('message'), [])
+        self.assertFalse(self.archive._ready)
+
+    def test_schema_is_read_without_the_writer(self):
+        self._add('old0', 40)
+        self._retention()._archiveExpired()
+        # like after a restart, the schema written by the writer thread is only read
+        archive = MessageArchive()
+        self.assertTrue(archive._isReady())
+        self.assertEqual(archive._searchModule, self.archive._searchModule)
+        self.assertEqual([result['messageId'] for result in archive.searchMessages('message')], ['old0'])
+
+    def test_keyset_paging(self):
+        # several messages share a timestamp, the messageId decides their order
+        for number in range(9):
+            self._add('msg%d' % number, 40 + number // 3)
+        self._retention(chunkSize=100)._archiveExpired()
+        expected = [message.messageId for message in self.archive.getMessageList('alice@s.whatsapp.net')]
+        self.assertEqual(expected, ['msg6', 'msg7', 'msg8', 'msg3', 'msg4', 'msg5', 'msg0', 'msg1', 'msg2'])
+
+        # backwards from the newest page, like scrolling up in the chat view
+        pages = []
+        page = self.archive.getMessageList('alice@s.whatsapp.net', numMessages=4)
+        while page:
+            pages.insert(0, [message.messageId for message in page])
+            page = self.archive.getMessageList('alice@s.whatsapp.net', numMessages=4, before=(page[0].timestamp, page[0].messageId))
+        self.assertEqual(pages, [['msg6'], ['msg7', 'msg8', 'msg3', 'msg4'], ['msg5', 'msg0', 'msg1', 'msg2']])
+
+        # and forward again
+        forward = []
+        page = self.archive.getMessageList('alice@s.whatsapp.net', numMessages=4, after=(self.now - datetime.timedelta(days=100), ''))
+        while page:
+            forward.extend(message.messageId for message in page)
+            page = self.archive.getMessageList('alice@s.whatsapp.net', numMessages=4, after=(page[-1].timestamp, page[-1].messageId))
+        self.assertEqual(forward, expected)
+        self.assertEqual(self.archive.countMessages('alice@s.whatsapp.net', before=(self.now - datetime.timedelta(days=41), 'msg4')), 4)
+
+    def test_archived_messages_are_found(self):
+        self._add('old0', 40, 'sent an image:<br><a href="http://example.com/holiday.jpg"><img src="wa-preview:0123" /></a> from the holiday')
+        self._add('new0', 1, 'another holiday')
+        self._retention()._archiveExpired()
+        results = self.archive.searchMessages('holiday')
+        self.assertEqual([result['messageId'] for result in results], ['old0'])
+        self.assertTrue(results[0]['archived'])
+        self.assertIn('<b>holiday</b>', results[0]['snippet'])
+        self.assertEqual(self.archive.searchMessages('href'), [])
+        self.assertEqual([result['messageId'] for result in self.contactDB.searchMessages('holiday')], ['new0'])
+
+if __name__ == '__main__':
+    unittest.main()
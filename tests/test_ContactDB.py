@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from . import resetDatabase
+from WazappDesktop.Database import ContactModel, DatabaseWriter
+from WazappDesktop.ContactDB import ContactDB
+
+class ContactDBTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        self.contactDB = ContactDB.instance()
+
+    def _storedName(self, conversationId):
+        DatabaseWriter.instance().flush()
+        return ContactModel.get(ContactModel.conversationId == conversationId).name
+
+    def test_writes_use_the_values_at_the_time_of_the_change(self):
+        blocker = DatabaseWriter.instance().submit(time.sleep, 0.1)
+        contact = self.contactDB.updateOrCreate('bob@s.whatsapp.net', name='Bob')
+        # changed in the cache while the write is still queued, without writing it
+        contact.name = 'not written'
+        blocker.wait()
+        self.assertEqual(self._storedName('bob@s.whatsapp.net'), 'Bob')
+        self.assertIsNotNone(contact.id)
+
+    def test_messages_for_new_contacts(self):
+        added = self.contactDB.addMessages([('carol@s.whatsapp.net', 'msg1', time.time(), 'carol@s.whatsapp.net', 'me@s.whatsapp.net', 'hello')])
+        self.assertEqual(len(added), 1)
+        self.assertEqual(self._storedName('carol@s.whatsapp.net'), 'carol@s.whatsapp.net')
+        self.assertEqual([message.messageId for message in self.contactDB.getMessageList('carol@s.whatsapp.net')], ['msg1'])
+
+    def test_create_missing_keeps_existing_contacts(self):
+        self.contactDB.updateOrCreate('bob@s.whatsapp.net', name='Bobby')
+        loads = self.contactDB.getCacheStats()['loads']
+        created = self.contactDB.createMissing([('alice@s.whatsapp.net', 'Alice', '1'), ('bob@s.whatsapp.net', 'Bob', None)])
+        self.assertEqual(created, 1)
+        self.assertIsNotNone(self.contactDB.getContactId('alice@s.whatsapp.net'))
+        self.assertEqual(self._storedName('alice@s.whatsapp.net'), 'Alice')
+        self.assertEqual(self._storedName('bob@s.whatsapp.net'), 'Bobby')
+        # written through the cache, it does not have to be loaded again
+        self.assertEqual(self.contactDB.getCacheStats()['loads'], loads)
+
+    def test_version_changes_only_with_what_is_rendered(self):
+        version = self.contactDB.getVersion()
+        # a new contact without name or picture looks like the unknown contact it was before
+        self.contactDB.updateOrCreate('dave@s.whatsapp.net')
+        self.contactDB.updateOrCreate('dave@s.whatsapp.net', lastSeen=None)
+        self.assertEqual(self.contactDB.getVersion(), version)
+        self.contactDB.updateOrCreate('dave@s.whatsapp.net', name='Dave')
+        self.assertEqual(self.contactDB.getVersion(), version + 1)
+        self.contactDB.updateOrCreate('erin@s.whatsapp.net', name='Erin')
+        self.assertEqual(self.contactDB.getVersion(), version + 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import unittest
+
+from . import resetDatabase, dataDir
+from WazappDesktop.helpers import DATABASE_FILE
+from WazappDesktop.Database import WazappDatabase, DatabaseWriter, WriteTimeout
+
+class DatabaseWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        self.writer = DatabaseWriter.instance()
+
+    def test_writes_run_in_order_on_one_thread(self):
+        done = []
+        threads = set()
+        def write(number):
+            threads.add(threading.current_thread())
+            done.append(number)
+            return number
+        results = [self.writer.submit(write, number) for number in range(100)]
+        self.assertEqual([result.wait() for result in results], range(100))
+        self.assertEqual(done, range(100))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads.pop(), threading.current_thread())
+
+    def test_errors_are_raised_to_the_caller(self):
+        def fail():
+            raise ValueError('broken write')
+        self.assertRaises(ValueError, self.writer.call, fail)
+        # the writer keeps going after a failed write
+        self.assertEqual(self.writer.call(lambda: 42), 42)
+
+    def test_nested_writes_run_right_away(self):
+        # a write submitted from the writer thread must not wait behind itself
+        self.assertEqual(self.writer.call(lambda: self.writer.call(lambda: 'inner')), 'inner')
+
+    def test_wait_timeout(self):
+        blocker = threading.Event()
+        self.writer.submit(blocker.wait, 5)
+        result = self.writer.submit(lambda: None)
+        try:
+            self.assertRaises(WriteTimeout, result.wait, 0.05)
+        finally:
+            blocker.set()
+        self.assertIsNone(result.wait(5))
+
+class WazappDatabaseTest(unittest.TestCase):
+
+    def test_new_files_use_incremental_vacuum(self):
+        filename = os.path.join(dataDir, 'new.db')
+        database = WazappDatabase(filename)
+        database.execute_sql('CREATE TABLE "test" ("id" INTEGER PRIMARY KEY)')
+        database.close()
+        connection = sqlite3.connect(filename)
+        try:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(connection.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        finally:
+            connection.close()
+
+    def test_initialized_database_uses_incremental_vacuum(self):
+        resetDatabase()
+        connection = sqlite3.connect(DATABASE_FILE)
+        try:
+            self.assertEqual(connection.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        finally:
+            connection.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import unittest
+
+from PyQt4.QtCore import QCoreApplication
+
+from WazappDesktop.Events import Events, EventBus
+
+# the tests call _drain() themselves, the event loop of the application never runs
+application = QCoreApplication.instance() or QCoreApplication([])
+
+class FakeSignalsInterface(object):
+    def __init__(self):
+        self.listeners = {}
+
+    def registerListener(self, event, callback):
+        self.listeners[event] = callback
+
+    def fire(self, event, *args):
+        # like yowsup on its network thread
+        self.listeners[event](*args)
+
+class Listener(Events):
+    def __init__(self):
+        self.received = []
+
+    @Events.bind('message_received')
+    def onMessageReceived(self, messageId, text):
+        self.received.append(('message', messageId, text))
+
+    @Events.bind('presence_updated')
+    def onPresenceUpdated(self, jid, lastSeen):
+        self.received.append(('lastSeen', jid, lastSeen))
+
+    @Events.bind('presence_available')
+    def onAvailable(self, jid):
+        self.received.append(('available', jid))
+
+    @Events.bind('presence_unavailable')
+    def onUnavailable(self, jid):
+        self.received.append(('unavailable', jid))
+
+class EventBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.signalsInterface = FakeSignalsInterface()
+        self.bus = EventBus(self.signalsInterface)
+        self.listener = Listener()
+        self.bus.register(self.listener)
+
+    def tearDown(self):
+        self.bus.close()
+
+    def _drainAll(self):
+        while self.bus.getStats()['queued']:
+            self.bus._drain()
+
+    def test_events_keep_their_order(self):
+        for number in range(10):
+            self.signalsInterface.fire('message_received', 'msg%d' % number, 'text')
+        self.assertEqual(self.listener.received, [])
+        self._drainAll()
+        self.assertEqual([item[1] for item in self.listener.received], ['msg%d' % number for number in range(10)])
+        self.assertEqual(self.bus.getStats()['events'], 10)
+
+    def test_coalescing_keeps_the_newest_arguments(self):
+        self.signalsInterface.fire('presence_updated', 'alice', 10)
+        self.signalsInterface.fire('message_received', 'msg1', 'text')
+        self.signalsInterface.fire('presence_updated', 'bob', 20)
+        self.signalsInterface.fire('presence_updated', 'alice', 30)
+        self._drainAll()
+        # alice keeps the place of her first update, with the arguments of the last one
+        self.assertEqual(self.listener.received, [('lastSeen', 'alice', 30), ('message', 'msg1', 'text'), ('lastSeen', 'bob', 20)])
+        self.assertEqual(self.bus.getStats()['coalesced'], 1)
+
+    def test_presence_coalesces_across_events(self):
+        self.signalsInterface.fire('presence_available', 'alice')
+        self.signalsInterface.fire('presence_unavailable', 'alice')
+        self.signalsInterface.fire('presence_available', 'alice')
+        self._drainAll()
+        self.assertEqual(self.listener.received, [('available', 'alice')])
+        # after the drain the next update is queued again
+        self.signalsInterface.fire('presence_unavailable', 'alice')
+        self._drainAll()
+        self.assertEqual(self.listener.received, [('available', 'alice'), ('unavailable', 'alice')])
+
+    def test_batches_are_limited(self):
+        self.bus._batchSize = 3
+        for number in range(7):
+            self.signalsInterface.fire('message_received', 'msg%d' % number, 'text')
+        self.bus._drain()
+        self.assertEqual(len(self.listener.received), 3)
+        self.assertEqual(self.bus.getStats()['queued'], 4)
+        self._drainAll()
+        self.assertEqual(len(self.listener.received), 7)
+
+    def test_failing_handler_does_not_stop_the_batch(self):
+        def fail(messageId, text):
+            raise ValueError('broken handler')
+        self.bus._handlers['message_received'].insert(0, fail)
+        self.signalsInterface.fire('message_received', 'msg1', 'text')
+        self._drainAll()
+        self.assertEqual(self.listener.received, [('message', 'msg1', 'text')])
+
+    def test_full_queue_makes_the_network_thread_wait(self):
+        self.bus._maxQueued = 2
+        def network():
+            for number in range(5):
+                self.signalsInterface.fire('message_received', 'msg%d' % number, 'text')
+        thread = threading.Thread(target=network)
+        thread.start()
+        deadline = time.time() + 5
+        while self.bus.getStats()['backpressureWaits'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.bus.getStats()['queued'], 2)
+        # nothing is dropped, every drain makes room for the waiting thread
+        while thread.is_alive() or self.bus.getStats()['queued']:
+            self.bus._drain()
+            time.sleep(0.01)
+            self.assertLess(time.time(), deadline)
+        thread.join()
+        self.assertEqual([item[1] for item in self.listener.received], ['msg%d' % number for number in range(5)])
+        self.assertLessEqual(self.bus.getStats()['maxQueued'], 2)
+
+    def test_qt_thread_never_waits(self):
+        self.bus._maxQueued = 2
+        for number in range(5):
+            self.signalsInterface.fire('message_received', 'msg%d' % number, 'text')
+        self.assertEqual(self.bus.getStats()['queued'], 5)
+        self.assertEqual(self.bus.getStats()['backpressureWaits'], 0)
+
+    def test_close_releases_a_waiting_thread(self):
+        self.bus._maxQueued = 1
+        self.signalsInterface.fire('message_received', 'msg0', 'text')
+        thread = threading.Thread(target=self.signalsInterface.fire, args=('message_received', 'msg1', 'text'))
+        thread.start()
+        deadline = time.time() + 5
+        while self.bus.getStats()['backpressureWaits'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.bus.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from . import resetDatabase
+from WazappDesktop.ContactDB import ContactDB
+from WazappDesktop.MessageIngestor import MessageIngestor
+
+def makeMessage(number, conversationId='alice@s.whatsapp.net'):
+    return (conversationId, 'msg%d' % number, time.time() + number, conversationId, 'me@s.whatsapp.net', 'message %d' % number)
+
+class MessageIngestorTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        self.committed = []
+        self.acks = []
+
+    def _committed(self, messages, acks):
+        self.committed.extend(messages)
+        self.acks.extend(acks)
+
+    def _ingest(self, messages, **kwargs):
+        ingestor = MessageIngestor(self._committed, **kwargs)
+        for message in messages:
+            # every message wants a receipt
+            ingestor.add(*message, ack=message[1])
+        ingestor.close()
+        return ingestor.getStats()
+
+    def test_batches(self):
+        messages = [makeMessage(number) for number in range(25)]
+        stats = self._ingest(messages, maxBatchSize=10, maxDelay=1.0)
+        self.assertEqual(stats['messages'], 25)
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['maxBatchSize'], 10)
+        self.assertEqual(self.committed, messages)
+        self.assertEqual(self.acks, [message[1] for message in messages])
+        self.assertEqual(ContactDB.instance().countMessages('alice@s.whatsapp.net'), 25)
+
+    def test_duplicates_are_skipped(self):
+        messages = [makeMessage(1), makeMessage(2), makeMessage(1)]
+        stats = self._ingest(messages)
+        self.assertEqual(stats['messages'], 2)
+        self.assertEqual(stats['duplicates'], 1)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual([message[1] for message in self.committed], ['msg1', 'msg2'])
+        # the duplicate is stored already, it is acknowledged again
+        self.assertEqual(self.acks, ['msg1', 'msg2', 'msg1'])
+        self.assertEqual(ContactDB.instance().countMessages('alice@s.whatsapp.net'), 2)
+
+    def test_failed_batch_falls_back_to_single_messages(self):
+        contactDB = ContactDB.instance()
+        addMessages = contactDB.addMessages
+        def failingAddMessages(messages):
+            # the whole batch fails because of one broken message
+            if any(message[5] is None for message in messages):
+                raise ValueError('broken message')
+            return addMessages(messages)
+        contactDB.addMessages = failingAddMessages
+        try:
+            broken = makeMessage(2)[:5] + (None,)
+            stats = self._ingest([makeMessage(1), broken, makeMessage(3)], maxDelay=1.0, retryDelay=0.0)
+        finally:
+            del contactDB.addMessages
+        self.assertEqual(stats['messages'], 2)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['duplicates'], 0)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual([message[1] for message in self.committed], ['msg1', 'msg3'])
+        self.assertEqual(self.acks, ['msg1', 'msg3'])
+
+    def test_no_acks_for_a_failed_batch(self):
+        contactDB = ContactDB.instance()
+        def failingAddMessages(messages):
+            raise ValueError('database is broken')
+        contactDB.addMessages = failingAddMessages
+        try:
+            stats = self._ingest([makeMessage(1), makeMessage(2)], maxDelay=1.0, retryDelay=0.0)
+        finally:
+            del contactDB.addMessages
+        self.assertEqual(stats['failed'], 2)
+        self.assertEqual(self.committed, [])
+        self.assertEqual(self.acks, [])
+
+if __name__ == '__main__':
+    unittest.main()
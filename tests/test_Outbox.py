@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from PyQt4.QtCore import QCoreApplication
+
+from . import resetDatabase
+from WazappDesktop.Database import MessageModel, OutboxModel, DatabaseWriter
+from WazappDesktop.Outbox import Outbox
+
+# timers need an application object, its event loop never runs in the tests
+application = QCoreApplication.instance() or QCoreApplication([])
+
+class FakeMethodsInterface(object):
+    def __init__(self):
+        self.sent = []
+
+    def call(self, method, args=()):
+        # like yowsup, every sent message gets a new id
+        self.sent.append((method, args))
+        return 'server-%d' % len(self.sent)
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        self.methodsInterface = FakeMethodsInterface()
+        self.outbox = Outbox(self.methodsInterface, 'me@s.whatsapp.net')
+        self.renamed = []
+        self.outbox.message_id_changed_signal.connect(lambda receiver, oldId, newId: self.renamed.append((oldId, newId)))
+
+    def tearDown(self):
+        self.outbox.close()
+
+    def _message(self, messageId):
+        DatabaseWriter.instance().flush()
+        for message in MessageModel.select().where(MessageModel.messageId == messageId):
+            return message
+        return None
+
+    def _outboxIds(self):
+        DatabaseWriter.instance().flush()
+        return [entry.messageId for entry in OutboxModel.select()]
+
+    def test_messages_wait_until_online(self):
+        localId = self.outbox.add('bob@s.whatsapp.net', u'hello')
+        self.assertEqual(self.methodsInterface.sent, [])
+        self.assertEqual(self._outboxIds(), [localId])
+        self.assertIsNotNone(self._message(localId))
+
+        self.outbox.setOnline(True)
+        self.assertEqual(self.methodsInterface.sent, [('message_send', ('bob@s.whatsapp.net', 'hello'))])
+        self.assertEqual(self.renamed, [(localId, 'server-1')])
+        self.assertEqual(self._outboxIds(), ['server-1'])
+        self.assertIsNone(self._message(localId))
+        self.assertIsNotNone(self._message('server-1'))
+
+    def test_messages_are_sent_in_order(self):
+        for number in range(5):
+            self.outbox.add('bob@s.whatsapp.net', u'message %d' % number)
+        self.outbox.setOnline(True)
+        self.assertEqual([args[1] for method, args in self.methodsInterface.sent], ['message %d' % number for number in range(5)])
+
+    def test_late_receipt_for_an_earlier_attempt(self):
+        self.outbox.setOnline(True)
+        self.outbox._retryTimeout = 0
+        self.outbox.add('bob@s.whatsapp.net', u'hello')
+        self.outbox.sendPending()
+        self.outbox.sendPending()
+        self.assertEqual(len(self.methodsInterface.sent), 2)
+        # the server confirms the first attempt, the message is known as server-2 by now
+        self.outbox.markSent('server-1')
+        self.outbox.flushStatuses()
+        self.assertEqual(self.outbox.getStats()['pending'], 0)
+        self.assertEqual(self._outboxIds(), [])
+        self.assertTrue(self._message('server-2').isSent)
+        self.outbox.markDelivered('server-1')
+        self.outbox.flushStatuses()
+        self.assertTrue(self._message('server-2').isDelivered)
+
+    def test_receipt_after_the_resend(self):
+        self.outbox.setOnline(True)
+        self.outbox._retryTimeout = 0
+        localId = self.outbox.add('bob@s.whatsapp.net', u'hello')
+        self.outbox.sendPending()
+        self.outbox.sendPending()
+        # the status shown for the receipt of the first attempt is that of the message as it is known now
+        self.assertEqual(self.outbox.currentId('server-1'), 'server-2')
+        self.assertEqual(self.outbox.currentId(localId), 'server-2')
+        self.assertEqual(self.outbox.currentId('server-2'), 'server-2')
+
+    def test_no_retry_after_a_receipt(self):
+        self.outbox.setOnline(True)
+        self.outbox._retryTimeout = 0
+        self.outbox.add('bob@s.whatsapp.net', u'hello')
+        self.outbox.sendPending()
+        self.outbox.markDelivered('server-1')
+        # the receipt is not flushed yet, it still must stop the retry
+        self.outbox.sendPending()
+        self.assertEqual(len(self.methodsInterface.sent), 1)
+        self.assertTrue(self._message('server-1').isDelivered)
+
+    def test_attempts_are_limited(self):
+        self.outbox._maxAttempts = 3
+        self.outbox.setOnline(True)
+        self.outbox._retryTimeout = 0
+        self.outbox.add('bob@s.whatsapp.net', u'hello')
+        for i in range(5):
+            self.outbox.sendPending()
+        self.assertEqual(len(self.methodsInterface.sent), 3)
+        # a new login gives it a new set of attempts
+        self.outbox.setOnline(False)
+        self.outbox.setOnline(True)
+        self.assertEqual(len(self.methodsInterface.sent), 4)
+
+    def test_pending_messages_are_loaded(self):
+        self.outbox.add('bob@s.whatsapp.net', u'hello')
+        self.outbox.close()
+        DatabaseWriter.instance().flush()
+        self.outbox = Outbox(self.methodsInterface, 'me@s.whatsapp.net')
+        self.outbox.setOnline(True)
+        self.assertEqual(len(self.methodsInterface.sent), 1)
+
+if __name__ == '__main__':
+    unittest.main()
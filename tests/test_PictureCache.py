@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from . import resetDatabase
+from WazappDesktop.ContactDB import ContactDB
+from WazappDesktop.PictureCache import PictureCache, ORIGINALS_PATH
+
+class PictureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        self.cache = PictureCache.instance()
+        self.cache._hashes = {}
+        self.cache._lastUsed = {}
+        for name in os.listdir(ORIGINALS_PATH):
+            os.remove(os.path.join(ORIGINALS_PATH, name))
+
+    def _addPicture(self, conversationId, contentHash, size):
+        with open(os.path.join(ORIGINALS_PATH, '%s.jpeg' % contentHash), 'wb') as fp:
+            fp.write('x' * size)
+        self.cache._getHashes()[conversationId] = contentHash
+        ContactDB.instance().updateOrCreate(conversationId, pictureId=conversationId)
+
+    def test_evict_removes_stray_files(self):
+        self._addPicture('alice@s.whatsapp.net', 'a' * 40, 100)
+        self._addPicture('bob@s.whatsapp.net', 'b' * 40, 100)
+        # the picture of carol never made it into the cache
+        strayPath = os.path.join(ORIGINALS_PATH, '%s.tmp' % ('c' * 40))
+        with open(strayPath, 'wb') as fp:
+            fp.write('x' * 100)
+        self.cache._getHashes()['carol@s.whatsapp.net'] = 'c' * 40
+        ContactDB.instance().updateOrCreate('carol@s.whatsapp.net', pictureId='carol@s.whatsapp.net')
+        # over budget, so the least recently used picture has to go as well
+        self.cache._maxSize = 150
+        self.cache._lastUsed['b' * 40] = 1.0
+        self.cache._lastUsed['a' * 40] = 2.0
+        self.cache.evict()
+        self.assertEqual(os.listdir(ORIGINALS_PATH), ['%s.jpeg' % ('a' * 40)])
+        self.assertEqual(self.cache.getOriginal('bob@s.whatsapp.net'), None)
+        self.assertEqual(self.cache.getOriginal('carol@s.whatsapp.net'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from . import resetDatabase
+from WazappDesktop.Database import MessageModel, DatabaseWriter, getDatabase, getSearchModule, searchMatch, searchText, setMetaData, backfillSearchIndex, SEARCH_TABLE
+from WazappDesktop.ContactDB import ContactDB
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        resetDatabase()
+        self.contactDB = ContactDB.instance()
+        self.writer = DatabaseWriter.instance()
+
+    def _add(self, messageId, message):
+        self.contactDB.addMessages([('alice@s.whatsapp.net', messageId, time.time(), 'alice@s.whatsapp.net', 'me@s.whatsapp.net', message)])
+
+    def _search(self, text):
+        return [result['messageId'] for result in self.contactDB.searchMessages(text)]
+
+    def _execute(self, sql, parameters=()):
+        def execute():
+            with getDatabase().transaction():
+                getDatabase().execute_sql(sql, parameters, require_commit=False)
+        self.writer.call(execute)
+
+    def test_search_module(self):
+        self.assertIn(getSearchModule(), ('fts5', 'fts4'))
+
+    def test_triggers_follow_inserts_updates_and_deletes(self):
+        self._add('msg1', 'see you at the station')
+        self._add('msg2', 'the train is late')
+        self.assertEqual(self._search('station'), ['msg1'])
+        self.assertEqual(sorted(self._search('the')), ['msg1', 'msg2'])
+        # prefix match
+        self.assertEqual(self._search('trai'), ['msg2'])
+
+        table = MessageModel._meta.db_table
+        self._execute('UPDATE "%s" SET "%s" = ? WHERE "%s" = ?' % (table, MessageModel.message.db_column, MessageModel.messageId.db_column), ('the bus is late', 'msg2'))
+        self.assertEqual(self._search('train'), [])
+        self.assertEqual(self._search('bus'), ['msg2'])
+
+        self._execute('DELETE FROM "%s" WHERE "%s" = ?' % (table, MessageModel.messageId.db_column), ('msg1',))
+        self.assertEqual(self._search('station'), [])
+        self.assertEqual(self._search('the'), ['msg2'])
+
+    def test_markup_is_not_indexed(self):
+        self._add('msg1', 'sent an image:<br><a href="http://example.com/holiday.jpg"><img alt="Preview Image" src="data:image/jpeg;base64,aG9saWRheQ==" /></a>')
+        self._add('msg2', 'sent an image:<br><a href="http://example.com/beach.jpg"><img alt="Preview Image" src="wa-preview:0123456789abcdef0123456789abcdef01234567" /></a>')
+        for text in ('href', 'holiday', 'beach', 'preview', 'base64', 'aG9saWRheQ', 'img'):
+            self.assertEqual(self._search(text), [], text)
+        self.assertEqual(sorted(self._search('image')), ['msg1', 'msg2'])
+        self.assertEqual(searchText('a <b>bold</b> word'), 'a  bold  word')
+        self.assertEqual(searchText('inline data:image/png;base64,AAAA== preview'), 'inline   preview')
+
+    def test_snippet_highlights_the_match(self):
+        self._add('msg1', 'meet me <b>downstairs</b> later')
+        results = self.contactDB.searchMessages('downstairs')
+        self.assertEqual(len(results), 1)
+        self.assertIn('<b>downstairs</b>', results[0]['snippet'])
+
+    def test_backfill(self):
+        self._add('msg1', 'an old message')
+        self._add('msg2', 'another old message')
+        # pretend both were stored before the index existed
+        self._execute('DELETE FROM "%s"' % SEARCH_TABLE if getSearchModule() == 'fts4' else 'INSERT INTO "%s" ("%s") VALUES (\'delete-all\')' % (SEARCH_TABLE, SEARCH_TABLE))
+        maxId = MessageModel.select().order_by(MessageModel.id.desc()).get().id
+        self.writer.call(setMetaData, 'searchIndexBackfill', str(maxId))
+        self.assertEqual(self._search('old'), [])
+        # the triggers leave messages that are not indexed yet alone
+        self._execute('DELETE FROM "%s" WHERE "%s" = ?' % (MessageModel._meta.db_table, MessageModel.messageId.db_column), ('msg1',))
+        self._add('msg3', 'a new message')
+        self.assertEqual(self._search('message'), ['msg3'])
+        while self.writer.call(backfillSearchIndex, 1):
+            pass
+        self.assertEqual(sorted(self._search('message')), ['msg2', 'msg3'])
+        self.assertEqual(self._search('old'), ['msg2'])
+
+class SearchMatchTest(unittest.TestCase):
+
+    def test_words_are_quoted(self):
+        self.assertEqual(searchMatch('hello world', 'fts5'), '"hello"* "world"*')
+        self.assertEqual(searchMatch('hello world', 'fts4'), '"hello*" "world*"')
+
+    def test_query_syntax_is_ignored(self):
+        self.assertEqual(searchMatch('"a" OR b* -c NEAR(d)', 'fts5'), '"a"* "OR"* "b"* "c"* "NEAR"* "d"*')
+        self.assertEqual(searchMatch('message:x', 'fts4'), '"message*" "x*"')
+
+    def test_no_words(self):
+        self.assertIsNone(searchMatch('', 'fts5'))
+        self.assertIsNone(searchMatch(' "*- ', 'fts4'))
+
+    def test_unicode(self):
+        self.assertEqual(searchMatch(u'grüße', 'fts5'), u'"grüße"*')
+
+if __name__ == '__main__':
+    unittest.main()